@@ -0,0 +1,113 @@
+"""
+One-off backfill for addresses saved before the fingerprint column existed.
+
+    python -m app.address_fingerprints backfill
+
+Each batch fingerprints its rows and merges duplicates into one address per
+(user_id, fingerprint): orders are repointed at the kept row and the copies are
+deleted, so the unique key can hold for every row and the backfill finishes.
+"""
+import argparse
+import asyncio
+
+from sqlalchemy import select, case, and_, tuple_
+
+from app.crud import address_fingerprint
+from app.database import database
+from app.models import addresses, orders
+
+ADDRESS_BACKFILL_BATCH_SIZE = 500
+
+
+async def _backfill_batch(rows) -> tuple:
+    """Fingerprints one batch of NULL-fingerprint rows; returns (fingerprinted, merged)."""
+    fingerprints = {row["id"]: address_fingerprint(dict(row)) for row in rows}
+    keys = sorted({(row["user_id"], fingerprints[row["id"]]) for row in rows})
+
+    # Rows that already carry a fingerprint win; locked so a concurrent save cannot add one meanwhile
+    keepers = {
+        (row["user_id"], row["fingerprint"]): row
+        for row in await database.fetch_all(
+            select(addresses.c.id, addresses.c.user_id, addresses.c.fingerprint, addresses.c.is_default)
+            .where(tuple_(addresses.c.user_id, addresses.c.fingerprint).in_(keys))
+            .with_for_update()
+        )
+    }
+    to_fingerprint, duplicates, defaults = {}, {}, set()
+    for row in sorted(rows, key=lambda row: row["id"]):
+        key = (row["user_id"], fingerprints[row["id"]])
+        keeper = keepers.get(key)
+        if keeper is None:
+            keepers[key] = row
+            to_fingerprint[row["id"]] = fingerprints[row["id"]]
+            continue
+        duplicates[row["id"]] = keeper["id"]
+        if row["is_default"] and not keeper["is_default"]:
+            defaults.add(keeper["id"])
+
+    if duplicates:
+        await database.execute(
+            orders.update()
+            .where(orders.c.shipping_address_id.in_(sorted(duplicates)))
+            .values(shipping_address_id=case(duplicates, value=orders.c.shipping_address_id))
+        )
+        await database.execute(addresses.delete().where(addresses.c.id.in_(sorted(duplicates))))
+    if to_fingerprint:
+        # updated_at is listed so its onupdate does not stamp every legacy row with now
+        await database.execute(
+            addresses.update()
+            .where(addresses.c.id.in_(sorted(to_fingerprint)))
+            .values(
+                fingerprint=case(to_fingerprint, value=addresses.c.id),
+                updated_at=addresses.c.updated_at,
+            )
+        )
+    if defaults:
+        await database.execute(
+            addresses.update()
+            .where(addresses.c.id.in_(sorted(defaults)))
+            .values(is_default=True, updated_at=addresses.c.updated_at)
+        )
+    return len(to_fingerprint), len(duplicates)
+
+
+async def backfill_address_fingerprints(batch_size: int = ADDRESS_BACKFILL_BATCH_SIZE) -> tuple:
+    """
+    Fingerprints every address that has none, one transaction per id batch, merging
+    legacy duplicates as it goes. Safe to re-run. Returns (fingerprinted, merged).
+    """
+    fingerprinted = merged = 0
+    last_id = 0
+    while True:
+        async with database.transaction():
+            rows = await database.fetch_all(
+                addresses.select()
+                .where(and_(addresses.c.fingerprint.is_(None), addresses.c.id > last_id))
+                .order_by(addresses.c.id)
+                .limit(batch_size)
+                .with_for_update()
+            )
+            if not rows:
+                return fingerprinted, merged
+            batch_fingerprinted, batch_merged = await _backfill_batch(rows)
+        fingerprinted += batch_fingerprinted
+        merged += batch_merged
+        last_id = rows[-1]["id"]
+
+
+async def _main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.address_fingerprints")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("backfill", help="fingerprint legacy addresses and merge their duplicates")
+    parser.parse_args(argv)
+
+    await database.connect()
+    try:
+        fingerprinted, merged = await backfill_address_fingerprints()
+        print(f"Fingerprinted {fingerprinted} addresses, merged {merged} duplicates", flush=True)
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
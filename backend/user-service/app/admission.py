@@ -0,0 +1,142 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+
+from fastapi import HTTPException, Response
+
+# Checkout transactions allowed at once; keep below the database pool size so catalog reads always find a connection
+CHECKOUT_MAX_CONCURRENT = int(os.getenv("CHECKOUT_MAX_CONCURRENT", 5))
+# Checkouts waiting for a slot beyond this are turned away immediately
+CHECKOUT_MAX_QUEUE = int(os.getenv("CHECKOUT_MAX_QUEUE", 100))
+CHECKOUT_MAX_WAIT_SECONDS = float(os.getenv("CHECKOUT_MAX_WAIT_SECONDS", 10))
+
+# Recent waits kept for the percentiles in stats()
+_WAIT_SAMPLES = 1000
+
+
+class AdmissionController:
+    """
+    Bounded budget of concurrent checkout transactions with a FIFO wait queue. A
+    finishing checkout hands its slot straight to the oldest waiter, so nobody is
+    overtaken. Full queues and long waits are rejected with 429 and a Retry-After
+    estimated from recent service times.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, max_wait_seconds: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self._active = 0
+        self._waiters = deque()
+        self._service_seconds = 0.2  # EWMA of how long a checkout holds its slot
+        self._waits = deque(maxlen=_WAIT_SAMPLES)
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    def _retry_after(self, position: int) -> int:
+        # Time for the queue ahead to drain through the slots
+        return max(1, math.ceil(position * self._service_seconds / self.max_concurrent))
+
+    def _reject(self, position: int, reason: str):
+        retry_after = self._retry_after(position)
+        raise HTTPException(
+            status_code=429,
+            detail={"message": f"Checkout is busy ({reason}), please retry", "queue_position": position, "retry_after": retry_after},
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    async def acquire(self):
+        """Waits for a slot; returns (queue position on arrival, seconds waited)."""
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            self.admitted += 1
+            self._waits.append(0.0)
+            return 0, 0.0
+
+        position = len(self._waiters) + 1
+        if position > self.max_queue:
+            self.rejected_full += 1
+            self._reject(position, "queue full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, timeout=self.max_wait_seconds)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot arrived as the wait ran out; give it to the next in line
+                self.release(0.0)
+            else:
+                self._remove(waiter)
+            self.rejected_timeout += 1
+            self._reject(len(self._waiters) + 1, "waited too long")
+        except asyncio.CancelledError:
+            # Client went away while queued
+            if waiter.done() and not waiter.cancelled():
+                self.release(0.0)
+            else:
+                self._remove(waiter)
+            raise
+
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self._waits.append(waited)
+        return position, waited
+
+    def _remove(self, waiter):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self, service_seconds: float):
+        if service_seconds:
+            self._service_seconds = 0.9 * self._service_seconds + 0.1 * service_seconds
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # slot passes to the waiter; active count unchanged
+                return
+        self._active -= 1
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+
+        def percentile(p):
+            return round(waits[max(0, int(len(waits) * p / 100) - 1)] * 1000, 1) if waits else 0.0
+
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "active": self._active,
+            "queued": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "wait_p50_ms": percentile(50),
+            "wait_p99_ms": percentile(99),
+            "service_time_ms": round(self._service_seconds * 1000, 1),
+        }
+
+
+checkout_admission = AdmissionController(CHECKOUT_MAX_CONCURRENT, CHECKOUT_MAX_QUEUE, CHECKOUT_MAX_WAIT_SECONDS)
+
+
+async def checkout_slot(response: Response):
+    """
+    Route dependency holding a checkout slot for the handler's duration. Declare it
+    with Depends(checkout_slot, scope="function") so the slot is freed as soon as the
+    handler returns, not after the response has been sent.
+    """
+    position, waited = await checkout_admission.acquire()
+    response.headers["X-Checkout-Queue-Position"] = str(position)
+    response.headers["X-Checkout-Queue-Wait-Ms"] = str(round(waited * 1000))
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        checkout_admission.release(time.monotonic() - started)
@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import os
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, func, literal
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from app.auth import now_ist_naive
+from app.database import database
+from app.models import sales_rollup_hourly, sales_rollup_daily, sales_rollup_deltas, order_items, items
+
+# Rollup levels, selected by which id columns are zero. There is no site-wide row:
+# every checkout would queue on it, so site totals are summed from owner totals.
+ROLLUP_GROUPS = ("total", "item", "variant")
+
+SALES_ROLLUP_FOLD_SECONDS = float(os.getenv("SALES_ROLLUP_FOLD_SECONDS", 5))
+SALES_ROLLUP_FOLD_BATCH_SIZE = int(os.getenv("SALES_ROLLUP_FOLD_BATCH_SIZE", 5000))
+
+
+def _counts_as_sale(status: Optional[str]) -> bool:
+    return (status or "").lower() != "cancelled"
+
+
+# =====================
+# Incremental updates
+# =====================
+def _rollup_deltas(lines) -> dict:
+    """
+    Folds order lines (owner_id, item_id, variant_id, quantity, line_total) into
+    (owner_id, item_id, variant_id) -> [revenue, units, orders] for every rollup level.
+    An order counts once in each row it touches.
+    """
+    deltas = {}
+    for owner_id, item_id, variant_id, quantity, line_total in lines:
+        keys = [(owner_id, 0, 0), (owner_id, item_id, 0)]
+        if variant_id:
+            keys.append((owner_id, item_id, variant_id))
+        for key in keys:
+            delta = deltas.setdefault(key, [0.0, 0, 1])
+            delta[0] += line_total
+            delta[1] += quantity
+    return deltas
+
+
+def _merge_deltas(buckets: dict, bucket, deltas: dict, sign: int):
+    merged = buckets.setdefault(bucket, {})
+    for key, (revenue, units, orders) in deltas.items():
+        total = merged.setdefault(key, [0.0, 0, 0])
+        total[0] += sign * revenue
+        total[1] += sign * units
+        total[2] += sign * orders
+
+
+async def _upsert_buckets(table, buckets: dict):
+    for bucket, deltas in sorted(buckets.items()):
+        # Sorted so concurrent writers take the row locks in the same order
+        rows = [
+            {
+                "bucket": bucket,
+                "owner_id": owner_id,
+                "item_id": item_id,
+                "variant_id": variant_id,
+                "revenue": revenue,
+                "units": units,
+                "orders": orders,
+            }
+            for (owner_id, item_id, variant_id), (revenue, units, orders) in sorted(deltas.items())
+        ]
+        stmt = mysql_insert(table).values(rows)
+        stmt = stmt.on_duplicate_key_update(
+            revenue=table.c.revenue + stmt.inserted.revenue,
+            units=table.c.units + stmt.inserted.units,
+            orders=table.c.orders + stmt.inserted.orders,
+        )
+        await database.execute(stmt)
+
+
+async def _queue_order_deltas(changes):
+    """
+    Appends (order_date, deltas, sign) triples to sales_rollup_deltas with one
+    multi-row insert. Writers never touch the shared rollup rows, so concurrent
+    checkouts of one shop do not queue on its owner total; fold_rollup_deltas
+    merges the queue into the rollups.
+    """
+    rows = [
+        {
+            "bucket": order_date.replace(minute=0, second=0, microsecond=0),
+            "owner_id": owner_id,
+            "item_id": item_id,
+            "variant_id": variant_id,
+            "revenue": sign * revenue,
+            "units": sign * units,
+            "orders": sign * orders,
+        }
+        for order_date, deltas, sign in changes
+        for (owner_id, item_id, variant_id), (revenue, units, orders) in sorted(deltas.items())
+    ]
+    if rows:
+        await database.execute(sales_rollup_deltas.insert().values(rows))
+
+
+async def record_order_sale(order_date: datetime, lines):
+    """
+    Queues a new order for the rollups; call inside the create_order transaction.
+    `lines` are (owner_id, item_id, variant_id, quantity, line_total) tuples.
+    """
+    deltas = _rollup_deltas(lines)
+    if deltas:
+        await _queue_order_deltas([(order_date, deltas, 1)])
+
+
+async def apply_shipment_status_changes(changes):
+    """
+    Queues the rollup changes of shipments moving into or out of "cancelled"; only
+    the lines of the shipment's owner move, so one shop cancelling its part of an
+    order leaves the others counted. `changes` are (order, owner_id, old_status,
+    new_status) with `order` read FOR UPDATE in the caller's transaction, so two
+    concurrent changes cannot both apply the same delta. owner_id None stands for
+    the whole of an order that has no shipments.
+    """
+    flips = {
+        (order["id"], owner_id): (order["order_date"], -1 if _counts_as_sale(old_status) else 1)
+        for order, owner_id, old_status, new_status in changes
+        if _counts_as_sale(old_status) != _counts_as_sale(new_status) and order["order_date"]
+    }
+    if not flips:
+        return
+
+    rows = await database.fetch_all(
+        select(order_items.c.order_id, items.c.owner_id, order_items.c.item_id, order_items.c.variant_id,
+               order_items.c.quantity, order_items.c.line_total_price)
+        .select_from(order_items.join(items, order_items.c.item_id == items.c.id))
+        .where(order_items.c.order_id.in_(sorted({order_id for order_id, _ in flips})))
+    )
+    lines_by_shipment = {}
+    for row in rows:
+        key = (row["order_id"], row["owner_id"])
+        if key not in flips:
+            key = (row["order_id"], None)
+            if key not in flips:
+                continue
+        lines_by_shipment.setdefault(key, []).append(
+            (row["owner_id"], row["item_id"], row["variant_id"], row["quantity"], row["line_total_price"])
+        )
+
+    await _queue_order_deltas([
+        (order_date, _rollup_deltas(lines_by_shipment[key]), sign)
+        for key, (order_date, sign) in flips.items()
+        if key in lines_by_shipment
+    ])
+
+
+# =====================
+# Folding
+# =====================
+async def fold_rollup_deltas(batch_size: int = SALES_ROLLUP_FOLD_BATCH_SIZE) -> int:
+    """
+    Merges one batch of queued deltas into the hourly and daily rollups, one upsert
+    per bucket, and deletes them. Batches are claimed with SKIP LOCKED, so every
+    worker can fold. Returns how many deltas were folded.
+    """
+    async with database.transaction():
+        rows = await database.fetch_all(
+            sales_rollup_deltas.select()
+            .order_by(sales_rollup_deltas.c.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        if not rows:
+            return 0
+        hourly, daily = {}, {}
+        for row in rows:
+            deltas = {(row["owner_id"], row["item_id"], row["variant_id"]): (row["revenue"], row["units"], row["orders"])}
+            _merge_deltas(hourly, row["bucket"], deltas, 1)
+            _merge_deltas(daily, row["bucket"].date(), deltas, 1)
+        await _upsert_buckets(sales_rollup_hourly, hourly)
+        await _upsert_buckets(sales_rollup_daily, daily)
+        await database.execute(
+            sales_rollup_deltas.delete().where(sales_rollup_deltas.c.id.in_([row["id"] for row in rows]))
+        )
+    return len(rows)
+
+
+async def fold_all_rollup_deltas() -> int:
+    """Folds batches until the queue is drained."""
+    folded = 0
+    while True:
+        batch = await fold_rollup_deltas()
+        folded += batch
+        if batch < SALES_ROLLUP_FOLD_BATCH_SIZE:
+            return folded
+
+
+_folder_task: Optional[asyncio.Task] = None
+
+
+async def _run_folder():
+    while True:
+        await asyncio.sleep(SALES_ROLLUP_FOLD_SECONDS)
+        try:
+            await fold_all_rollup_deltas()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Sales rollup folding error: {e}", flush=True)
+
+
+def start_rollup_folder():
+    global _folder_task
+    if _folder_task is None:
+        _folder_task = asyncio.create_task(_run_folder())
+
+
+async def stop_rollup_folder():
+    global _folder_task
+    if _folder_task is not None:
+        _folder_task.cancel()
+        try:
+            await _folder_task
+        except asyncio.CancelledError:
+            pass
+        _folder_task = None
+
+
+# =====================
+# Queries (rollup tables only)
+# =====================
+async def fetch_rollups(
+    owner_id: Optional[int],
+    start: date,
+    end: date,
+    granularity: str = "day",
+    group_by: str = "total",
+    item_id: Optional[int] = None,
+    limit: int = 1000,
+):
+    """
+    Rollup rows for an inclusive date range. owner_id=0 reads site-wide totals, summed
+    from the owner totals per bucket, so an order spanning two shops counts as two
+    orders there; None reads every owner's rows of the level. Orders show up once
+    their deltas are folded, within SALES_ROLLUP_FOLD_SECONDS.
+    """
+    if granularity == "hour":
+        table = sales_rollup_hourly
+        query = select(table).where(
+            (table.c.bucket >= datetime.combine(start, datetime.min.time()))
+            & (table.c.bucket < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+        )
+    else:
+        table = sales_rollup_daily
+        query = select(table).where((table.c.bucket >= start) & (table.c.bucket <= end))
+
+    site_wide = owner_id == 0 and group_by == "total"
+    if site_wide:
+        query = (
+            query.with_only_columns(
+                table.c.bucket, literal(0).label("owner_id"), literal(0).label("item_id"),
+                literal(0).label("variant_id"), func.sum(table.c.revenue).label("revenue"),
+                func.sum(table.c.units).label("units"), func.sum(table.c.orders).label("orders"),
+            )
+            .where(table.c.owner_id != 0)
+            .group_by(table.c.bucket)
+        )
+    elif owner_id is None:
+        query = query.where(table.c.owner_id != 0)
+    else:
+        query = query.where(table.c.owner_id == owner_id)
+
+    if group_by == "total":
+        query = query.where((table.c.item_id == 0) & (table.c.variant_id == 0))
+    elif group_by == "item":
+        query = query.where((table.c.item_id != 0) & (table.c.variant_id == 0))
+    else:
+        query = query.where(table.c.variant_id != 0)
+    if item_id is not None:
+        query = query.where(table.c.item_id == item_id)
+
+    if site_wide:
+        query = query.order_by(table.c.bucket).limit(limit)
+    else:
+        query = query.order_by(table.c.bucket, table.c.owner_id, table.c.item_id, table.c.variant_id).limit(limit)
+    rows = await database.fetch_all(query)
+    return [
+        {
+            "bucket": row["bucket"] if granularity == "hour" else datetime.combine(row["bucket"], datetime.min.time()),
+            "owner_id": row["owner_id"],
+            "item_id": row["item_id"] or None,
+            "variant_id": row["variant_id"] or None,
+            "revenue": float(row["revenue"]),
+            "units": int(row["units"]),
+            "orders": int(row["orders"]),
+        }
+        for row in rows
+    ]
+
+
+# =====================
+# Backfill
+# =====================
+# (owner, item, variant) expressions and GROUP BY columns for each rollup level
+_BACKFILL_LEVELS = (
+    ("i.owner_id", "0", "0", ", i.owner_id", ""),
+    ("i.owner_id", "oi.item_id", "0", ", i.owner_id, oi.item_id", ""),
+    ("i.owner_id", "oi.item_id", "oi.variant_id", ", i.owner_id, oi.item_id, oi.variant_id",
+     "AND oi.variant_id IS NOT NULL"),
+)
+
+
+async def backfill_rollups(since: Optional[date] = None, until: Optional[date] = None):
+    """
+    Rebuilds both rollup tables for whole days from orders, in one transaction.
+    Orders committed while it runs may be missed, so run it for closed days or at a quiet time.
+    """
+    since = since or date(1970, 1, 1)
+    until = until or (now_ist_naive().date() + timedelta(days=1))
+    values = {
+        "since": datetime.combine(since, datetime.min.time()),
+        "until": datetime.combine(until + timedelta(days=1), datetime.min.time()),
+    }
+
+    async with database.transaction():
+        await database.execute(
+            sales_rollup_hourly.delete().where(
+                (sales_rollup_hourly.c.bucket >= values["since"]) & (sales_rollup_hourly.c.bucket < values["until"])
+            )
+        )
+        await database.execute(
+            sales_rollup_daily.delete().where(
+                (sales_rollup_daily.c.bucket >= since) & (sales_rollup_daily.c.bucket <= until)
+            )
+        )
+        # Queued deltas of these days are already part of the orders being re-read
+        await database.execute(
+            sales_rollup_deltas.delete().where(
+                (sales_rollup_deltas.c.bucket >= values["since"]) & (sales_rollup_deltas.c.bucket < values["until"])
+            )
+        )
+
+        for owner, item, variant, group_by, extra in _BACKFILL_LEVELS:
+            await database.execute(
+                query=f"""
+                INSERT INTO sales_rollup_hourly (bucket, owner_id, item_id, variant_id, revenue, units, orders)
+                SELECT TIMESTAMP(DATE(o.order_date), MAKETIME(HOUR(o.order_date), 0, 0)) AS hour_bucket,
+                       {owner}, {item}, {variant},
+                       SUM(oi.line_total_price), SUM(oi.quantity), COUNT(DISTINCT o.id)
+                FROM orders o
+                JOIN order_items oi ON oi.order_id = o.id
+                JOIN items i ON i.id = oi.item_id
+                LEFT JOIN order_shipments os ON os.order_id = o.id AND os.owner_id = i.owner_id
+                WHERE o.order_date >= :since AND o.order_date < :until
+                  AND LOWER(COALESCE(os.status, o.status, 'pending')) <> 'cancelled'
+                  {extra}
+                GROUP BY hour_bucket{group_by}
+                """,
+                values=values,
+            )
+
+        # Every order sits in exactly one hour, so daily rows are plain sums of hourly ones
+        await database.execute(
+            query="""
+            INSERT INTO sales_rollup_daily (bucket, owner_id, item_id, variant_id, revenue, units, orders)
+            SELECT DATE(bucket) AS day_bucket, owner_id, item_id, variant_id,
+                   SUM(revenue), SUM(units), SUM(orders)
+            FROM sales_rollup_hourly
+            WHERE bucket >= :since AND bucket < :until
+            GROUP BY day_bucket, owner_id, item_id, variant_id
+            """,
+            values=values,
+        )
+
+
+async def _main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.analytics")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    backfill = subcommands.add_parser("backfill", help="rebuild sales rollups from orders")
+    backfill.add_argument("--since", type=date.fromisoformat, help="first day to rebuild (YYYY-MM-DD)")
+    backfill.add_argument("--until", type=date.fromisoformat, help="last day to rebuild (YYYY-MM-DD)")
+    subcommands.add_parser("fold", help="merge queued sales deltas into the rollups now")
+    args = parser.parse_args(argv)
+
+    await database.connect()
+    try:
+        if args.command == "fold":
+            folded = await fold_all_rollup_deltas()
+            print(f"Folded {folded} sales rollup deltas", flush=True)
+        else:
+            await backfill_rollups(args.since, args.until)
+            print(f"Sales rollups rebuilt from {args.since or 'the first order'} to {args.until or 'today'}", flush=True)
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,361 @@
+import os
+import random
+import time
+from bisect import bisect_right
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException
+from pymysql.err import IntegrityError
+from sqlalchemy import select, func, or_
+
+from app.database import database
+from app.models import coupons, coupon_redemptions
+
+# Short TTL: coupon edits on other workers become visible within this window
+COUPON_CACHE_TTL_SECONDS = float(os.getenv("COUPON_CACHE_TTL_SECONDS", 30))
+
+# code -> (expires_at on the monotonic clock, coupon dict)
+_coupon_cache = {}
+
+# Sorted index of currently redeemable public coupons, rebuilt lazily (see _CouponIndex)
+_coupon_index = None
+# Most public coupons the index holds; beyond it /cart/best-coupon answers 503 instead of guessing
+COUPON_INDEX_MAX_SIZE = int(os.getenv("COUPON_INDEX_MAX_SIZE", 1000))
+
+
+# =====================
+# Coupon cache
+# =====================
+async def get_cached_coupon(code: str) -> Optional[dict]:
+    """
+    Returns the coupon row for a code from the in-process cache, loading it on a miss.
+    Callers must treat the dict as read-only; used_count in it may be stale.
+    """
+    now = time.monotonic()
+    entry = _coupon_cache.get(code)
+    if entry and entry[0] > now:
+        return entry[1]
+
+    row = await database.fetch_one(coupons.select().where(coupons.c.code == code))
+    if row is None:
+        _coupon_cache.pop(code, None)
+        return None
+    coupon = dict(row)
+    _coupon_cache[code] = (now + COUPON_CACHE_TTL_SECONDS, coupon)
+    return coupon
+
+
+def invalidate_coupon_cache(code: Optional[str] = None):
+    """
+    Drops one code (or everything) from this worker's cache after a coupon write.
+    """
+    global _coupon_index
+    if code is None:
+        _coupon_cache.clear()
+    else:
+        _coupon_cache.pop(code, None)
+    _coupon_index = None
+
+
+def _user_redemptions(user_id: int):
+    return (
+        select(func.count())
+        .select_from(coupon_redemptions)
+        .where(
+            (coupon_redemptions.c.coupon_id == coupons.c.id)
+            & (coupon_redemptions.c.user_id == user_id)
+        )
+        .scalar_subquery()
+    )
+
+
+# =====================
+# Validation (shared by /coupons/redeem and checkout)
+# =====================
+def compute_discount(coupon, subtotal: float) -> float:
+    """
+    Discount a coupon gives on a subtotal; never more than the subtotal itself.
+    """
+    if coupon["discount_type"] == "percentage":
+        discount_amount = subtotal * (coupon["discount_value"] / 100)
+    elif coupon["discount_type"] == "fixed":
+        discount_amount = coupon["discount_value"]
+    else:
+        discount_amount = 0.0
+    return min(discount_amount, subtotal)
+
+
+def check_coupon_rules(coupon, order_total: float, now: datetime, user_redemptions: int = 0):
+    """
+    Applies every coupon rule in one place and raises HTTPException on the first failure.
+    """
+    if not coupon or not coupon["active"]:
+        raise HTTPException(status_code=404, detail="Coupon not available or inactive")
+
+    # Check coupon validity period
+    if coupon["start_at"] and now < coupon["start_at"]:
+        raise HTTPException(status_code=400, detail="Coupon not valid yet")
+    if coupon["end_at"] and now > coupon["end_at"]:
+        raise HTTPException(status_code=400, detail="Coupon has expired")
+
+    # Check minimum order amount eligibility
+    if coupon["min_order_amount"] and order_total < coupon["min_order_amount"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Order total below minimum required amount: {coupon['min_order_amount']}"
+        )
+
+    # Check usage limits
+    if coupon["max_uses"] and (coupon["used_count"] or 0) >= coupon["max_uses"]:
+        raise HTTPException(status_code=400, detail="Coupon usage limit reached")
+    if coupon["per_user_limit"] and user_redemptions >= coupon["per_user_limit"]:
+        raise HTTPException(status_code=400, detail="You have already used this coupon the maximum number of times")
+
+
+async def validate_coupon(code: str, order_total: float, user_id: int, now: datetime):
+    """
+    Checks the cached coupon in memory; only coupons with usage limits cost a DB read,
+    because used_count and redemptions are never trusted from the cache.
+    Returns the coupon dict.
+    """
+    coupon = await get_cached_coupon(code)
+    check_coupon_rules(coupon, order_total, now)
+
+    if coupon["max_uses"] or coupon["per_user_limit"]:
+        counters = await database.fetch_one(
+            select(coupons.c.used_count, _user_redemptions(user_id).label("user_redemptions"))
+            .where(coupons.c.id == coupon["id"])
+        )
+        if counters is None:
+            invalidate_coupon_cache(code)
+            raise HTTPException(status_code=404, detail="Coupon not available or inactive")
+        coupon = {**coupon, "used_count": counters["used_count"]}
+        check_coupon_rules(coupon, order_total, now, counters["user_redemptions"])
+
+    return coupon
+
+
+# =====================
+# Redemption (checkout only)
+# =====================
+async def consume_coupon(coupon, user_id: int, order_id: int, order_total: float, now: datetime):
+    """
+    Counts one use of the coupon inside the caller's transaction. The increment is a
+    single conditional UPDATE, so concurrent checkouts can never push used_count past
+    max_uses or a customer past per_user_limit.
+    """
+    user_redemptions = _user_redemptions(user_id)
+    updated = await database.execute(
+        coupons.update()
+        .where(coupons.c.id == coupon["id"])
+        .where(coupons.c.active == True)
+        .where(or_(coupons.c.start_at.is_(None), coupons.c.start_at <= now))
+        .where(or_(coupons.c.end_at.is_(None), coupons.c.end_at >= now))
+        .where(func.coalesce(coupons.c.min_order_amount, 0) <= order_total)
+        .where(
+            or_(
+                func.coalesce(coupons.c.max_uses, 0) == 0,
+                func.coalesce(coupons.c.used_count, 0) < coupons.c.max_uses,
+            )
+        )
+        .where(
+            or_(
+                func.coalesce(coupons.c.per_user_limit, 0) == 0,
+                user_redemptions < coupons.c.per_user_limit,
+            )
+        )
+        # updated_at is listed explicitly so its Python-side onupdate does not null it
+        .values(used_count=func.coalesce(coupons.c.used_count, 0) + 1, updated_at=coupons.c.updated_at)
+    )
+    if not updated:
+        # Lost a race with another checkout or an edit; report the rule that now fails
+        invalidate_coupon_cache(coupon["code"])
+        await validate_coupon(coupon["code"], order_total, user_id, now)
+        raise HTTPException(status_code=400, detail="Coupon usage limit reached")
+
+    await database.execute(
+        coupon_redemptions.insert().values(
+            coupon_id=coupon["id"],
+            user_id=user_id,
+            order_id=order_id,
+            redeemed_at=now,
+        )
+    )
+
+
+# =====================
+# Bulk code generation
+# =====================
+COUPON_BATCH_CHUNK_SIZE = int(os.getenv("COUPON_BATCH_CHUNK_SIZE", 1000))
+
+_code_rng = random.SystemRandom()
+
+
+def generate_coupon_codes(count: int, length: int, alphabet: str, prefix: str = "", exclude=()) -> list:
+    """
+    Generates `count` distinct codes of prefix + `length` random characters, none of
+    which appear in `exclude`. Raises ValueError when the code space is too small for
+    collision-free generation to finish quickly.
+    """
+    alphabet = "".join(dict.fromkeys(alphabet))
+    if len(alphabet) < 2:
+        raise ValueError("Alphabet needs at least two distinct characters")
+    if len(alphabet) ** length < count * 2:
+        raise ValueError("Code space too small for the requested count; increase length or alphabet")
+
+    # One uniform draw over the whole code space per code, then base-N encode it
+    base = len(alphabet)
+    keyspace = base ** length
+    randbelow = _code_rng.randrange
+    codes = set()
+    while len(codes) < count:
+        for _ in range(count - len(codes)):
+            n = randbelow(keyspace)
+            chars = []
+            for _ in range(length):
+                n, digit = divmod(n, base)
+                chars.append(alphabet[digit])
+            code = prefix + "".join(chars)
+            if code not in exclude:
+                codes.add(code)
+    return list(codes)
+
+
+async def insert_coupon_codes(codes: list, template: dict, length: int, alphabet: str, prefix: str = ""):
+    """
+    Inserts one coupon per code in multi-row INSERTs of COUPON_BATCH_CHUNK_SIZE, inside
+    the caller's transaction. The unique index on coupons.code is the only collision
+    check; a chunk that hits an existing code has those codes replaced and is retried.
+    `codes` is updated in place so the caller returns what was actually stored. Batch
+    codes are never public, so they stay out of the best-coupon index.
+    """
+    template = {**template, "public": False}
+    generated = set(codes)
+    for start in range(0, len(codes), COUPON_BATCH_CHUNK_SIZE):
+        end = min(start + COUPON_BATCH_CHUNK_SIZE, len(codes))
+        while True:
+            try:
+                await database.execute(
+                    coupons.insert().values([{**template, "code": code} for code in codes[start:end]])
+                )
+                break
+            except IntegrityError:
+                taken = await database.fetch_all(
+                    select(coupons.c.code).where(coupons.c.code.in_(codes[start:end]))
+                )
+                taken = {row["code"] for row in taken}
+                replacements = iter(
+                    generate_coupon_codes(len(taken), length, alphabet, prefix, exclude=generated | taken)
+                )
+                for i in range(start, end):
+                    if codes[i] in taken:
+                        codes[i] = next(replacements)
+                        generated.add(codes[i])
+
+
+# =====================
+# Best coupon for a cart
+# =====================
+class _CouponIndex:
+    """
+    Currently redeemable public coupons sorted by min_order_amount, with prefix maxima of the
+    fixed and percentage discount values. For a cart total the eligible coupons are a
+    prefix found by bisection, and the best fixed and best percentage coupon of that
+    prefix are read directly, so a lookup is O(log n).
+    """
+
+    def __init__(self, rows, now: datetime):
+        self.coupons = sorted(
+            (c for c in rows if not c["start_at"] or c["start_at"] <= now),
+            key=lambda c: c["min_order_amount"] or 0,
+        )
+        self.thresholds = [c["min_order_amount"] or 0 for c in self.coupons]
+
+        self.best_fixed = []
+        self.best_percentage = []
+        best_fixed = best_percentage = -1
+        for i, c in enumerate(self.coupons):
+            if c["discount_type"] == "fixed" and (
+                best_fixed < 0 or c["discount_value"] > self.coupons[best_fixed]["discount_value"]
+            ):
+                best_fixed = i
+            if c["discount_type"] == "percentage" and (
+                best_percentage < 0 or c["discount_value"] > self.coupons[best_percentage]["discount_value"]
+            ):
+                best_percentage = i
+            self.best_fixed.append(best_fixed)
+            self.best_percentage.append(best_percentage)
+
+        # Rebuild at the TTL or when a coupon starts or ends, whichever comes first
+        ttl = COUPON_CACHE_TTL_SECONDS
+        for c in rows:
+            for boundary in (c["start_at"], c["end_at"]):
+                if boundary and boundary > now:
+                    ttl = min(ttl, (boundary - now).total_seconds())
+        self.expires_at = time.monotonic() + ttl
+
+    def candidates(self, total: float):
+        """
+        Eligible coupons for a total, best discount first. The first candidate costs
+        O(log n); the full ranking is only built if the caller asks for more.
+        """
+        eligible = bisect_right(self.thresholds, total)
+        if not eligible:
+            return
+        picks = [i for i in (self.best_fixed[eligible - 1], self.best_percentage[eligible - 1]) if i >= 0]
+        best = max(picks, key=lambda i: compute_discount(self.coupons[i], total))
+        yield self.coupons[best]
+
+        rest = sorted(
+            (c for i, c in enumerate(self.coupons[:eligible]) if i != best),
+            key=lambda c: compute_discount(c, total),
+            reverse=True,
+        )
+        yield from rest
+
+
+async def _get_coupon_index(now: datetime) -> _CouponIndex:
+    global _coupon_index
+    if _coupon_index is None or _coupon_index.expires_at <= time.monotonic():
+        rows = await database.fetch_all(
+            coupons.select()
+            .where(coupons.c.public == True)
+            .where(coupons.c.active == True)
+            .where(or_(coupons.c.end_at.is_(None), coupons.c.end_at >= now))
+            .where(
+                or_(
+                    func.coalesce(coupons.c.max_uses, 0) == 0,
+                    func.coalesce(coupons.c.used_count, 0) < coupons.c.max_uses,
+                )
+            )
+            .limit(COUPON_INDEX_MAX_SIZE + 1)
+        )
+        if len(rows) > COUPON_INDEX_MAX_SIZE:
+            # Percentage and fixed values only compare for a given cart total, so no subset is
+            # safe to drop: a truncated index would suggest the wrong coupon without saying so
+            print(
+                f"More than COUPON_INDEX_MAX_SIZE={COUPON_INDEX_MAX_SIZE} redeemable public coupons; "
+                "not suggesting any until the limit is raised or coupons are made private",
+                flush=True,
+            )
+            raise HTTPException(status_code=503, detail="Coupon suggestions are unavailable")
+        _coupon_index = _CouponIndex([dict(r) for r in rows], now)
+    return _coupon_index
+
+
+async def find_best_coupon(total: float, user_id: int, now: datetime):
+    """
+    Returns (coupon, discount_amount) for the discount-maximizing coupon the user can
+    redeem on this total, or (None, 0.0). Coupons with usage limits are confirmed
+    against the DB counters before being offered.
+    """
+    index = await _get_coupon_index(now)
+    for coupon in index.candidates(total):
+        if coupon["max_uses"] or coupon["per_user_limit"]:
+            try:
+                coupon = await validate_coupon(coupon["code"], total, user_id, now)
+            except HTTPException:
+                continue
+        return coupon, compute_discount(coupon, total)
+    return None, 0.0
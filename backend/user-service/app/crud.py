@@ -1,9 +1,15 @@
+import hashlib
+import heapq
+from itertools import islice
 from app.database import database
-from app.models import users, notifications, user_profiles  
+from app.models import users, notifications, notification_counters, user_profiles, addresses
+from sqlalchemy import func, select, and_, or_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from passlib.context import CryptContext
 from app.schemas import UserUpdate
 from datetime import datetime, timezone, timedelta
 from app.email_service import send_low_stock_email
+from app.events import publish
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -26,36 +32,121 @@ async def update_user(user_id: int, user_update: UserUpdate):
 # ======================
 # Notifications CRUD
 # ======================
-async def create_notification(user_id: int, message: str, send_email_alert: bool = False, item_title: str = None, stock: int = None):
+async def _add_unread(counts: dict):
+    # user_id -> new unread notifications, folded into the counters with one upsert
+    counts = {user_id: count for user_id, count in counts.items() if count}
+    if not counts:
+        return
+    stmt = mysql_insert(notification_counters).values(
+        [{"user_id": user_id, "unread": count} for user_id, count in sorted(counts.items())]
+    )
+    await database.execute(
+        stmt.on_duplicate_key_update(unread=notification_counters.c.unread + stmt.inserted.unread)
+    )
+
+
+async def _remove_unread(user_id: int, count: int):
+    if count:
+        await database.execute(
+            notification_counters.update()
+            .where(notification_counters.c.user_id == user_id)
+            .values(unread=func.greatest(notification_counters.c.unread - count, 0))
+        )
+
+
+async def create_notification(user_id: int, message: str, send_email_alert: bool = False, item_title: str = None, stock: int = None) -> list:
+    """Returns the rows to hand to publish_notifications after the caller's commit."""
     IST = timezone(timedelta(hours=5, minutes=30))
     now_ist = datetime.now(IST)
     now_str = now_ist.strftime("%Y-%m-%d %H:%M:%S")
     now = datetime.strptime(now_str, "%Y-%m-%d %H:%M:%S")
 
-    # Insert in DB with IST datetime naive
-    query = notifications.insert().values(
-        user_id=user_id,
-        message=message,
-        is_read=False,
-        created_at=now
-    )
-    await database.execute(query)
+    # Insert in DB with IST datetime naive; the unread counter moves with it
+    rows = await insert_notifications([{"user_id": user_id, "message": message, "created_at": now}])
 
     # Optional email alert
     if send_email_alert and item_title and stock is not None:
         owner = await database.fetch_one(users.select().where(users.c.id == user_id))
         if owner and owner["email"]:
             send_low_stock_email(owner["email"], item_title, stock)
+    return rows
+
+async def insert_notifications(rows: list) -> list:
+    """
+    Inserts unread notifications (dicts with user_id, message, created_at) with one
+    multi-row insert and bumps each user's unread counter in the same transaction.
+    Returns the rows for publish_notifications, which the caller runs once its
+    outermost transaction has committed.
+    """
+    if not rows:
+        return []
+    counts = {}
+    for row in rows:
+        counts[row["user_id"]] = counts.get(row["user_id"], 0) + 1
+    async with database.transaction():
+        await database.execute(notifications.insert().values([
+            {"user_id": row["user_id"], "message": row["message"], "is_read": False, "created_at": row["created_at"]}
+            for row in rows
+        ]))
+        await _add_unread(counts)
+    return rows
+
+def publish_notifications(rows: list):
+    """Tells the recipients' open event streams; only after the notifications are committed."""
+    for row in rows:
+        publish(row["user_id"], "notification", {"message": row["message"], "created_at": row["created_at"]})
+
+async def get_user_notifications(user_id: int, limit: int = 50, after=None, unread_only: bool = False):
+    """
+    Newest first, keyset-paginated on (created_at, id); `after` is the (created_at, id)
+    of the last row already seen. Unread and read rows are two range reads on
+    ix_notifications_user_read_created merged here, so no filesort. Returns up to
+    limit + 1 rows; the extra one only tells the caller there is another page.
+    """
+    def page(is_read: bool):
+        query = notifications.select().where(
+            (notifications.c.user_id == user_id) & (notifications.c.is_read == is_read)
+        )
+        if after is not None:
+            query = query.where(or_(
+                notifications.c.created_at < after[0],
+                and_(notifications.c.created_at == after[0], notifications.c.id < after[1]),
+            ))
+        return database.fetch_all(
+            query.order_by(notifications.c.created_at.desc(), notifications.c.id.desc()).limit(limit + 1)
+        )
+
+    unread = await page(False)
+    if unread_only:
+        return unread
+    read = await page(True)
+    merged = heapq.merge(unread, read, key=lambda row: (row["created_at"], row["id"]), reverse=True)
+    return list(islice(merged, limit + 1))
 
-async def get_user_notifications(user_id: int):
-    query = notifications.select().where(notifications.c.user_id == user_id).order_by(notifications.c.created_at.desc())
-    return await database.fetch_all(query)
+async def get_unread_count(user_id: int) -> int:
+    return await database.fetch_val(
+        select(notification_counters.c.unread).where(notification_counters.c.user_id == user_id)
+    ) or 0
 
 async def mark_notification_read(notification_id: int, user_id: int):
-    query = notifications.update().where(
-        (notifications.c.id == notification_id) & (notifications.c.user_id == user_id)
-    ).values(is_read=True)
-    await database.execute(query)
+    async with database.transaction():
+        changed = await database.execute(
+            notifications.update().where(
+                (notifications.c.id == notification_id) &
+                (notifications.c.user_id == user_id) &
+                (notifications.c.is_read == False)
+            ).values(is_read=True)
+        )
+        await _remove_unread(user_id, changed)
+
+async def mark_all_notifications_read(user_id: int):
+    async with database.transaction():
+        changed = await database.execute(
+            notifications.update().where(
+                (notifications.c.user_id == user_id) & (notifications.c.is_read == False)
+            ).values(is_read=True)
+        )
+        await _remove_unread(user_id, changed)
 
 # ======================
 # User Profile CRUD
@@ -77,4 +168,38 @@ async def create_user_profile(user_id: int, profile_data: dict):
 async def update_user_profile(user_id: int, profile_data: dict):
     query = user_profiles.update().where(user_profiles.c.user_id == user_id).values(**profile_data)
     await database.execute(query)
-    return await get_user_profile(user_id)
\ No newline at end of file
+    return await get_user_profile(user_id)
+
+
+# ======================
+# Address dedupe
+# ======================
+ADDRESS_FINGERPRINT_FIELDS = (
+    "full_name", "phone", "address_line1", "address_line2",
+    "city", "state", "postal_code", "country",
+)
+
+def address_fingerprint(address: dict) -> str:
+    """
+    Case- and whitespace-insensitive hash of an address; NULL and "" line2 are equal.
+    """
+    normalized = "\x1f".join(
+        " ".join(str(address.get(field) or "").split()).casefold()
+        for field in ADDRESS_FINGERPRINT_FIELDS
+    )
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+async def upsert_address(user_id: int, values: dict, refresh_default: bool = False) -> int:
+    """
+    Inserts the address or, if the user already has an identical one, returns its id.
+    One statement: the (user_id, fingerprint) unique key detects the duplicate and
+    LAST_INSERT_ID(id) hands back the existing row's id.
+    """
+    values = {**values, "user_id": user_id, "fingerprint": address_fingerprint(values)}
+    stmt = mysql_insert(addresses).values(**values)
+    on_duplicate = {"id": func.last_insert_id(addresses.c.id)}
+    if refresh_default:
+        on_duplicate["is_default"] = stmt.inserted.is_default
+        on_duplicate["updated_at"] = stmt.inserted.updated_at
+    return await database.execute(stmt.on_duplicate_key_update(**on_duplicate))
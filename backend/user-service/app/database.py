@@ -1,6 +1,7 @@
 import os
-from databases import Database
+from app.query_accounting import InstrumentedDatabase
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-database = Database(DATABASE_URL)
+# Counts queries per request for app.query_accounting; otherwise a plain databases.Database
+database = InstrumentedDatabase(DATABASE_URL)
@@ -127,7 +127,10 @@ CartStream Support
 
 
 
-def send_order_status_notification(to_email: str, order_id: int, status: str, tracking_number: str = None):
+def build_order_status_email(order_id: int, status: str, tracking_number: str = None):
+    """
+    Returns (subject, body) of the customer email for an order status change.
+    """
     status_lower = status.lower()
     
     # Define dynamic subject and body parts based on status
@@ -163,9 +166,91 @@ Thank you for shopping with us!
 Thanks,
 CartStream Support
 """
+    return subject, body
+
+
+def send_order_status_notification(to_email: str, order_id: int, status: str, tracking_number: str = None):
+    subject, body = build_order_status_email(order_id, status, tracking_number)
     send_email(subject, body, to_email)
 
 
+def send_order_status_notifications(notifications: list):
+    """
+    Sends a batch of order status emails over a single SMTP connection.
+    Each entry is a dict with to_email, order_id, status and tracking_number.
+    A failed message is logged and the rest of the batch still goes out.
+    """
+    if not notifications:
+        return
+    try:
+        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
+            server.starttls()
+            server.login(SMTP_USERNAME, SMTP_PASSWORD)
+            for notification in notifications:
+                subject, body = build_order_status_email(
+                    notification["order_id"], notification["status"], notification.get("tracking_number")
+                )
+                msg = MIMEMultipart()
+                msg['From'] = f"{FROM_NAME} <{FROM_EMAIL}>"
+                msg['To'] = notification["to_email"]
+                msg['Subject'] = subject
+                msg.attach(MIMEText(body, 'plain'))
+                try:
+                    server.sendmail(FROM_EMAIL, notification["to_email"], msg.as_string())
+                except Exception as e:
+                    logging.error(f"Failed to send status email for order {notification['order_id']}: {e}")
+        logging.info(f"Sent {len(notifications)} order status emails")
+    except Exception as e:
+        logging.error(f"Failed to send order status email batch: {e}")
+
+
+def build_wishlist_digest_email(lines: list):
+    subject = "Good news about items on your wishlist" if len(lines) > 1 else "An item on your wishlist has an update"
+    alerts = "\n".join(f"- {line}" for line in lines)
+    body = f"""Hi,
+
+Here is what changed on your wishlist:
+
+{alerts}
+
+Grab them before they are gone!
+
+Thanks,
+CartStream Support
+"""
+    return subject, body
+
+
+def send_wishlist_digests(digests: list):
+    """
+    Sends wishlist alert digests over a single SMTP connection. Each entry is a dict
+    with to_email and lines (one line per alert). Returns the addresses that were sent.
+    """
+    sent = []
+    if not digests:
+        return sent
+    try:
+        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
+            server.starttls()
+            server.login(SMTP_USERNAME, SMTP_PASSWORD)
+            for digest in digests:
+                subject, body = build_wishlist_digest_email(digest["lines"])
+                msg = MIMEMultipart()
+                msg['From'] = f"{FROM_NAME} <{FROM_EMAIL}>"
+                msg['To'] = digest["to_email"]
+                msg['Subject'] = subject
+                msg.attach(MIMEText(body, 'plain'))
+                try:
+                    server.sendmail(FROM_EMAIL, digest["to_email"], msg.as_string())
+                    sent.append(digest["to_email"])
+                except Exception as e:
+                    logging.error(f"Failed to send wishlist digest to {digest['to_email']}: {e}")
+        logging.info(f"Sent {len(sent)} wishlist digests")
+    except Exception as e:
+        logging.error(f"Failed to send wishlist digest batch: {e}")
+    return sent
+
+
 
 def send_delivery_confirmation(to_email: str, order_id: int):
     subject = f"Order #{order_id} Delivered"
@@ -0,0 +1,140 @@
+"""
+In-process pub/sub behind GET /events/stream (server-sent events).
+
+Writers call publish(user_id, event, data) after their change; every open stream of
+that user on this worker gets it. An idle stream is one task blocked on its own
+bounded queue. Heartbeats come from a single ticker for all streams rather than a
+timer per connection, and no database connection is held while waiting.
+"""
+import asyncio
+import json
+import os
+from typing import Optional
+
+from fastapi.encoders import jsonable_encoder
+
+# Events buffered per stream; a client that falls this far behind gets a "resync" instead
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", 100))
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", 20))
+# Open streams (tabs) allowed per user on one worker
+EVENTS_MAX_STREAMS_PER_USER = int(os.getenv("EVENTS_MAX_STREAMS_PER_USER", 10))
+# Browser reconnect delay sent with the first frame
+EVENTS_RETRY_MS = int(os.getenv("EVENTS_RETRY_MS", 5000))
+
+_HEARTBEAT = ": ping\n\n"
+_RESYNC = "event: resync\ndata: {}\n\n"
+
+
+class _Stream:
+    __slots__ = ("queue", "overflowed")
+
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self.overflowed = False
+
+    def offer(self, frame: str):
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # Drop the backlog; the client refetches once it sees the resync event
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(_RESYNC)
+
+
+class EventBroker:
+    def __init__(self):
+        self._streams = {}  # user_id -> set of _Stream
+        self.published = 0
+        self.resyncs = 0
+
+    def subscribe(self, user_id: int) -> Optional[_Stream]:
+        """A new stream for the user, or None when they already have too many open."""
+        streams = self._streams.setdefault(user_id, set())
+        if len(streams) >= EVENTS_MAX_STREAMS_PER_USER:
+            return None
+        stream = _Stream()
+        streams.add(stream)
+        return stream
+
+    def unsubscribe(self, user_id: int, stream: _Stream):
+        streams = self._streams.get(user_id)
+        if streams is not None:
+            streams.discard(stream)
+            if not streams:
+                del self._streams[user_id]
+
+    def publish(self, user_id: int, event: str, data: dict):
+        streams = self._streams.get(user_id)
+        if not streams:
+            return
+        frame = f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+        for stream in streams:
+            overflowed = stream.overflowed
+            stream.offer(frame)
+            if stream.overflowed and not overflowed:
+                self.resyncs += 1
+        self.published += 1
+
+    def connected_users(self) -> list:
+        return list(self._streams)
+
+    def heartbeat(self):
+        for streams in self._streams.values():
+            for stream in streams:
+                if stream.queue.empty():
+                    stream.offer(_HEARTBEAT)
+
+    async def stream(self, user_id: int, stream: _Stream):
+        """SSE frames for one connection; unsubscribes when the client goes away."""
+        try:
+            yield f"retry: {EVENTS_RETRY_MS}\n\n"
+            while True:
+                frame = await stream.queue.get()
+                if frame == _RESYNC:
+                    stream.overflowed = False
+                yield frame
+        finally:
+            self.unsubscribe(user_id, stream)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._streams),
+            "streams": sum(len(streams) for streams in self._streams.values()),
+            "published": self.published,
+            "resyncs": self.resyncs,
+        }
+
+
+broker = EventBroker()
+
+
+def publish(user_id: int, event: str, data: dict):
+    broker.publish(user_id, event, data)
+
+
+_heartbeat_task: Optional[asyncio.Task] = None
+
+
+async def _run_heartbeat():
+    while True:
+        await asyncio.sleep(EVENTS_HEARTBEAT_SECONDS)
+        broker.heartbeat()
+
+
+def start_event_heartbeat():
+    global _heartbeat_task
+    if _heartbeat_task is None:
+        _heartbeat_task = asyncio.create_task(_run_heartbeat())
+
+
+async def stop_event_heartbeat():
+    global _heartbeat_task
+    if _heartbeat_task is not None:
+        _heartbeat_task.cancel()
+        try:
+            await _heartbeat_task
+        except asyncio.CancelledError:
+            pass
+        _heartbeat_task = None
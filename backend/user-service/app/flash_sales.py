@@ -0,0 +1,556 @@
+"""
+Flash-sale mode. While a sale runs, each worker claims slices of the variant's stock
+(one locked ledger movement per slice) and admits orders from an in-process counter,
+so thousands of checkouts do not queue on the variant's row lock. After the sale,
+reconciliation returns every unsold unit exactly once; it waits until every live
+worker has released its slices, i.e. until no order admitted from them is still
+committing.
+
+    python -m app.flash_sales reconcile
+    python -m app.flash_sales bench --variant-id 12 --orders 2000 --concurrency 200
+"""
+import argparse
+import asyncio
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import select, func
+
+from app.analytics import record_order_sale
+from app.auth import now_ist_naive
+from app.database import database
+from app.inventory import get_stock, take_stock, add_stock
+from app.models import flash_sales, flash_sale_slices, flash_sale_orders, orders, order_items, items, product_variants
+from app.shipments import create_order_shipments, lock_orders, set_order_statuses
+
+FLASH_SALE_DEFAULT_SLICE_SIZE = int(os.getenv("FLASH_SALE_DEFAULT_SLICE_SIZE", 50))
+# How often workers reload the sale schedule and reconcile finished sales
+FLASH_SALE_REFRESH_SECONDS = float(os.getenv("FLASH_SALE_REFRESH_SECONDS", 5))
+# Orders admitted just before a sale ends may still be committing; reconcile after this
+FLASH_SALE_RECONCILE_GRACE_SECONDS = int(os.getenv("FLASH_SALE_RECONCILE_GRACE_SECONDS", 120))
+# A worker whose slices went this long without a heartbeat is dead, and so are its open transactions
+FLASH_SALE_WORKER_TIMEOUT_SECONDS = int(os.getenv("FLASH_SALE_WORKER_TIMEOUT_SECONDS", 30))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+# =====================
+# In-process counters
+# =====================
+class _FlashSaleCounters:
+    """
+    Per-variant stock admitted from in memory. Counters are plain ints touched only
+    from the event loop, so admission needs no lock; only slice claims, which go to
+    the database, are serialised per variant.
+    """
+
+    def __init__(self):
+        self._sales = {}  # variant_id -> running sale row
+        self._slices = {}  # variant_id -> [[slice_id, units left], ...]
+        self._claim_locks = {}
+        self._claimed = {}  # sale_id -> sale row, for sales this worker holds unreleased slices of
+        self._in_flight = {}  # sale_id -> admissions whose order has not committed or rolled back yet
+
+    def load(self, sales):
+        self._sales = {sale["variant_id"]: sale for sale in sales}
+        for variant_id in list(self._slices):
+            if variant_id not in self._sales:
+                # Sale over: unsold units in our slices are returned by reconciliation
+                del self._slices[variant_id]
+
+    def active_sale(self, variant_id: int, now: Optional[datetime] = None):
+        sale = self._sales.get(variant_id)
+        now = now or now_ist_naive()
+        if sale and sale["starts_at"] <= now < sale["ends_at"]:
+            return sale
+        return None
+
+    def _take_local(self, variant_id: int, quantity: int) -> list:
+        taken = []
+        for open_slice in self._slices.get(variant_id, []):
+            if quantity == 0:
+                break
+            units = min(open_slice[1], quantity)
+            if units:
+                open_slice[1] -= units
+                quantity -= units
+                taken.append((open_slice[0], units))
+        self._slices[variant_id] = [s for s in self._slices.get(variant_id, []) if s[1] > 0]
+        return taken
+
+    async def take(self, sale, quantity: int) -> list:
+        """
+        Admits `quantity` units; returns [(slice_id, units), ...]. Claims new slices
+        as the local counter runs dry and raises 400 once the stock is gone.
+        """
+        variant_id = sale["variant_id"]
+        taken = self._take_local(variant_id, quantity)
+        missing = quantity - sum(units for _, units in taken)
+        while missing:
+            lock = self._claim_locks.setdefault(variant_id, asyncio.Lock())
+            async with lock:
+                # Another order may have claimed a slice while we waited
+                if not self._slices.get(variant_id):
+                    # Admission runs before the order transaction, so the claim commits on its own
+                    claimed = await _claim_slice(sale, max(sale["slice_size"], missing))
+                    if claimed is None:
+                        self.give_back(variant_id, taken)
+                        raise HTTPException(status_code=400, detail="Sold out")
+                    self._claimed[sale["id"]] = sale
+                    self._slices.setdefault(variant_id, []).append(list(claimed))
+            more = self._take_local(variant_id, missing)
+            missing -= sum(units for _, units in more)
+            taken.extend(more)
+        return taken
+
+    def give_back(self, variant_id: int, taken: list):
+        if variant_id not in self._sales:
+            return
+        open_slices = {s[0]: s for s in self._slices.setdefault(variant_id, [])}
+        for slice_id, units in taken:
+            if slice_id in open_slices:
+                open_slices[slice_id][1] += units
+            else:
+                self._slices[variant_id].append([slice_id, units])
+
+    def enter(self, sale_id: int):
+        self._in_flight[sale_id] = self._in_flight.get(sale_id, 0) + 1
+
+    def leave(self, sale_id: int):
+        self._in_flight[sale_id] -= 1
+        if not self._in_flight[sale_id]:
+            del self._in_flight[sale_id]
+
+    def slice_states(self, now: datetime):
+        """(live, done) sale ids among the claimed ones: done once over with nothing in flight."""
+        live, done = [], []
+        for sale_id, sale in self._claimed.items():
+            if now < sale["ends_at"] or self._in_flight.get(sale_id):
+                live.append(sale_id)
+            else:
+                done.append(sale_id)
+        return live, done
+
+    def forget(self, sale_ids):
+        for sale_id in sale_ids:
+            self._claimed.pop(sale_id, None)
+
+
+_counters = _FlashSaleCounters()
+
+
+async def _claim_slice(sale, size: int):
+    """
+    Moves up to `size` units from the variant's stock into a new slice for this
+    worker. The variant is locked once per slice instead of once per order.
+    Returns (slice_id, units) or None when no stock is left.
+    """
+    async with database.transaction():
+        available = (await get_stock([sale["variant_id"]], for_update=True)).get(sale["variant_id"])
+        quantity = size if available is None else min(size, available)
+        if quantity <= 0:
+            return None
+        await take_stock({sale["variant_id"]: quantity}, "hold", f"flash:{sale['id']}")
+        now = now_ist_naive()
+        slice_id = await database.execute(
+            flash_sale_slices.insert().values(
+                flash_sale_id=sale["id"], worker_id=WORKER_ID, quantity=quantity, claimed_at=now, heartbeat_at=now
+            )
+        )
+    print(f"Claimed flash sale slice {slice_id} of {quantity} units for variant {sale['variant_id']}", flush=True)
+    return slice_id, quantity
+
+
+class FlashSaleAdmission:
+    """
+    Flash-sale units of one order, {variant_id: quantity}. Enter it before the order
+    transaction, `async with FlashSaleAdmission(quantities) as admission, database.transaction():`,
+    so slices are claimed on the request's own connection outside the order, and the
+    units go back to the counters unless `record` wrote them and the order committed. Until it exits, this
+    worker keeps its slices of the sale live, which holds off reconciliation.
+    """
+
+    def __init__(self, quantities: Optional[dict] = None):
+        self._quantities = quantities or {}
+        self._taken = {}  # variant_id -> (sale, [(slice_id, units), ...])
+        self._entered = []  # sale ids counted as in flight
+        self._recorded = False
+        self._now = now_ist_naive()
+
+    def sale_for(self, variant_id: int):
+        return _counters.active_sale(variant_id, self._now)
+
+    def settle(self, variant_id: int, quantity: int):
+        """
+        Keeps only `quantity` of the units admitted for a variant (fewer when some
+        were already covered by the payment's stock holds) and returns the rest.
+        """
+        sale, taken = self._taken.get(variant_id, (None, []))
+        kept, extra = [], []
+        for slice_id, units in taken:
+            keep = min(units, quantity)
+            quantity -= keep
+            if keep:
+                kept.append((slice_id, keep))
+            if units > keep:
+                extra.append((slice_id, units - keep))
+        if quantity:
+            raise HTTPException(status_code=400, detail="Sold out")
+        if extra:
+            _counters.give_back(variant_id, extra)
+            self._taken[variant_id] = (sale, kept)
+
+    async def record(self, order_id: int):
+        """Writes the order's flash-sale units; call inside the order transaction."""
+        rows = [
+            {"flash_sale_id": sale["id"], "order_id": order_id, "slice_id": slice_id, "quantity": units}
+            for sale, taken in self._taken.values()
+            for slice_id, units in taken
+        ]
+        if rows:
+            await database.execute(flash_sale_orders.insert().values(rows))
+        self._recorded = True
+
+    def _release(self, give_back: bool):
+        if give_back:
+            for variant_id, (sale, taken) in self._taken.items():
+                _counters.give_back(variant_id, taken)
+        for sale_id in self._entered:
+            _counters.leave(sale_id)
+        self._entered = []
+
+    async def __aenter__(self):
+        sales = {}
+        for variant_id, quantity in sorted(self._quantities.items()):
+            sale = self.sale_for(variant_id)
+            if sale is not None and quantity > 0:
+                sales[variant_id] = sale
+                # Counted before the first await, so a heartbeat cannot release the slices in between
+                _counters.enter(sale["id"])
+                self._entered.append(sale["id"])
+        try:
+            for variant_id, sale in sales.items():
+                self._taken[variant_id] = (sale, await _counters.take(sale, self._quantities[variant_id]))
+        except BaseException:
+            self._release(give_back=True)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Units stay sold only when an order recorded them and committed; an early return
+        # (an idempotent replay) or a rollback hands them back
+        self._release(give_back=exc_type is not None or not self._recorded)
+        return False
+
+
+# =====================
+# Schedule and reconciliation
+# =====================
+async def create_flash_sale(variant_id: int, starts_at: datetime, ends_at: datetime, slice_size: Optional[int] = None) -> int:
+    return await database.execute(
+        flash_sales.insert().values(
+            variant_id=variant_id,
+            starts_at=starts_at,
+            ends_at=ends_at,
+            slice_size=slice_size or FLASH_SALE_DEFAULT_SLICE_SIZE,
+            status="scheduled",
+            created_at=now_ist_naive(),
+        )
+    )
+
+
+async def get_flash_sale_summary(sale_id: int) -> Optional[dict]:
+    sale = await database.fetch_one(flash_sales.select().where(flash_sales.c.id == sale_id))
+    if not sale:
+        return None
+    allocated = await database.fetch_val(
+        select(func.coalesce(func.sum(flash_sale_slices.c.quantity), 0)).where(flash_sale_slices.c.flash_sale_id == sale_id)
+    )
+    sold = await database.fetch_val(
+        select(func.coalesce(func.sum(flash_sale_orders.c.quantity), 0)).where(flash_sale_orders.c.flash_sale_id == sale_id)
+    )
+    return {**dict(sale), "units_allocated": int(allocated), "units_sold": int(sold)}
+
+
+async def reconcile_flash_sale(sale_id: int, force: bool = False) -> Optional[int]:
+    """
+    Returns a finished sale's unsold units to stock: everything claimed into slices
+    minus what orders recorded. Runs once per sale (the sale row is locked and marked
+    reconciled), so units are never returned twice. Returns the units released, or
+    None if the sale is not ready.
+    """
+    async with database.transaction():
+        sale = await database.fetch_one(
+            flash_sales.select().where(flash_sales.c.id == sale_id).with_for_update()
+        )
+        now = now_ist_naive()
+        if not sale or sale["status"] == "reconciled":
+            return None
+        if not force and now < sale["ends_at"] + timedelta(seconds=FLASH_SALE_RECONCILE_GRACE_SECONDS):
+            return None
+        # A live worker may still be committing orders from its slices, however long that takes
+        held = await database.fetch_val(
+            select(func.count())
+            .select_from(flash_sale_slices)
+            .where(flash_sale_slices.c.flash_sale_id == sale_id)
+            .where(flash_sale_slices.c.released_at.is_(None))
+            .where(flash_sale_slices.c.heartbeat_at >= now - timedelta(seconds=FLASH_SALE_WORKER_TIMEOUT_SECONDS))
+        )
+        if held:
+            return None
+
+        allocated = int(await database.fetch_val(
+            select(func.coalesce(func.sum(flash_sale_slices.c.quantity), 0)).where(flash_sale_slices.c.flash_sale_id == sale_id)
+        ))
+        sold = int(await database.fetch_val(
+            select(func.coalesce(func.sum(flash_sale_orders.c.quantity), 0)).where(flash_sale_orders.c.flash_sale_id == sale_id)
+        ))
+        if sold > allocated:
+            # Cannot happen while admission only draws from claimed slices; leave the sale for a human
+            print(f"Flash sale {sale_id} sold {sold} units but only {allocated} were allocated", flush=True)
+            return None
+
+        await add_stock({sale["variant_id"]: allocated - sold}, "release", f"flash:{sale_id}")
+        await database.execute(
+            flash_sales.update()
+            .where(flash_sales.c.id == sale_id)
+            .values(status="reconciled", units_released=allocated - sold, reconciled_at=now)
+        )
+    print(f"Reconciled flash sale {sale_id}: {sold}/{allocated} sold, {allocated - sold} returned", flush=True)
+    return allocated - sold
+
+
+async def reconcile_finished_sales(force: bool = False) -> int:
+    cutoff = now_ist_naive() - timedelta(seconds=0 if force else FLASH_SALE_RECONCILE_GRACE_SECONDS)
+    rows = await database.fetch_all(
+        select(flash_sales.c.id)
+        .where(flash_sales.c.status == "scheduled")
+        .where(flash_sales.c.ends_at <= cutoff)
+    )
+    reconciled = 0
+    for row in rows:
+        if await reconcile_flash_sale(row["id"], force=force) is not None:
+            reconciled += 1
+    return reconciled
+
+
+async def refresh_flash_sales():
+    now = now_ist_naive()
+    sales = await database.fetch_all(
+        flash_sales.select()
+        .where(flash_sales.c.status == "scheduled")
+        .where(flash_sales.c.ends_at > now)
+        .where(flash_sales.c.starts_at <= now + timedelta(seconds=FLASH_SALE_REFRESH_SECONDS))
+    )
+    _counters.load([dict(sale) for sale in sales])
+
+
+async def heartbeat_slices():
+    """
+    Marks this worker's slices live while their sale runs or orders admitted from
+    them are still open, and released once neither holds, after which
+    reconciliation may count them.
+    """
+    now = now_ist_naive()
+    live, done = _counters.slice_states(now)
+    mine = (flash_sale_slices.c.worker_id == WORKER_ID) & flash_sale_slices.c.released_at.is_(None)
+    if live:
+        await database.execute(
+            flash_sale_slices.update().where(mine & flash_sale_slices.c.flash_sale_id.in_(live)).values(heartbeat_at=now)
+        )
+    if done:
+        await database.execute(
+            flash_sale_slices.update().where(mine & flash_sale_slices.c.flash_sale_id.in_(done)).values(released_at=now)
+        )
+        _counters.forget(done)
+
+
+_worker_task: Optional[asyncio.Task] = None
+
+
+async def _run_flash_sale_worker():
+    while True:
+        try:
+            await refresh_flash_sales()
+            await heartbeat_slices()
+            await reconcile_finished_sales()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Flash sale worker error: {e}", flush=True)
+        await asyncio.sleep(FLASH_SALE_REFRESH_SECONDS)
+
+
+def start_flash_sale_worker():
+    global _worker_task
+    if _worker_task is None:
+        _worker_task = asyncio.create_task(_run_flash_sale_worker())
+
+
+async def stop_flash_sale_worker():
+    global _worker_task
+    if _worker_task is not None:
+        _worker_task.cancel()
+        try:
+            await _worker_task
+        except asyncio.CancelledError:
+            pass
+        _worker_task = None
+
+
+# =====================
+# Contention benchmark
+# =====================
+def _percentile(latencies, p):
+    return latencies[max(0, int(len(latencies) * p / 100) - 1)] * 1000
+
+
+async def _bench(label: str, checkout, orders: int, concurrency: int):
+    queue = asyncio.Queue()
+    for _ in range(orders):
+        queue.put_nowait(None)
+    latencies, failures = [], 0
+
+    async def runner():
+        nonlocal failures
+        while not queue.empty():
+            queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                await checkout()
+            except HTTPException:
+                failures += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(runner() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(
+        f"{label}: {orders} checkouts in {elapsed:.2f}s = {orders / elapsed:.0f}/s, "
+        f"p50 {_percentile(latencies, 50):.1f} ms, p99 {_percentile(latencies, 99):.1f} ms, "
+        f"{failures} rejected",
+        flush=True,
+    )
+    return orders - failures
+
+
+async def _bench_order(variant, order_ids: list, admission: Optional[FlashSaleAdmission] = None):
+    """
+    The writes of a one-unit create_order in the same sequence: the order, its stock
+    (a ledger take, or the admitted flash-sale units), the line, the sales rollups and
+    the shipment. Call inside a transaction.
+    """
+    now = now_ist_naive()
+    price = variant["price"] or 0
+    order_id = await database.execute(
+        orders.insert().values(customer_id=variant["owner_id"], status="pending", total_price=price, order_date=now)
+    )
+    order_ids.append(order_id)
+    if admission is None:
+        await take_stock({variant["id"]: 1}, "sale", f"order:{order_id}")
+    else:
+        admission.settle(variant["id"], 1)
+        await admission.record(order_id)
+    await database.execute(
+        order_items.insert().values(
+            order_id=order_id, item_id=variant["item_id"], variant_id=variant["id"], quantity=1, line_total_price=price
+        )
+    )
+    await record_order_sale(now, [(variant["owner_id"], variant["item_id"], variant["id"], 1, price)])
+    await create_order_shipments(order_id, variant["owner_id"], now, {variant["owner_id"]: price})
+
+
+async def _drop_bench_orders(order_ids: list):
+    # Cancelling puts the units back and takes the orders out of the rollups; then the rows go
+    for start in range(0, len(order_ids), 500):
+        batch = order_ids[start:start + 500]
+        async with database.transaction():
+            await set_order_statuses(await lock_orders(batch), "cancelled")
+            await database.execute(order_items.delete().where(order_items.c.order_id.in_(batch)))
+            await database.execute(orders.delete().where(orders.c.id.in_(batch)))
+    order_ids.clear()
+
+
+async def run_benchmark(variant_id: int, orders: int, concurrency: int, slice_size: int):
+    """
+    Single-unit checkouts against one variant: first with a locked ledger take per
+    order (the regular path), then admitted through a flash sale. Each checkout is
+    its own transaction with the writes of a real order, placed by the item's owner.
+    The orders are cancelled and deleted afterwards, which puts every unit back, so
+    run it against a development database.
+    """
+    variant = await database.fetch_one(
+        select(product_variants.c.id, product_variants.c.item_id, product_variants.c.price, items.c.owner_id)
+        .select_from(product_variants.join(items, items.c.id == product_variants.c.item_id))
+        .where(product_variants.c.id == variant_id)
+    )
+    if not variant:
+        print(f"Variant {variant_id} not found", flush=True)
+        return
+    order_ids = []
+
+    async def locked_checkout():
+        async with database.transaction():
+            await _bench_order(variant, order_ids)
+
+    try:
+        await _bench("row-locked", locked_checkout, orders, concurrency)
+    finally:
+        await _drop_bench_orders(order_ids)
+
+    now = now_ist_naive()
+    sale_id = await create_flash_sale(variant_id, now, now + timedelta(hours=1), slice_size)
+    _counters.load([dict(await database.fetch_one(flash_sales.select().where(flash_sales.c.id == sale_id)))])
+
+    async def flash_checkout():
+        async with FlashSaleAdmission({variant_id: 1}) as admission, database.transaction():
+            await _bench_order(variant, order_ids, admission)
+
+    try:
+        await _bench(f"flash sale (slices of {slice_size})", flash_checkout, orders, concurrency)
+    finally:
+        # Reconciliation returns the unsold units; cancelling the orders returns the sold ones
+        _counters.load([])
+        ended = now_ist_naive()
+        await database.execute(flash_sales.update().where(flash_sales.c.id == sale_id).values(ends_at=ended))
+        _counters.forget([sale_id])
+        await database.execute(
+            flash_sale_slices.update()
+            .where((flash_sale_slices.c.flash_sale_id == sale_id) & (flash_sale_slices.c.worker_id == WORKER_ID))
+            .values(released_at=ended)
+        )
+        await reconcile_flash_sale(sale_id, force=True)
+        await _drop_bench_orders(order_ids)
+
+
+async def _main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.flash_sales")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    reconcile = subcommands.add_parser("reconcile", help="return unsold units of finished sales to stock")
+    reconcile.add_argument("--force", action="store_true", help="skip the grace period after the sale ends")
+    bench = subcommands.add_parser("bench", help="compare row-locked and flash-sale checkouts on one variant")
+    bench.add_argument("--variant-id", type=int, required=True)
+    bench.add_argument("--orders", type=int, default=2000)
+    bench.add_argument("--concurrency", type=int, default=200)
+    bench.add_argument("--slice-size", type=int, default=FLASH_SALE_DEFAULT_SLICE_SIZE)
+    args = parser.parse_args(argv)
+
+    await database.connect()
+    try:
+        if args.command == "reconcile":
+            reconciled = await reconcile_finished_sales(force=args.force)
+            print(f"Reconciled {reconciled} flash sales", flush=True)
+        else:
+            await run_benchmark(args.variant_id, args.orders, args.concurrency, args.slice_size)
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
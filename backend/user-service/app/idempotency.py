@@ -0,0 +1,116 @@
+import json
+import os
+from datetime import timedelta
+from typing import Optional
+
+from fastapi import HTTPException
+from pymysql.err import IntegrityError
+
+from app.auth import now_ist_naive
+from app.database import database
+from app.models import idempotency_keys
+
+# How long a stored response is replayed before the key may be reused
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", 24))
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+
+
+def validate_idempotency_key(key: Optional[str]) -> Optional[str]:
+    """
+    Normalizes the Idempotency-Key header; returns None when the client sent none.
+    """
+    if key is None:
+        return None
+    key = key.strip()
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Idempotency-Key must be 1-{IDEMPOTENCY_KEY_MAX_LENGTH} characters",
+        )
+    return key
+
+
+async def get_stored_response(customer_id: int, key: str) -> Optional[dict]:
+    """
+    Fast replay path: one lookup on the (customer_id, idempotency_key) unique index.
+    Returns the stored response of a completed, unexpired request, else None.
+    """
+    row = await database.fetch_one(
+        idempotency_keys.select().where(
+            (idempotency_keys.c.customer_id == customer_id)
+            & (idempotency_keys.c.idempotency_key == key)
+            & (idempotency_keys.c.expires_at > now_ist_naive())
+        )
+    )
+    if row and row["response_body"] is not None:
+        return json.loads(row["response_body"])
+    return None
+
+
+async def claim_idempotency_key(customer_id: int, key: str) -> Optional[dict]:
+    """
+    Must run inside the caller's transaction. Inserts the key row so that a concurrent
+    request with the same key blocks on the unique index until this transaction ends.
+    Returns None when the claim succeeded (caller proceeds), or the stored response
+    when another request already completed with this key.
+    """
+    now = now_ist_naive()
+
+    # An expired key may be reused for a new request
+    await database.execute(
+        idempotency_keys.delete().where(
+            (idempotency_keys.c.customer_id == customer_id)
+            & (idempotency_keys.c.idempotency_key == key)
+            & (idempotency_keys.c.expires_at <= now)
+        )
+    )
+
+    try:
+        await database.execute(
+            idempotency_keys.insert().values(
+                customer_id=customer_id,
+                idempotency_key=key,
+                created_at=now,
+                expires_at=now + timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS),
+            )
+        )
+        return None
+    except IntegrityError:
+        # The first request committed while we waited; locking read sees its row
+        row = await database.fetch_one(
+            idempotency_keys.select()
+            .where(
+                (idempotency_keys.c.customer_id == customer_id)
+                & (idempotency_keys.c.idempotency_key == key)
+            )
+            .with_for_update()
+        )
+        if row and row["response_body"] is not None:
+            return json.loads(row["response_body"])
+        raise HTTPException(
+            status_code=409,
+            detail="A request with this Idempotency-Key is already being processed",
+        )
+
+
+async def store_response(customer_id: int, key: str, order_id: int, response: dict):
+    """
+    Records the response for a claimed key; runs in the same transaction as the claim.
+    """
+    await database.execute(
+        idempotency_keys.update()
+        .where(
+            (idempotency_keys.c.customer_id == customer_id)
+            & (idempotency_keys.c.idempotency_key == key)
+        )
+        .values(order_id=order_id, response_body=json.dumps(response))
+    )
+
+
+async def purge_expired_idempotency_keys():
+    """
+    Deletes expired keys using the expires_at index.
+    """
+    await database.execute(
+        idempotency_keys.delete().where(idempotency_keys.c.expires_at <= now_ist_naive())
+    )
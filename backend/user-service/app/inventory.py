@@ -0,0 +1,342 @@
+"""
+Inventory ledger. Every stock change is an inventory_movements row; product_variants.stock
+is only a snapshot that the compactor advances, and live stock is the snapshot plus the
+movements after stock_ledger_id.
+
+    python -m app.inventory compact    # fold pending movements into the snapshots now
+"""
+import argparse
+import asyncio
+import os
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import select, func, case, cast, exists, and_, Integer
+
+from app.auth import now_ist_naive
+from app.database import database
+from app.models import product_variants, inventory_movements, wishlist_alert_events
+
+MOVEMENT_REASONS = ("sale", "restock", "adjustment", "cancellation", "hold", "release")
+
+INVENTORY_COMPACT_SECONDS = float(os.getenv("INVENTORY_COMPACT_SECONDS", 30))
+INVENTORY_COMPACT_BATCH_SIZE = int(os.getenv("INVENTORY_COMPACT_BATCH_SIZE", 500))
+
+
+# =====================
+# Reads
+# =====================
+def live_stock_sql(alias: str = "pv") -> str:
+    """
+    Live stock of the product_variants row `alias`, for raw SQL. The subquery is a
+    short range scan on ix_inventory_movements_variant_id (variant_id, id), bounded
+    by what arrived since the last compaction.
+    """
+    return (
+        f"CAST({alias}.stock + COALESCE((SELECT SUM(m.delta) FROM inventory_movements m "
+        f"WHERE m.variant_id = {alias}.id AND m.id > {alias}.stock_ledger_id), 0) AS SIGNED)"
+    )
+
+
+def live_stock_column():
+    pending = (
+        select(func.sum(inventory_movements.c.delta))
+        .where(inventory_movements.c.variant_id == product_variants.c.id)
+        .where(inventory_movements.c.id > product_variants.c.stock_ledger_id)
+        .scalar_subquery()
+    )
+    return cast(product_variants.c.stock + func.coalesce(pending, 0), Integer).label("stock")
+
+
+def select_variants():
+    """SELECT of product_variants with `stock` replaced by live stock."""
+    columns = [column for column in product_variants.c if column.name != "stock"]
+    return select(*columns, live_stock_column())
+
+
+async def _lock_variants(variant_ids, share: bool = False):
+    # Every ledger writer locks its variant rows first, so the compactor (exclusive) never
+    # folds past a movement that is still uncommitted. Takers need exclusive locks for the
+    # availability check; restocks only take shared ones and do not block each other.
+    await database.fetch_all(
+        select(product_variants.c.id)
+        .where(product_variants.c.id.in_(sorted(variant_ids)))
+        .order_by(product_variants.c.id)
+        .with_for_update(read=share)
+    )
+
+
+async def _locked_stock(variant_ids) -> dict:
+    """
+    Locks the variants exclusively and reads their live stock with locking reads only.
+    Under REPEATABLE READ a plain SELECT sees the transaction's snapshot, which can
+    predate movements committed while this transaction waited for the locks; a locking
+    read sees the latest committed rows. No movement of these variants can be
+    uncommitted once the locks are held, because every ledger writer locks its
+    variants first.
+    """
+    variants = await database.fetch_all(
+        select(product_variants.c.id, product_variants.c.stock)
+        .where(product_variants.c.id.in_(sorted(variant_ids)))
+        .order_by(product_variants.c.id)
+        .with_for_update()
+    )
+    pending = await database.fetch_all(
+        select(inventory_movements.c.variant_id, func.sum(inventory_movements.c.delta).label("delta"))
+        .select_from(
+            inventory_movements.join(
+                product_variants,
+                and_(
+                    product_variants.c.id == inventory_movements.c.variant_id,
+                    inventory_movements.c.id > product_variants.c.stock_ledger_id,
+                ),
+            )
+        )
+        .where(inventory_movements.c.variant_id.in_(sorted(variant_ids)))
+        .group_by(inventory_movements.c.variant_id)
+        .with_for_update(read=True)
+    )
+    deltas = {row["variant_id"]: int(row["delta"]) for row in pending}
+    return {
+        variant["id"]: variant["stock"] + deltas.get(variant["id"], 0) if variant["stock"] is not None else None
+        for variant in variants
+    }
+
+
+async def get_stock(variant_ids, for_update: bool = False) -> dict:
+    """
+    Live stock per variant id (None when the variant's stock is untracked).
+    for_update locks the variants and reads the stock with locking reads; call
+    inside a transaction then.
+    """
+    variant_ids = sorted(set(variant_ids))
+    if not variant_ids:
+        return {}
+    if for_update:
+        return await _locked_stock(variant_ids)
+    rows = await database.fetch_all(
+        select(product_variants.c.id, live_stock_column()).where(product_variants.c.id.in_(variant_ids))
+    )
+    return {row["id"]: row["stock"] for row in rows}
+
+
+# =====================
+# Writes (call inside a transaction)
+# =====================
+async def _record_movements(deltas: dict, reason: str, reference: Optional[str]):
+    await _insert_movements([(variant_id, delta, reference) for variant_id, delta in sorted(deltas.items())], reason)
+
+
+async def _insert_movements(movements, reason: str):
+    now = now_ist_naive()
+    rows = [
+        {"variant_id": variant_id, "delta": delta, "reason": reason, "reference": reference, "created_at": now}
+        for variant_id, delta, reference in movements
+        if delta
+    ]
+    if rows:
+        await database.execute(inventory_movements.insert().values(rows))
+
+
+async def _record_back_in_stock(variant_ids):
+    # Outbox rows for app.wishlist_alerts; only written when a tracked level crosses zero
+    if not variant_ids:
+        return
+    now = now_ist_naive()
+    variants = await database.fetch_all(
+        select(product_variants.c.id, product_variants.c.item_id).where(product_variants.c.id.in_(sorted(variant_ids)))
+    )
+    await database.execute(wishlist_alert_events.insert().values([
+        {
+            "item_id": variant["item_id"],
+            "variant_id": variant["id"],
+            "kind": "back_in_stock",
+            "old_value": None,
+            "new_value": None,
+            "created_at": now,
+            "processed_at": None,
+        }
+        for variant in variants
+    ]))
+
+
+async def take_stock(quantities: dict, reason: str, reference: Optional[str] = None) -> dict:
+    """
+    Removes units (variant_id -> units) from stock, failing with 400 if any variant has
+    too few. The variant rows are locked for the check but not rewritten; the change
+    is a ledger row. Returns the stock left per variant.
+    """
+    quantities = {variant_id: quantity for variant_id, quantity in quantities.items() if quantity > 0}
+    levels = await get_stock(quantities, for_update=True)
+    for variant_id, quantity in sorted(quantities.items()):
+        if variant_id not in levels:
+            raise HTTPException(status_code=404, detail=f"Variant {variant_id} not found")
+        if levels[variant_id] is not None and levels[variant_id] < quantity:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Not enough stock for variant {variant_id}. Only {levels[variant_id]} available.",
+            )
+    await _record_movements({variant_id: -quantity for variant_id, quantity in quantities.items()}, reason, reference)
+    return {
+        variant_id: levels[variant_id] - quantity if levels[variant_id] is not None else None
+        for variant_id, quantity in quantities.items()
+    }
+
+
+async def add_stock(quantities: dict, reason: str, reference: Optional[str] = None):
+    """Puts units (variant_id -> units) back on the shelf: restocks, releases, cancellations."""
+    await add_stock_movements(
+        [(variant_id, quantity, reference) for variant_id, quantity in quantities.items()], reason
+    )
+
+
+async def add_stock_movements(movements, reason: str):
+    """add_stock for several references at once: (variant_id, units, reference) tuples."""
+    movements = [movement for movement in movements if movement[1] > 0]
+    if not movements:
+        return
+    added = {}
+    for variant_id, quantity, _ in movements:
+        added[variant_id] = added.get(variant_id, 0) + quantity
+    await _lock_variants(added, share=True)
+    levels = await get_stock(added)
+    await _insert_movements(sorted(movements, key=lambda movement: movement[0]), reason)
+    await _record_back_in_stock([
+        variant_id for variant_id, quantity in added.items()
+        if levels.get(variant_id) is not None and levels[variant_id] <= 0 < levels[variant_id] + quantity
+    ])
+
+
+async def set_stock(variant_id: int, stock: int, reference: Optional[str] = None):
+    """A counted stock level from the owner, recorded as an adjustment by the difference."""
+    current = (await get_stock([variant_id], for_update=True)).get(variant_id)
+    if current is None:
+        # Untracked snapshot: start counting from zero; movements taken against it no longer apply
+        last_id = await database.fetch_val(
+            select(func.max(inventory_movements.c.id)).where(inventory_movements.c.variant_id == variant_id)
+        )
+        await database.execute(
+            product_variants.update()
+            .where(product_variants.c.id == variant_id)
+            .values(stock=0, stock_ledger_id=last_id or 0)
+        )
+        current = 0
+    elif current <= 0 < stock:
+        await _record_back_in_stock([variant_id])
+    await _record_movements({variant_id: stock - current}, "adjustment", reference)
+
+
+# =====================
+# Compaction
+# =====================
+async def compact_variants(variant_ids) -> int:
+    """
+    Folds the pending movements of the given variants into their snapshots with one
+    UPDATE. Returns how many variants changed.
+    """
+    async with database.transaction():
+        await _lock_variants(variant_ids)
+        rows = await database.fetch_all(
+            select(
+                inventory_movements.c.variant_id,
+                func.sum(inventory_movements.c.delta).label("delta"),
+                func.max(inventory_movements.c.id).label("last_id"),
+            )
+            .select_from(
+                inventory_movements.join(
+                    product_variants,
+                    and_(
+                        product_variants.c.id == inventory_movements.c.variant_id,
+                        inventory_movements.c.id > product_variants.c.stock_ledger_id,
+                    ),
+                )
+            )
+            .where(inventory_movements.c.variant_id.in_(list(variant_ids)))
+            .group_by(inventory_movements.c.variant_id)
+        )
+        if not rows:
+            return 0
+        deltas = {row["variant_id"]: int(row["delta"]) for row in rows}
+        last_ids = {row["variant_id"]: row["last_id"] for row in rows}
+        await database.execute(
+            product_variants.update()
+            .where(product_variants.c.id.in_(list(deltas)))
+            .values(
+                stock=product_variants.c.stock + case(deltas, value=product_variants.c.id, else_=0),
+                stock_ledger_id=case(last_ids, value=product_variants.c.id, else_=product_variants.c.stock_ledger_id),
+            )
+        )
+    return len(rows)
+
+
+async def compact_inventory() -> int:
+    """Compacts every variant with pending movements, in id batches."""
+    compacted, after_id = 0, 0
+    while True:
+        variant_ids = [
+            row["id"]
+            for row in await database.fetch_all(
+                select(product_variants.c.id)
+                .where(product_variants.c.id > after_id)
+                .where(
+                    exists()
+                    .where(inventory_movements.c.variant_id == product_variants.c.id)
+                    .where(inventory_movements.c.id > product_variants.c.stock_ledger_id)
+                )
+                .order_by(product_variants.c.id)
+                .limit(INVENTORY_COMPACT_BATCH_SIZE)
+            )
+        ]
+        if not variant_ids:
+            return compacted
+        compacted += await compact_variants(variant_ids)
+        after_id = variant_ids[-1]
+
+
+_compactor_task: Optional[asyncio.Task] = None
+
+
+async def _run_compactor():
+    while True:
+        await asyncio.sleep(INVENTORY_COMPACT_SECONDS)
+        try:
+            await compact_inventory()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Inventory compaction error: {e}", flush=True)
+
+
+def start_inventory_compactor():
+    global _compactor_task
+    if _compactor_task is None:
+        _compactor_task = asyncio.create_task(_run_compactor())
+
+
+async def stop_inventory_compactor():
+    global _compactor_task
+    if _compactor_task is not None:
+        _compactor_task.cancel()
+        try:
+            await _compactor_task
+        except asyncio.CancelledError:
+            pass
+        _compactor_task = None
+
+
+async def _main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.inventory")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("compact", help="fold pending inventory movements into stock snapshots")
+    parser.parse_args(argv)
+
+    await database.connect()
+    try:
+        compacted = await compact_inventory()
+        print(f"Compacted stock of {compacted} variants", flush=True)
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
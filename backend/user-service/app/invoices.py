@@ -0,0 +1,298 @@
+import asyncio
+import json
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from pymysql.err import IntegrityError
+
+from app.auth import now_ist_naive
+from app.database import database
+from app.models import order_invoices
+
+# Rendered PDFs are cached here; snapshots never change, so neither do the files
+INVOICE_PDF_DIR = os.getenv("INVOICE_PDF_DIR", "invoices")
+INVOICE_PDF_WORKERS = int(os.getenv("INVOICE_PDF_WORKERS", 2))
+
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+
+INVOICE_QUERY = """
+SELECT
+    o.id as order_id,
+    o.order_date,
+    o.total_price,
+    o.coupon_code,
+    o.transaction_id,
+    o.shipping_charge,
+    u.username as customer_name,
+    u.email as customer_email,
+    up.contact_number as customer_phone,
+    a.full_name as shipping_name,
+    a.phone as shipping_phone,
+    a.address_line1,
+    a.address_line2,
+    a.city,
+    a.state,
+    a.postal_code,
+    a.country,
+    oi.quantity,
+    oi.line_total_price,
+    oi.variant_id,
+    i.title as item_title,
+    i.description,
+    pv.color as variant_color,
+    pv.size as variant_size,
+    pv.image_url as variant_image_url,
+    c.discount_type,
+    c.discount_value
+FROM orders o
+LEFT JOIN users u ON o.customer_id = u.id
+LEFT JOIN user_profiles up ON u.id = up.user_id
+LEFT JOIN addresses a ON o.shipping_address_id = a.id
+LEFT JOIN order_items oi ON o.id = oi.order_id
+LEFT JOIN items i ON oi.item_id = i.id
+LEFT JOIN product_variants pv ON oi.variant_id = pv.id
+LEFT JOIN coupons c ON o.coupon_code = c.code
+WHERE o.id = :order_id
+"""
+
+
+# =====================
+# Invoice snapshots
+# =====================
+async def build_invoice_document(
+    order_id: int,
+    discount_amount: Optional[float] = None,
+    shipping_charge: Optional[float] = None,
+) -> Optional[dict]:
+    """
+    Builds the invoice document for an order. create_order passes the discount and
+    shipping it actually charged; for older orders they are derived from the total.
+    Order status is not part of the document, it is read live when serving it.
+    """
+    rows = await database.fetch_all(INVOICE_QUERY, values={"order_id": order_id})
+    if not rows:
+        return None
+    head = rows[0]
+
+    document = {
+        "order_id": head["order_id"],
+        "order_date": head["order_date"].isoformat() if head["order_date"] else None,
+        "total_price": float(head["total_price"]),
+        "transaction_id": head["transaction_id"],
+        "customer": {
+            "name": head["customer_name"],
+            "email": head["customer_email"],
+            "phone": head["customer_phone"],
+        },
+        "shipping_address": {
+            "full_name": head["shipping_name"],
+            "phone": head["shipping_phone"],
+            "address_line1": head["address_line1"],
+            "address_line2": head["address_line2"] or "",
+            "city": head["city"],
+            "state": head["state"],
+            "postal_code": head["postal_code"],
+            "country": head["country"],
+        },
+        "items": [],
+        "coupon": None,
+        "subtotal": 0.0,
+        "discount_amount": 0.0,
+        "shipping_charge": 0.0,
+    }
+
+    subtotal = 0.0
+    for row in rows:
+        if not row["item_title"]:
+            continue
+        item_title = row["item_title"]
+        variant_info = [v for v in (row["variant_color"], row["variant_size"]) if v]
+        if variant_info:
+            item_title += f" ({', '.join(variant_info)})"
+
+        # The line total is what was charged; the variant's current price may have changed since
+        line_total = float(row["line_total_price"])
+        subtotal += line_total
+        document["items"].append({
+            "item_title": item_title,
+            "description": row["description"],
+            "image_url": row["variant_image_url"],
+            "unit_price": line_total / row["quantity"] if row["quantity"] else line_total,
+            "quantity": row["quantity"],
+            "line_total_price": line_total,
+            "variant_id": row["variant_id"],
+            "variant_color": row["variant_color"],
+            "variant_size": row["variant_size"],
+        })
+    document["subtotal"] = subtotal
+
+    if head["coupon_code"]:
+        document["coupon"] = {
+            "code": head["coupon_code"],
+            "discount_type": head["discount_type"],
+            "discount_value": float(head["discount_value"]) if head["discount_value"] is not None else None,
+        }
+        if discount_amount is None and head["discount_value"] is not None:
+            if head["discount_type"] == "percentage":
+                discount_amount = subtotal * (float(head["discount_value"]) / 100)
+            else:
+                discount_amount = float(head["discount_value"])
+    document["discount_amount"] = discount_amount or 0.0
+
+    if shipping_charge is None:
+        shipping_charge = head["shipping_charge"]
+    if shipping_charge is None:
+        # Orders from before shipping was stored: whatever the total holds beyond items and discount
+        shipping_charge = max(0.0, document["total_price"] - (subtotal - document["discount_amount"]))
+    document["shipping_charge"] = float(shipping_charge)
+
+    return document
+
+
+async def snapshot_invoice(
+    order_id: int,
+    discount_amount: Optional[float] = None,
+    shipping_charge: Optional[float] = None,
+) -> Optional[dict]:
+    """
+    Builds and stores the invoice document once. If another request stored it first,
+    that copy wins and is returned.
+    """
+    document = await build_invoice_document(order_id, discount_amount, shipping_charge)
+    if document is None:
+        return None
+    try:
+        await database.execute(
+            order_invoices.insert().values(
+                order_id=order_id,
+                document=json.dumps(document, separators=(",", ":")),
+                created_at=now_ist_naive(),
+            )
+        )
+    except IntegrityError:
+        row = await database.fetch_one(order_invoices.select().where(order_invoices.c.order_id == order_id))
+        return json.loads(row["document"])
+    return document
+
+
+# =====================
+# PDF rendering
+# =====================
+def _pdf_text(value) -> str:
+    text = str(value if value is not None else "").replace("₹", "Rs. ")
+    text = text.encode("latin-1", "replace").decode("latin-1")
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _invoice_lines(document: dict) -> list:
+    address = document["shipping_address"]
+    customer = document["customer"]
+    lines = [
+        (16, f"Invoice #{document['order_id']}"),
+        (10, f"Order date: {(document['order_date'] or '').replace('T', ' ')}"),
+    ]
+    if document.get("transaction_id"):
+        lines.append((10, f"Transaction: {document['transaction_id']}"))
+    lines += [
+        (10, ""),
+        (12, "Billed to"),
+        (10, f"{customer['name'] or ''}  {customer['email'] or ''}  {customer['phone'] or ''}"),
+        (10, ""),
+        (12, "Ship to"),
+        (10, address["full_name"] or ""),
+        (10, " ".join(p for p in (address["address_line1"], address["address_line2"]) if p)),
+        (10, ", ".join(p for p in (address["city"], address["state"], address["postal_code"], address["country"]) if p)),
+        (10, f"Phone: {address['phone'] or ''}"),
+        (10, ""),
+        (12, "Items"),
+    ]
+    for item in document["items"]:
+        lines.append((10, f"{item['item_title']}  x {item['quantity']}  @ Rs. {item['unit_price']:.2f}  = Rs. {item['line_total_price']:.2f}"))
+    lines += [
+        (10, ""),
+        (10, f"Subtotal: Rs. {document['subtotal']:.2f}"),
+    ]
+    if document.get("coupon"):
+        lines.append((10, f"Discount ({document['coupon']['code']}): -Rs. {document['discount_amount']:.2f}"))
+    lines += [
+        (10, f"Shipping: Rs. {document['shipping_charge']:.2f}"),
+        (12, f"Total: Rs. {document['total_price']:.2f}"),
+    ]
+    return lines
+
+
+def render_invoice_pdf(document: dict) -> bytes:
+    """
+    Renders an invoice document as a plain-text A4 PDF. Pure function of the
+    document so it can run in a worker process.
+    """
+    lines = _invoice_lines(document)
+    per_page = 50
+    pages = [lines[i:i + per_page] for i in range(0, len(lines), per_page)] or [[]]
+
+    # Object numbers: 1 catalog, 2 page tree, 3 font, then a (page, content) pair per page
+    objects = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    }
+    kids = []
+    for n, page_lines in enumerate(pages):
+        page_obj, content_obj = 4 + 2 * n, 5 + 2 * n
+        kids.append(f"{page_obj} 0 R")
+        ops = ["BT", "50 800 Td"]
+        for size, text in page_lines:
+            ops.append(f"/F1 {size} Tf ({_pdf_text(text)}) Tj 0 -{size + 4} Td")
+        ops.append("ET")
+        stream = "\n".join(ops).encode("latin-1")
+        objects[page_obj] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_obj} 0 R >>"
+        ).encode("latin-1")
+        objects[content_obj] = b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(pages)} >>".encode("latin-1")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number in range(1, len(objects) + 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, objects[number])
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    if _pdf_pool is None:
+        _pdf_pool = ProcessPoolExecutor(max_workers=INVOICE_PDF_WORKERS)
+    return _pdf_pool
+
+
+def shutdown_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+
+
+async def get_invoice_pdf_path(document: dict) -> str:
+    """
+    Returns the cached PDF for an invoice, rendering it in the process pool on first use.
+    """
+    path = os.path.join(INVOICE_PDF_DIR, f"invoice_{document['order_id']}.pdf")
+    if os.path.exists(path):
+        return path
+
+    pdf = await asyncio.get_running_loop().run_in_executor(_get_pdf_pool(), render_invoice_pdf, document)
+    os.makedirs(INVOICE_PDF_DIR, exist_ok=True)
+    # Write then rename so a concurrent request never serves a half-written file
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(pdf)
+    os.replace(tmp_path, path)
+    return path
@@ -15,7 +15,26 @@ from app.routes import coupons as coupons_routes
 from app.routes import addresses as addresses_routes
 from app.routes import categories as categories_routes
 from app.routes import item_attributes as item_attributes_routes
+from app.routes import shipping as shipping_routes
+from app.routes import analytics as analytics_routes
+from app.routes import payments as payments_routes
+from app.routes import flash_sales as flash_sales_routes
+from app.routes import events as events_routes
+from app.routes import metrics as metrics_routes
 from fastapi.staticfiles import StaticFiles
+from app.idempotency import purge_expired_idempotency_keys
+from app.shipping import load_rate_table
+from app.invoices import shutdown_pdf_pool
+from app.payments import start_payment_worker, stop_payment_worker
+from app.stock_holds import start_hold_scheduler, stop_hold_scheduler
+from app.inventory import start_inventory_compactor, stop_inventory_compactor
+from app.analytics import start_rollup_folder, stop_rollup_folder
+from app.flash_sales import start_flash_sale_worker, stop_flash_sale_worker
+from app.wishlist_alerts import start_wishlist_alerts, stop_wishlist_alerts
+from app.events import start_event_heartbeat, stop_event_heartbeat
+from app.notifications import start_notification_purge, stop_notification_purge
+from app.metrics import MetricsMiddleware
+from app.query_accounting import QueryAccountingMiddleware
 
 load_dotenv(dotenv_path="/app/.env")
 
@@ -35,8 +54,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],    # allow all HTTP methods like GET, POST, OPTIONS
     allow_headers=["*"],    # allow all headers
+    expose_headers=["X-Next-Cursor"],  # paging cursor of GET /notifications
 )
 
+# Per-route latency, status and size counters, served on /metrics
+app.add_middleware(MetricsMiddleware)
+# Query counts per request; logs N+1 loops and requests over DB_QUERY_BUDGET
+app.add_middleware(QueryAccountingMiddleware)
+
 # Use pymysql for sync schema creation instead of MySQLdb
 sync_db_url = DATABASE_URL.replace("+aiomysql", "+pymysql")
 engine = create_engine(sync_db_url)
@@ -55,14 +80,39 @@ app.include_router(coupons_routes.router)
 app.include_router(addresses_routes.router)
 app.include_router(categories_routes.router)
 app.include_router(item_attributes_routes.router)
+app.include_router(shipping_routes.router)
+app.include_router(analytics_routes.router)
+app.include_router(payments_routes.router)
+app.include_router(flash_sales_routes.router)
+app.include_router(events_routes.router)
+app.include_router(metrics_routes.router)
 
 
 @app.on_event("startup")
 async def startup():
+    load_rate_table()
     await database.connect()
+    await purge_expired_idempotency_keys()
+    start_payment_worker()
+    start_hold_scheduler()
+    start_inventory_compactor()
+    start_rollup_folder()
+    start_flash_sale_worker()
+    start_wishlist_alerts()
+    start_event_heartbeat()
+    start_notification_purge()
 
 @app.on_event("shutdown")
 async def shutdown():
+    shutdown_pdf_pool()
+    await stop_payment_worker()
+    await stop_hold_scheduler()
+    await stop_inventory_compactor()
+    await stop_rollup_folder()
+    await stop_flash_sale_worker()
+    await stop_wishlist_alerts()
+    await stop_event_heartbeat()
+    await stop_notification_purge()
     await database.disconnect()
 
 @app.get("/")
@@ -0,0 +1,136 @@
+"""
+Per-route request metrics in Prometheus text format.
+
+MetricsMiddleware is plain ASGI: per request it takes one clock reading at the start
+and one at the end, then bumps pre-allocated bucket counters for the matched route
+template (never the raw path, so ids do not create new series). /metrics renders
+the counters on demand.
+"""
+import time
+from bisect import bisect_left
+
+# Seconds; the last, implicit bucket is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Bytes of response body
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+_UNMATCHED = "unmatched"
+
+
+class _RouteStats:
+    __slots__ = ("latency_counts", "latency_sum", "size_counts", "size_sum", "statuses")
+
+    def __init__(self):
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.size_counts = [0] * (len(SIZE_BUCKETS) + 1)
+        self.size_sum = 0
+        self.statuses = {}  # status code -> requests
+
+    def observe(self, seconds: float, size: int, status: int):
+        self.latency_counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.latency_sum += seconds
+        self.size_counts[bisect_left(SIZE_BUCKETS, size)] += 1
+        self.size_sum += size
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+class _Exchange:
+    # What the send wrapper learns about one response
+    __slots__ = ("send", "status", "size")
+
+    def __init__(self, send):
+        self.send = send
+        self.status = 500  # unless the app gets as far as starting a response
+        self.size = 0
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.body":
+            self.size += len(message.get("body", b""))
+        elif message["type"] == "http.response.start":
+            self.status = message["status"]
+        await self.send(message)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.in_flight = 0
+        self._routes = {}  # route path template -> method -> _RouteStats
+
+    def stats_for(self, path: str, method: str) -> _RouteStats:
+        methods = self._routes.get(path)
+        if methods is None:
+            methods = self._routes[path] = {}
+        stats = methods.get(method)
+        if stats is None:
+            stats = methods[method] = _RouteStats()
+        return stats
+
+    def render(self) -> str:
+        lines = [
+            "# HELP http_requests_in_flight Requests currently being handled by this worker.",
+            "# TYPE http_requests_in_flight gauge",
+            f"http_requests_in_flight {self.in_flight}",
+            "# HELP http_request_duration_seconds Time from request start to the last response byte.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        sizes = [
+            "# HELP http_response_size_bytes Response body size.",
+            "# TYPE http_response_size_bytes histogram",
+        ]
+        statuses = [
+            "# HELP http_requests_total Completed requests by status code.",
+            "# TYPE http_requests_total counter",
+        ]
+        for path, methods in sorted(self._routes.items()):
+            for method, stats in sorted(methods.items()):
+                labels = f'method="{method}",route="{_escape(path)}"'
+                _histogram(lines, "http_request_duration_seconds", labels, LATENCY_BUCKETS, stats.latency_counts, stats.latency_sum)
+                _histogram(sizes, "http_response_size_bytes", labels, SIZE_BUCKETS, stats.size_counts, stats.size_sum)
+                for status, count in sorted(stats.statuses.items()):
+                    statuses.append(f'http_requests_total{{{labels},status="{status}"}} {count}')
+        return "\n".join(lines + sizes + statuses) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram(lines: list, name: str, labels: str, buckets, counts, total):
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    cumulative += counts[-1]
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+    lines.append(f"{name}_sum{{{labels}}} {total}")
+    lines.append(f"{name}_count{{{labels}}} {cumulative}")
+
+
+request_metrics = RequestMetrics()
+
+
+class MetricsMiddleware:
+    """Records every HTTP request into request_metrics; register with app.add_middleware."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        exchange = _Exchange(send)
+        request_metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, exchange)
+        finally:
+            request_metrics.in_flight -= 1
+            # The router stores the matched route in the scope; its path is the template
+            route = scope.get("route")
+            path = getattr(route, "path", None) or _UNMATCHED
+            request_metrics.stats_for(path, scope["method"]).observe(
+                time.perf_counter() - started, exchange.size, exchange.status
+            )
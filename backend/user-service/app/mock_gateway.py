@@ -0,0 +1,127 @@
+"""
+Local stand-in for the payment gateway; everything runs against localhost.
+
+    python -m app.mock_gateway serve [--port 8081]
+        Serves /pay/{transaction_id}: posts a signed webhook to the user service and
+        redirects the browser back to redirectUrl, like the real hosted payment page.
+
+    python -m app.mock_gateway load [--count 20000] [--concurrency 200] [--duplicates 0.1]
+        Fires signed webhooks at the user service as fast as it will take them and
+        reports throughput and latency percentiles.
+
+Both sign with PAYMENT_WEBHOOK_SECRET, so set it to the same value as the user service.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+from app.payments import sign_payload
+
+DEFAULT_WEBHOOK_URL = "http://127.0.0.1:8000/payment/phonepe/webhook"
+
+
+def _signed_request(transaction_id: str, status: str):
+    body = json.dumps({"transactionId": transaction_id, "status": status}).encode()
+    return body, {"Content-Type": "application/json", "X-VERIFY": sign_payload(body)}
+
+
+# =====================
+# Hosted payment page
+# =====================
+def create_gateway_app(webhook_url: str):
+    from fastapi import FastAPI
+    from fastapi.responses import RedirectResponse
+
+    gateway = FastAPI(title="Mock Payment Gateway")
+    client = httpx.AsyncClient(timeout=10)
+
+    @gateway.get("/pay/{transaction_id}")
+    async def pay(transaction_id: str, redirectUrl: str = "/", outcome: str = "PAYMENT_SUCCESS"):
+        body, headers = _signed_request(transaction_id, outcome)
+        response = await client.post(webhook_url, content=body, headers=headers)
+        print(f"Webhook for {transaction_id} ({outcome}) -> {response.status_code}", flush=True)
+        return RedirectResponse(redirectUrl)
+
+    @gateway.on_event("shutdown")
+    async def close_client():
+        await client.aclose()
+
+    return gateway
+
+
+# =====================
+# Webhook load test
+# =====================
+async def run_load(webhook_url: str, count: int, concurrency: int, duplicates: float):
+    # Each transaction goes PENDING -> SUCCESS; a share of deliveries are repeated as the real gateway does
+    transactions = [f"LOAD{uuid.uuid4().hex[:20].upper()}" for _ in range(max(1, count // 2))]
+    deliveries = []
+    for transaction_id in transactions:
+        deliveries.append((transaction_id, "PAYMENT_PENDING"))
+        deliveries.append((transaction_id, "PAYMENT_SUCCESS"))
+    deliveries = deliveries[:count]
+    deliveries += random.sample(deliveries, int(len(deliveries) * duplicates))
+    random.shuffle(deliveries)
+
+    queue = asyncio.Queue()
+    for delivery in deliveries:
+        queue.put_nowait(delivery)
+
+    codes = Counter()
+    latencies = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+        async def sender():
+            while not queue.empty():
+                transaction_id, status = queue.get_nowait()
+                body, headers = _signed_request(transaction_id, status)
+                started = time.perf_counter()
+                try:
+                    response = await client.post(webhook_url, content=body, headers=headers)
+                    codes[response.status_code] += 1
+                except httpx.HTTPError as e:
+                    codes[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"Sent {len(deliveries)} webhooks ({len(deliveries) - count} duplicates) in {elapsed:.2f}s "
+          f"= {len(deliveries) / elapsed:.0f}/s", flush=True)
+    print(f"Responses: {dict(codes)}", flush=True)
+    for p in (50, 90, 99):
+        print(f"p{p} latency: {latencies[int(len(latencies) * p / 100) - 1] * 1000:.1f} ms", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.mock_gateway")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    serve = subcommands.add_parser("serve", help="run the hosted payment page")
+    serve.add_argument("--port", type=int, default=8081)
+    serve.add_argument("--webhook-url", default=DEFAULT_WEBHOOK_URL)
+
+    load = subcommands.add_parser("load", help="load-test the webhook endpoint")
+    load.add_argument("--webhook-url", default=DEFAULT_WEBHOOK_URL)
+    load.add_argument("--count", type=int, default=20000)
+    load.add_argument("--concurrency", type=int, default=200)
+    load.add_argument("--duplicates", type=float, default=0.1, help="share of deliveries sent twice")
+
+    args = parser.parse_args(argv)
+    if args.command == "serve":
+        import uvicorn
+        uvicorn.run(create_gateway_app(args.webhook_url), host="127.0.0.1", port=args.port)
+    else:
+        asyncio.run(run_load(args.webhook_url, args.count, args.concurrency, args.duplicates))
+
+
+if __name__ == "__main__":
+    main()
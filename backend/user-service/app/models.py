@@ -1,6 +1,6 @@
 from datetime import datetime
 from pymysql import TIMESTAMP
-from sqlalchemy import Table, Column, Integer, String, Text, Float, ForeignKey, MetaData,Boolean, DateTime, UniqueConstraint, Date
+from sqlalchemy import Table, Column, Integer, String, Text, Float, ForeignKey, MetaData,Boolean, DateTime, UniqueConstraint, Date, Index
 from sqlalchemy.sql import expression, func
 
 metadata = MetaData()
@@ -29,8 +29,10 @@ product_variants = Table(
     Column("size", String(50), nullable=True),
     Column("color", String(50), nullable=True),
     Column("price", Float, nullable=True),  # Variant-specific price (nullable to fallback on item's price)
-    Column("stock", Integer, default=0),
+    Column("stock", Integer, default=0),  # snapshot; live stock adds inventory_movements after stock_ledger_id
     Column("image_url", String(255), nullable=True),
+    Column("weight_grams", Integer, nullable=True),  # shipping weight per unit
+    Column("stock_ledger_id", Integer, nullable=False, server_default="0"),  # last movement folded into stock
     UniqueConstraint("item_id", "size", "color", name="unique_variant"),
 )
 
@@ -115,6 +117,11 @@ orders = Table(
     Column("coupon_code", String(64), nullable=True),  # adjust length as needed
     Column("transaction_id", String(128), nullable=True, unique=True, index=True),  # add this
     Column("shipping_address_id", Integer, ForeignKey("addresses.id"), nullable=True),  # Add this
+    Column("shipping_charge", Float, nullable=True),  # quoted server-side at order time
+    Column("payment_status", String(20), nullable=True),  # set from gateway webhooks via transaction_id
+    Index("ix_orders_order_date", "order_date"),  # date-range exports
+    Index("ix_orders_status_date", "status", "order_date"),  # admin search by status
+    Index("ix_orders_customer_date", "customer_id", "order_date"),  # admin search by customer
 
 
 )
@@ -143,6 +150,7 @@ addresses = Table(
     Column("state", String(100), nullable=False),
     Column("postal_code", String(20), nullable=False),
     Column("country", String(100), nullable=False),
+    Column("fingerprint", String(64), nullable=True),  # normalized hash of the address fields, see crud.address_fingerprint
     Column(
         "is_default",
         Boolean(),
@@ -163,6 +171,7 @@ addresses = Table(
         server_default=func.now(),
         onupdate=func.now()
     ),
+    UniqueConstraint("user_id", "fingerprint", name="unique_user_address_fingerprint"),
 )
 
 wishlist = Table(
@@ -171,6 +180,7 @@ wishlist = Table(
     Column("id", Integer, primary_key=True),
     Column("customer_id", Integer, ForeignKey("users.id"), nullable=False),
     Column("item_id", Integer, ForeignKey("items.id"), nullable=False),
+    Index("ix_wishlist_item_id", "item_id"),  # alert fan-out: subscribers of an item
 )
 
 audit_logs = Table(
@@ -191,7 +201,17 @@ notifications = Table(
     Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
     Column("message", String(500), nullable=False),
     Column("is_read", Boolean, default=False),
-    Column("created_at", DateTime, default=datetime.utcnow)
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Index("ix_notifications_user_read_created", "user_id", "is_read", "created_at"),
+    Index("ix_notifications_read_created", "is_read", "created_at"),  # retention sweep
+)
+
+# Unread notifications per user, kept in step by app.crud so the badge never counts rows
+notification_counters = Table(
+    "notification_counters",
+    metadata,
+    Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+    Column("unread", Integer, nullable=False, server_default="0"),
 )
 
 # ===== Cart Table =====
@@ -223,7 +243,256 @@ coupons = Table(
     Column("min_order_amount", Float, default=0),
     Column("max_uses", Integer, default=0),  # 0 = unlimited
     Column("used_count", Integer, default=0),
+    Column("per_user_limit", Integer, default=0),  # 0 = unlimited redemptions per customer
+    # Offered by /cart/best-coupon; batch campaign codes are private to whoever received them
+    Column("public", Boolean, nullable=False, server_default=expression.true(), default=True),
     Column("created_by", Integer, ForeignKey("users.id"), nullable=True),
     Column("created_at", DateTime, default=datetime.utcnow),
     Column("updated_at", DateTime, default=datetime.utcnow, onupdate=datetime.utcnow),
-)
\ No newline at end of file
+    Index("ix_coupons_public_active", "public", "active"),
+)
+# ===== Coupon Redemptions Table =====
+coupon_redemptions = Table(
+    "coupon_redemptions",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("coupon_id", Integer, ForeignKey("coupons.id", ondelete="CASCADE"), nullable=False),
+    Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+    Column("order_id", Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=True),
+    Column("redeemed_at", DateTime, nullable=False),
+    Index("ix_coupon_redemptions_coupon_user", "coupon_id", "user_id"),
+)
+
+# ===== Idempotency Keys Table =====
+# Stores the response of a keyed POST /orders/ so client retries replay it instead of placing a second order
+idempotency_keys = Table(
+    "idempotency_keys",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("customer_id", Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+    Column("idempotency_key", String(128), nullable=False),
+    Column("order_id", Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=True),
+    Column("response_body", Text, nullable=True),  # JSON body replayed to retries, NULL while in progress
+    Column("created_at", DateTime, nullable=False),
+    Column("expires_at", DateTime, nullable=False, index=True),
+    UniqueConstraint("customer_id", "idempotency_key", name="unique_customer_idempotency_key"),
+)
+
+# ===== Order Invoices Table =====
+# Invoice document frozen at order time, so later price, coupon or address edits never change it
+order_invoices = Table(
+    "order_invoices",
+    metadata,
+    Column("order_id", Integer, ForeignKey("orders.id", ondelete="CASCADE"), primary_key=True, autoincrement=False),
+    Column("document", Text(16777215), nullable=False),  # compact JSON; MEDIUMTEXT on MySQL
+    Column("created_at", DateTime, nullable=False),
+)
+
+# ===== Sales Rollup Tables =====
+# Incrementally maintained sales totals. Each bucket holds three levels of rows:
+# owner totals (item_id=0, variant_id=0), item totals (variant_id=0) and variant rows.
+# Site-wide totals are summed from owner totals. Cancelled orders are not counted.
+sales_rollup_hourly = Table(
+    "sales_rollup_hourly",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("bucket", DateTime, nullable=False),  # order_date truncated to the hour
+    Column("owner_id", Integer, nullable=False),
+    Column("item_id", Integer, nullable=False),
+    Column("variant_id", Integer, nullable=False),
+    Column("revenue", Float, nullable=False, default=0),
+    Column("units", Integer, nullable=False, default=0),
+    Column("orders", Integer, nullable=False, default=0),
+    UniqueConstraint("owner_id", "bucket", "item_id", "variant_id", name="unique_sales_rollup_hourly"),
+)
+
+sales_rollup_daily = Table(
+    "sales_rollup_daily",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("bucket", Date, nullable=False),
+    Column("owner_id", Integer, nullable=False),
+    Column("item_id", Integer, nullable=False),
+    Column("variant_id", Integer, nullable=False),
+    Column("revenue", Float, nullable=False, default=0),
+    Column("units", Integer, nullable=False, default=0),
+    Column("orders", Integer, nullable=False, default=0),
+    UniqueConstraint("owner_id", "bucket", "item_id", "variant_id", name="unique_sales_rollup_daily"),
+)
+
+# Pending rollup changes. Checkouts and cancellations append rows here instead of
+# upserting the shared rollup rows; the folder in app.analytics merges them in batches.
+sales_rollup_deltas = Table(
+    "sales_rollup_deltas",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("bucket", DateTime, nullable=False),  # order_date truncated to the hour
+    Column("owner_id", Integer, nullable=False),
+    Column("item_id", Integer, nullable=False),
+    Column("variant_id", Integer, nullable=False),
+    Column("revenue", Float, nullable=False),
+    Column("units", Integer, nullable=False),
+    Column("orders", Integer, nullable=False),
+)
+
+# ===== Order Shipments Table =====
+# One sub-order per (order, shop owner) with its own status, so owner dashboards and
+# status updates are range scans on (owner_id, order_date) instead of joins through order_items
+order_shipments = Table(
+    "order_shipments",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("order_id", Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=False),
+    Column("owner_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("customer_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("status", String(20), nullable=False),
+    Column("order_date", DateTime, nullable=False),
+    Column("subtotal", Float, nullable=False),  # sum of this owner's line totals
+    Column("tracking_number", String(100), nullable=True),
+    Column("updated_at", DateTime, nullable=True),
+    UniqueConstraint("order_id", "owner_id", name="unique_order_shipment_owner"),
+    Index("ix_order_shipments_owner_date", "owner_id", "order_date"),
+)
+
+# ===== Payment Tables =====
+# One row per gateway payment started from /payment/phonepe/initiate
+payment_transactions = Table(
+    "payment_transactions",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("transaction_id", String(128), nullable=False, unique=True),
+    Column("customer_id", Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+    Column("merchant_order_ref", String(128), nullable=True),  # orderId sent by the client
+    Column("amount", Float, nullable=False),
+    Column("status", String(20), nullable=False),  # INITIATED, PENDING, SUCCESS, FAILED
+    Column("created_at", DateTime, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+)
+
+# Webhook ingest queue: written when a webhook is acknowledged, applied to orders by the payment worker.
+# The unique key drops redelivered webhooks for the same transaction and status.
+payment_webhook_events = Table(
+    "payment_webhook_events",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("transaction_id", String(128), nullable=False),
+    Column("status", String(20), nullable=False),
+    Column("payload", Text, nullable=True),
+    Column("received_at", DateTime, nullable=False),
+    Column("processed_at", DateTime, nullable=True),
+    UniqueConstraint("transaction_id", "status", name="unique_webhook_transaction_status"),
+    Index("ix_payment_webhook_events_processed", "processed_at", "id"),
+)
+
+# ===== Stock Holds Table =====
+# Stock taken out of product_variants.stock at payment initiation, one row per variant.
+# held -> committed when the payment succeeds, held -> released (stock restored) on
+# failure, timeout or cancellation. order_id is set once an order is placed against it.
+stock_holds = Table(
+    "stock_holds",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("transaction_id", String(128), nullable=False),
+    Column("variant_id", Integer, ForeignKey("product_variants.id", ondelete="CASCADE"), nullable=False),
+    Column("quantity", Integer, nullable=False),
+    Column("status", String(20), nullable=False),  # held, committed, released
+    Column("order_id", Integer, ForeignKey("orders.id", ondelete="SET NULL"), nullable=True),
+    Column("expires_at", DateTime, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+    UniqueConstraint("transaction_id", "variant_id", name="unique_stock_hold_variant"),
+    Index("ix_stock_holds_status_expires", "status", "expires_at"),
+    Index("ix_stock_holds_order", "order_id"),
+)
+
+# ===== Inventory Ledger Table =====
+# Append-only record of every stock change. Writers insert deltas instead of rewriting
+# product_variants.stock; the compactor in app.inventory folds them into the snapshot.
+inventory_movements = Table(
+    "inventory_movements",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("variant_id", Integer, ForeignKey("product_variants.id", ondelete="CASCADE"), nullable=False),
+    Column("delta", Integer, nullable=False),
+    Column("reason", String(20), nullable=False),  # sale, restock, adjustment, cancellation, hold, release
+    Column("reference", String(128), nullable=True),  # e.g. order:42, txn:TXN..., user:7
+    Column("created_at", DateTime, nullable=False),
+    Index("ix_inventory_movements_variant_id", "variant_id", "id"),
+)
+
+# ===== Flash Sale Tables =====
+# Opt-in mode for scheduled drops: while a sale runs, orders for the variant are admitted
+# from in-process counters fed by stock slices, instead of locking the variant per order.
+flash_sales = Table(
+    "flash_sales",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("variant_id", Integer, ForeignKey("product_variants.id", ondelete="CASCADE"), nullable=False),
+    Column("starts_at", DateTime, nullable=False),
+    Column("ends_at", DateTime, nullable=False),
+    Column("slice_size", Integer, nullable=False),  # units a worker takes from stock per claim
+    Column("status", String(20), nullable=False),  # scheduled, reconciled
+    Column("units_released", Integer, nullable=True),  # unsold units returned to stock by reconciliation
+    Column("created_at", DateTime, nullable=False),
+    Column("reconciled_at", DateTime, nullable=True),
+    Index("ix_flash_sales_status_ends", "status", "ends_at"),
+)
+
+# Stock slices claimed by workers; each claim is one ledger movement for the whole slice
+flash_sale_slices = Table(
+    "flash_sale_slices",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("flash_sale_id", Integer, ForeignKey("flash_sales.id", ondelete="CASCADE"), nullable=False),
+    Column("worker_id", String(100), nullable=False),
+    Column("quantity", Integer, nullable=False),
+    Column("claimed_at", DateTime, nullable=False),
+    Column("heartbeat_at", DateTime, nullable=True),  # refreshed by the worker while orders may still use the slice
+    Column("released_at", DateTime, nullable=True),  # set by the worker once no order can use the slice any more
+    Index("ix_flash_sale_slices_sale", "flash_sale_id"),
+)
+
+# Units each order took from a sale, written in the order's transaction; reconciliation counts these
+flash_sale_orders = Table(
+    "flash_sale_orders",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("flash_sale_id", Integer, ForeignKey("flash_sales.id", ondelete="CASCADE"), nullable=False),
+    Column("order_id", Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=False),
+    Column("slice_id", Integer, nullable=False),
+    Column("quantity", Integer, nullable=False),
+    Index("ix_flash_sale_orders_sale", "flash_sale_id"),
+)
+
+# ===== Wishlist Alert Tables =====
+# Outbox of stock/price changes worth telling wishlisters about, written in the same
+# transaction as the change; the matcher in app.wishlist_alerts drains it in batches.
+wishlist_alert_events = Table(
+    "wishlist_alert_events",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("item_id", Integer, ForeignKey("items.id", ondelete="CASCADE"), nullable=False),
+    Column("variant_id", Integer, ForeignKey("product_variants.id", ondelete="CASCADE"), nullable=False),
+    Column("kind", String(20), nullable=False),  # back_in_stock, price_drop
+    Column("old_value", Float, nullable=True),
+    Column("new_value", Float, nullable=True),
+    Column("created_at", DateTime, nullable=False),
+    Column("processed_at", DateTime, nullable=True),
+    Index("ix_wishlist_alert_events_processed", "processed_at", "id"),
+)
+
+# One row per alert sent to a customer; also the queue for the email digest
+wishlist_alerts = Table(
+    "wishlist_alerts",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+    Column("item_id", Integer, ForeignKey("items.id", ondelete="CASCADE"), nullable=False),
+    Column("variant_id", Integer, nullable=False),
+    Column("kind", String(20), nullable=False),
+    Column("message", String(500), nullable=False),
+    Column("created_at", DateTime, nullable=False),
+    Column("emailed_at", DateTime, nullable=True),
+    Index("ix_wishlist_alerts_emailed", "emailed_at", "user_id"),
+    Index("ix_wishlist_alerts_variant_kind", "variant_id", "kind", "created_at"),
+)
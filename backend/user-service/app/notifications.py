@@ -0,0 +1,160 @@
+"""
+Notification housekeeping: retention of old read notifications and admin broadcasts.
+
+    python -m app.notifications purge    # delete read notifications past retention now
+"""
+import argparse
+import asyncio
+import os
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import select, func, literal
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from app.auth import now_ist_naive
+from app.database import database
+from app.events import broker, publish
+from app.models import notifications, notification_counters, users
+
+# Read notifications older than this are deleted; unread ones are kept until read
+NOTIFICATION_RETENTION_DAYS = int(os.getenv("NOTIFICATION_RETENTION_DAYS", 90))
+NOTIFICATION_PURGE_BATCH_SIZE = int(os.getenv("NOTIFICATION_PURGE_BATCH_SIZE", 1000))
+NOTIFICATION_PURGE_SECONDS = float(os.getenv("NOTIFICATION_PURGE_SECONDS", 3600))
+# Users per INSERT ... SELECT when broadcasting
+NOTIFICATION_BROADCAST_CHUNK_SIZE = int(os.getenv("NOTIFICATION_BROADCAST_CHUNK_SIZE", 5000))
+
+
+# =====================
+# Retention
+# =====================
+async def purge_read_notifications(retention_days: int = NOTIFICATION_RETENTION_DAYS) -> int:
+    """
+    Deletes read notifications older than the retention window in short batches: each
+    batch picks its ids from ix_notifications_read_created and deletes them by primary
+    key, so row locks are held briefly and writers are not blocked. Unread counters are
+    untouched since only read rows go. Returns how many rows were deleted.
+    """
+    cutoff = now_ist_naive() - timedelta(days=retention_days)
+    deleted = 0
+    while True:
+        ids = [
+            row["id"]
+            for row in await database.fetch_all(
+                select(notifications.c.id)
+                .where(notifications.c.is_read == True)
+                .where(notifications.c.created_at < cutoff)
+                .order_by(notifications.c.created_at)
+                .limit(NOTIFICATION_PURGE_BATCH_SIZE)
+            )
+        ]
+        if not ids:
+            return deleted
+        deleted += await database.execute(notifications.delete().where(notifications.c.id.in_(ids)))
+        if len(ids) < NOTIFICATION_PURGE_BATCH_SIZE:
+            return deleted
+
+
+_purge_task: Optional[asyncio.Task] = None
+
+
+async def _run_purge():
+    while True:
+        try:
+            deleted = await purge_read_notifications()
+            if deleted:
+                print(f"Purged {deleted} read notifications", flush=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Notification purge error: {e}", flush=True)
+        await asyncio.sleep(NOTIFICATION_PURGE_SECONDS)
+
+
+def start_notification_purge():
+    global _purge_task
+    if _purge_task is None:
+        _purge_task = asyncio.create_task(_run_purge())
+
+
+async def stop_notification_purge():
+    global _purge_task
+    if _purge_task is not None:
+        _purge_task.cancel()
+        try:
+            await _purge_task
+        except asyncio.CancelledError:
+            pass
+        _purge_task = None
+
+
+# =====================
+# Broadcast
+# =====================
+async def broadcast_notification(message: str, role: Optional[str] = None) -> int:
+    """
+    Sends one notification to every user (or every user with `role`). Users are taken
+    in id ranges of NOTIFICATION_BROADCAST_CHUNK_SIZE; each range is one
+    INSERT ... SELECT into notifications plus one into the unread counters, in its own
+    transaction. Open event streams in range are told as well. Returns the recipients.
+    """
+    now = now_ist_naive()
+    recipients, after_id = 0, 0
+    while True:
+        chunk = select(users.c.id).where(users.c.id > after_id)
+        if role is not None:
+            chunk = chunk.where(users.c.role == role)
+        upto_id = await database.fetch_val(
+            chunk.order_by(users.c.id).offset(NOTIFICATION_BROADCAST_CHUNK_SIZE - 1).limit(1)
+        )
+        if upto_id is not None:
+            chunk = chunk.where(users.c.id <= upto_id)
+
+        async with database.transaction():
+            # execute() reports the first new id for INSERT ... SELECT, not the row count
+            inserted = await database.fetch_val(chunk.with_only_columns(func.count(users.c.id)))
+            if inserted:
+                await database.execute(
+                    notifications.insert().from_select(
+                        ["user_id", "message", "is_read", "created_at"],
+                        chunk.with_only_columns(users.c.id, literal(message), literal(False), literal(now)),
+                    )
+                )
+                stmt = mysql_insert(notification_counters).from_select(
+                    ["user_id", "unread"], chunk.with_only_columns(users.c.id, literal(1))
+                )
+                await database.execute(
+                    stmt.on_duplicate_key_update(unread=notification_counters.c.unread + 1)
+                )
+        recipients += inserted
+
+        connected = [
+            user_id for user_id in broker.connected_users()
+            if user_id > after_id and (upto_id is None or user_id <= upto_id)
+        ]
+        if connected and inserted:
+            for row in await database.fetch_all(chunk.where(users.c.id.in_(connected))):
+                publish(row["id"], "notification", {"message": message, "created_at": now})
+
+        if upto_id is None:
+            return recipients
+        after_id = upto_id
+
+
+async def _main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.notifications")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    purge = subcommands.add_parser("purge", help="delete read notifications past the retention window")
+    purge.add_argument("--days", type=int, default=NOTIFICATION_RETENTION_DAYS)
+    args = parser.parse_args(argv)
+
+    await database.connect()
+    try:
+        deleted = await purge_read_notifications(args.days)
+        print(f"Deleted {deleted} read notifications older than {args.days} days", flush=True)
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
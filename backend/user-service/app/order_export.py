@@ -0,0 +1,151 @@
+import csv
+import io
+import json
+import os
+import zlib
+from datetime import datetime
+from typing import Optional
+
+import aiomysql
+
+from app.database import database
+
+# Rows fetched from the server-side cursor per round trip; memory use is bounded by this
+ORDER_EXPORT_BATCH_SIZE = int(os.getenv("ORDER_EXPORT_BATCH_SIZE", 1000))
+
+ORDER_FIELDS = [
+    "order_id", "order_date", "status", "customer_id", "customer_username", "customer_email",
+    "coupon_code", "transaction_id", "order_total", "shipping_charge",
+]
+LINE_FIELDS = [
+    "order_item_id", "shop_owner_id", "shop_owner_name", "item_id", "item_title",
+    "variant_id", "variant_color", "variant_size", "quantity", "unit_price", "line_total_price",
+]
+CSV_COLUMNS = ORDER_FIELDS + LINE_FIELDS
+
+# One row per order line, in order so NDJSON can group lines without buffering
+_EXPORT_QUERY = """
+    SELECT
+        o.id AS order_id, o.order_date, {status} AS status,
+        o.customer_id, c.username AS customer_username, c.email AS customer_email,
+        o.coupon_code, o.transaction_id, o.total_price AS order_total, o.shipping_charge,
+        oi.id AS order_item_id, i.owner_id AS shop_owner_id, owner.username AS shop_owner_name,
+        oi.item_id, i.title AS item_title,
+        oi.variant_id, pv.color AS variant_color, pv.size AS variant_size,
+        oi.quantity, oi.line_total_price
+    FROM orders o
+    {shipment_join}
+    JOIN order_items oi ON oi.order_id = o.id
+    JOIN items i ON i.id = oi.item_id
+    LEFT JOIN users owner ON owner.id = i.owner_id
+    LEFT JOIN users c ON c.id = o.customer_id
+    LEFT JOIN product_variants pv ON pv.id = oi.variant_id
+    WHERE {date_column} >= %(start)s AND {date_column} < %(end)s
+    {owner_filter}
+    ORDER BY {date_column}, o.id, oi.id
+"""
+
+
+def _export_query(owner_id: Optional[int]) -> str:
+    if owner_id is None:
+        return _EXPORT_QUERY.format(
+            status="o.status", shipment_join="", date_column="o.order_date", owner_filter=""
+        )
+    # Shop owners: range scan on order_shipments (owner_id, order_date), their own lines and shipment status
+    return _EXPORT_QUERY.format(
+        status="s.status",
+        shipment_join="JOIN order_shipments s ON s.order_id = o.id AND s.owner_id = %(owner_id)s",
+        date_column="s.order_date",
+        owner_filter="AND i.owner_id = %(owner_id)s",
+    )
+
+
+async def _fetch_batches(start: datetime, end: datetime, owner_id: Optional[int]):
+    """
+    Yields batches of export rows from an unbuffered (server-side) cursor, so the
+    result set never sits in memory as a whole.
+    """
+    async with database.connection() as connection:
+        cursor = await connection.raw_connection.cursor(aiomysql.SSDictCursor)
+        try:
+            await cursor.execute(_export_query(owner_id), {"start": start, "end": end, "owner_id": owner_id})
+            while True:
+                rows = await cursor.fetchmany(ORDER_EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    quantity = row["quantity"] or 0
+                    row["unit_price"] = row["line_total_price"] / quantity if quantity else row["line_total_price"]
+                yield rows
+        finally:
+            await cursor.close()
+
+
+async def _csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    async for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _ndjson_line(order: dict, lines: list) -> str:
+    document = {field: order[field] for field in ORDER_FIELDS}
+    document["items"] = [{field: line[field] for field in LINE_FIELDS} for line in lines]
+    return json.dumps(document, default=lambda v: v.isoformat() if hasattr(v, "isoformat") else str(v)) + "\n"
+
+
+async def _ndjson_chunks(batches):
+    """
+    One JSON object per order with its lines nested. Rows arrive grouped by order,
+    so only the current order is held at a time.
+    """
+    current, lines = None, []
+    async for rows in batches:
+        out = []
+        for row in rows:
+            if current is not None and row["order_id"] != current["order_id"]:
+                out.append(_ndjson_line(current, lines))
+                lines = []
+            current = row
+            lines.append(row)
+        if out:
+            yield "".join(out)
+    if current is not None:
+        yield _ndjson_line(current, lines)
+
+
+async def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def _encode_chunks(chunks):
+    async for chunk in chunks:
+        yield chunk.encode("utf-8")
+
+
+def stream_order_export(start: datetime, end: datetime, fmt: str = "csv", compress: bool = True, owner_id: Optional[int] = None):
+    """
+    Async byte stream of orders placed in [start, end), as CSV (one row per line item)
+    or NDJSON (one object per order), optionally gzip-compressed on the fly.
+    owner_id limits the export to that shop owner's shipments and lines.
+    """
+    batches = _fetch_batches(start, end, owner_id)
+    chunks = _ndjson_chunks(batches) if fmt == "ndjson" else _csv_chunks(batches)
+    return _gzip_chunks(chunks) if compress else _encode_chunks(chunks)
+
+
+def export_media_type(fmt: str, compress: bool) -> str:
+    if compress:
+        return "application/gzip"
+    return "application/x-ndjson" if fmt == "ndjson" else "text/csv"
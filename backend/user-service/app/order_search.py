@@ -0,0 +1,121 @@
+import base64
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException
+import aiomysql
+from sqlalchemy import select, and_, or_
+from sqlalchemy.dialects.mysql import pymysql
+
+from app.database import database
+from app.models import orders, users
+
+ORDER_SEARCH_MAX_LIMIT = 200
+
+
+# =====================
+# Cursor
+# =====================
+def encode_cursor(order_date: datetime, order_id: int) -> str:
+    raw = f"{order_date.isoformat()}|{order_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        order_date, order_id = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+        return datetime.fromisoformat(order_date), int(order_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# =====================
+# Query planning
+# =====================
+def expected_index(transaction_id: Optional[str], customer_id: Optional[int], status: Optional[str]) -> str:
+    """
+    The index each filter combination is expected to be served from, most selective
+    first. Every plan reads the index in (order_date, id) order, so keyset pagination
+    never needs a filesort:
+      transaction_id         -> ix_orders_transaction_id (unique, at most one row)
+      customer (+ anything)  -> ix_orders_customer_date
+      status (+ dates)       -> ix_orders_status_date
+      dates only / nothing   -> ix_orders_order_date
+    """
+    if transaction_id:
+        return "ix_orders_transaction_id"
+    if customer_id is not None:
+        return "ix_orders_customer_date"
+    if status:
+        return "ix_orders_status_date"
+    return "ix_orders_order_date"
+
+
+def build_search_query(
+    transaction_id: Optional[str] = None,
+    customer_id: Optional[int] = None,
+    status: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    after: Optional[tuple] = None,
+    limit: int = 50,
+):
+    query = (
+        select(
+            orders.c.id,
+            orders.c.order_date,
+            orders.c.status,
+            orders.c.total_price,
+            orders.c.shipping_charge,
+            orders.c.coupon_code,
+            orders.c.transaction_id,
+            orders.c.customer_id,
+            users.c.username.label("customer_username"),
+            users.c.email.label("customer_email"),
+        )
+        .select_from(orders.outerjoin(users, users.c.id == orders.c.customer_id))
+    )
+
+    if transaction_id:
+        query = query.where(orders.c.transaction_id == transaction_id)
+    if customer_id is not None:
+        query = query.where(orders.c.customer_id == customer_id)
+    if status:
+        query = query.where(orders.c.status == status)
+    if start:
+        query = query.where(orders.c.order_date >= start)
+    if end:
+        query = query.where(orders.c.order_date < end)
+    if after:
+        # Keyset: strictly older than the last row of the previous page
+        after_date, after_id = after
+        query = query.where(
+            or_(
+                orders.c.order_date < after_date,
+                and_(orders.c.order_date == after_date, orders.c.id < after_id),
+            )
+        )
+
+    return query.order_by(orders.c.order_date.desc(), orders.c.id.desc()).limit(limit)
+
+
+async def explain_search_query(query) -> list:
+    """
+    Runs EXPLAIN on the search query with its real parameters, so the plan of each
+    filter combination can be checked against a production-sized table.
+    """
+    compiled = query.compile(dialect=pymysql.dialect(), compile_kwargs={"render_postcompile": True})
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    async with database.connection() as connection:
+        cursor = await connection.raw_connection.cursor(aiomysql.DictCursor)
+        try:
+            await cursor.execute(f"EXPLAIN {compiled}", params)
+            return list(await cursor.fetchall())
+        finally:
+            await cursor.close()
+
+
+async def resolve_customer_id(email: str) -> Optional[int]:
+    # Unique index on users.email
+    return await database.fetch_val(select(users.c.id).where(users.c.email == email))
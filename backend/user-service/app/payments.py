@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import select, or_
+
+from app.auth import now_ist_naive
+from app.database import database
+from app.models import orders, payment_transactions, payment_webhook_events
+from app.stock_holds import commit_holds, release_holds
+
+# Gateway the customer is redirected to; defaults to the local stand-in (python -m app.mock_gateway serve)
+PAYMENT_GATEWAY_URL = os.getenv("PAYMENT_GATEWAY_URL", "http://127.0.0.1:8081")
+# Shared secret for the X-VERIFY webhook signature; there is no default, webhooks are refused until it is set
+PAYMENT_WEBHOOK_SECRET = os.getenv("PAYMENT_WEBHOOK_SECRET")
+
+# Webhooks are written in group commits: one INSERT per batch or per flush interval
+WEBHOOK_INGEST_MAX_BATCH = int(os.getenv("WEBHOOK_INGEST_MAX_BATCH", 500))
+WEBHOOK_INGEST_FLUSH_SECONDS = float(os.getenv("WEBHOOK_INGEST_FLUSH_MS", 5)) / 1000
+
+PAYMENT_WORKER_BATCH_SIZE = int(os.getenv("PAYMENT_WORKER_BATCH_SIZE", 1000))
+PAYMENT_WORKER_IDLE_SECONDS = float(os.getenv("PAYMENT_WORKER_IDLE_SECONDS", 1))
+
+# Gateway status codes -> our payment states
+_STATUS_MAP = {
+    "SUCCESS": "SUCCESS",
+    "PAYMENT_SUCCESS": "SUCCESS",
+    "COMPLETED": "SUCCESS",
+    "PENDING": "PENDING",
+    "PAYMENT_PENDING": "PENDING",
+    "FAILED": "FAILED",
+    "PAYMENT_ERROR": "FAILED",
+    "PAYMENT_DECLINED": "FAILED",
+    "DECLINED": "FAILED",
+    "TIMED_OUT": "FAILED",
+    "CANCELLED": "FAILED",
+}
+# Once a payment reaches one of these it is never changed by a later webhook
+TERMINAL_PAYMENT_STATES = ("SUCCESS", "FAILED")
+
+
+def normalize_payment_status(status: str) -> Optional[str]:
+    return _STATUS_MAP.get((status or "").strip().upper())
+
+
+def sign_payload(body: bytes) -> str:
+    if not PAYMENT_WEBHOOK_SECRET:
+        raise RuntimeError("PAYMENT_WEBHOOK_SECRET is not set")
+    return hmac.new(PAYMENT_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(body: bytes, signature: Optional[str]) -> bool:
+    return bool(PAYMENT_WEBHOOK_SECRET) and bool(signature) and hmac.compare_digest(sign_payload(body), signature)
+
+
+# =====================
+# Webhook ingestion
+# =====================
+class _WebhookIngestor:
+    """
+    Group-commits acknowledged webhooks into payment_webhook_events. Each caller waits
+    until its row is durably written, but concurrent webhooks share one multi-row
+    INSERT IGNORE, so ingest throughput is not bound by one round trip per webhook.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._timer: Optional[asyncio.Task] = None
+
+    async def submit(self, row: dict):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+        if len(self._pending) >= WEBHOOK_INGEST_MAX_BATCH:
+            asyncio.create_task(self._flush())
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(WEBHOOK_INGEST_FLUSH_SECONDS)
+        self._timer = None
+        await self._flush()
+
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            # IGNORE: a redelivered (transaction_id, status) is already queued
+            await database.execute(
+                payment_webhook_events.insert().prefix_with("IGNORE").values([row for row, _ in batch])
+            )
+        except Exception as e:
+            print(f"Failed to store {len(batch)} payment webhooks: {e}", flush=True)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+
+_ingestor = _WebhookIngestor()
+
+
+async def ingest_webhook(transaction_id: str, status: str, payload: dict):
+    """
+    Queues one webhook for the payment worker; returns once it is stored.
+    """
+    await _ingestor.submit({
+        "transaction_id": transaction_id,
+        "status": status,
+        "payload": json.dumps(payload, separators=(",", ":")),
+        "received_at": now_ist_naive(),
+    })
+
+
+# =====================
+# Payment worker
+# =====================
+def _not_terminal(column):
+    return or_(column.is_(None), column.notin_(TERMINAL_PAYMENT_STATES))
+
+
+async def process_webhook_batch(batch_size: int = PAYMENT_WORKER_BATCH_SIZE) -> int:
+    """
+    Claims up to batch_size queued webhooks (SKIP LOCKED, so several workers can run)
+    and applies them to payment_transactions, orders and stock holds with one UPDATE
+    per resulting state. Returns how many events were processed.
+    """
+    async with database.transaction():
+        events = await database.fetch_all(
+            select(payment_webhook_events.c.id, payment_webhook_events.c.transaction_id, payment_webhook_events.c.status)
+            .where(payment_webhook_events.c.processed_at.is_(None))
+            .order_by(payment_webhook_events.c.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        if not events:
+            return 0
+
+        # Latest state per transaction; terminal states win over PENDING whatever the arrival order
+        latest = {}
+        for event in events:
+            current = latest.get(event["transaction_id"])
+            if current is None or current not in TERMINAL_PAYMENT_STATES:
+                latest[event["transaction_id"]] = event["status"]
+
+        by_status = {}
+        for transaction_id, status in latest.items():
+            by_status.setdefault(status, []).append(transaction_id)
+
+        now = now_ist_naive()
+        for status, transaction_ids in by_status.items():
+            await database.execute(
+                payment_transactions.update()
+                .where(payment_transactions.c.transaction_id.in_(transaction_ids))
+                .where(_not_terminal(payment_transactions.c.status))
+                .values(status=status, updated_at=now)
+            )
+            await database.execute(
+                orders.update()
+                .where(orders.c.transaction_id.in_(transaction_ids))
+                .where(_not_terminal(orders.c.payment_status))
+                .values(payment_status=status)
+            )
+
+        # Held stock follows the payment: sold on success, back on the shelf on failure
+        await commit_holds(by_status.get("SUCCESS"))
+        await release_holds(by_status.get("FAILED"))
+
+        await database.execute(
+            payment_webhook_events.update()
+            .where(payment_webhook_events.c.id.in_([event["id"] for event in events]))
+            .values(processed_at=now)
+        )
+    return len(events)
+
+
+_worker_task: Optional[asyncio.Task] = None
+
+
+async def _run_payment_worker():
+    while True:
+        try:
+            processed = await process_webhook_batch()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Payment worker error: {e}", flush=True)
+            processed = 0
+        if processed < PAYMENT_WORKER_BATCH_SIZE:
+            await asyncio.sleep(PAYMENT_WORKER_IDLE_SECONDS)
+
+
+def start_payment_worker():
+    global _worker_task
+    if not PAYMENT_WEBHOOK_SECRET:
+        print("PAYMENT_WEBHOOK_SECRET is not set; payment webhooks will be refused", flush=True)
+    if _worker_task is None:
+        _worker_task = asyncio.create_task(_run_payment_worker())
+
+
+async def stop_payment_worker():
+    global _worker_task
+    if _worker_task is not None:
+        _worker_task.cancel()
+        try:
+            await _worker_task
+        except asyncio.CancelledError:
+            pass
+        _worker_task = None
+
+
+async def lock_payment_for_order(transaction_id: str, customer_id: int):
+    """
+    The customer's own gateway transaction, read FOR UPDATE so the worker cannot apply a
+    webhook before the order commits and a second order for it waits here. Raises 404
+    for unknown or someone else's transactions and 409 if an order already uses it.
+    Returns the row (status, amount); the caller checks the amount against its total.
+    """
+    payment = await database.fetch_one(
+        select(payment_transactions.c.status, payment_transactions.c.amount)
+        .where(payment_transactions.c.transaction_id == transaction_id)
+        .where(payment_transactions.c.customer_id == customer_id)
+        .with_for_update()
+    )
+    if payment is None:
+        raise HTTPException(status_code=404, detail="Payment transaction not found")
+    linked = await database.fetch_val(select(orders.c.id).where(orders.c.transaction_id == transaction_id))
+    if linked is not None:
+        raise HTTPException(status_code=409, detail="Payment transaction is already linked to an order")
+    return payment
@@ -0,0 +1,190 @@
+"""
+Per-request database query accounting.
+
+InstrumentedDatabase counts every query made through `app.database.database` into the
+QueryStats of the current context, together with the time spent and how often each
+statement shape repeated; the same shape over and over in one request is the mark
+of an N+1 loop. QueryAccountingMiddleware gives each HTTP request its own stats and
+logs requests over budget. query_budget() is the helper for tests:
+
+    with query_budget(max_queries=5, max_repeats=2):
+        response = await client.get("/wishlist/", headers=auth)
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from databases import Database
+
+# A request running more queries than this is logged (0 disables)
+DB_QUERY_BUDGET = int(os.getenv("DB_QUERY_BUDGET", 50))
+# ...or running any one statement shape more often than this
+DB_REPEATED_QUERY_BUDGET = int(os.getenv("DB_REPEATED_QUERY_BUDGET", 10))
+# Adds X-DB-Query-Count and Server-Timing headers to responses; for development
+DB_QUERY_HEADERS = os.getenv("DB_QUERY_HEADERS", "").lower() in ("1", "true", "yes")
+
+_current_stats: ContextVar[Optional["QueryStats"]] = ContextVar("query_stats", default=None)
+
+
+def _shape(query):
+    # Raw SQL strings are their own shape. For SQLAlchemy statements the cache key
+    # ignores bound values, so the same query for another id counts as a repeat.
+    if isinstance(query, str):
+        return query
+    cache_key = query._generate_cache_key()
+    return cache_key.key if cache_key is not None else str(query)
+
+
+class QueryStats:
+    __slots__ = ("count", "seconds", "shapes")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = {}  # shape -> [times run, example statement]
+
+    def record(self, query, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        shape = _shape(query)
+        entry = self.shapes.get(shape)
+        if entry is None:
+            self.shapes[shape] = [1, query]
+        else:
+            entry[0] += 1
+
+    def merge_into(self, other: "QueryStats"):
+        other.count += self.count
+        other.seconds += self.seconds
+        for shape, (count, query) in self.shapes.items():
+            entry = other.shapes.get(shape)
+            if entry is None:
+                other.shapes[shape] = [count, query]
+            else:
+                entry[0] += count
+
+    def repeated(self, more_than: int) -> list:
+        """(times run, SQL) of the shapes run more than `more_than` times, most first."""
+        return sorted(
+            ((count, " ".join(str(query).split())) for count, query in self.shapes.values() if count > more_than),
+            key=lambda repeat: -repeat[0],
+        )
+
+    def over_budget(self, max_queries: Optional[int], max_repeats: Optional[int]) -> list:
+        """Human-readable budget violations; empty when within budget."""
+        problems = []
+        if max_queries and self.count > max_queries:
+            problems.append(f"{self.count} queries (budget {max_queries})")
+        if max_repeats:
+            for count, sql in self.repeated(max_repeats):
+                problems.append(f"{count}x {sql[:200]}")
+        return problems
+
+
+@contextmanager
+def track_queries():
+    """Counts the queries of the enclosed block; nested blocks also count towards the outer one."""
+    stats = QueryStats()
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+        parent = _current_stats.get()
+        if parent is not None:
+            stats.merge_into(parent)
+
+
+@contextmanager
+def query_budget(max_queries: int, max_repeats: Optional[int] = None):
+    """
+    Test helper: fails with AssertionError when the block runs more than `max_queries`
+    queries, or any statement shape more than `max_repeats` times. Drive the app
+    in-process (httpx.AsyncClient with ASGITransport) so the requests share the context.
+    """
+    with track_queries() as stats:
+        yield stats
+    problems = stats.over_budget(max_queries, max_repeats)
+    if problems:
+        raise AssertionError("Query budget exceeded: " + "; ".join(problems))
+
+
+class InstrumentedDatabase(Database):
+    async def _timed(self, query, call):
+        stats = _current_stats.get()
+        if stats is None:
+            return await call
+        started = time.perf_counter()
+        try:
+            return await call
+        finally:
+            stats.record(query, time.perf_counter() - started)
+
+    async def fetch_all(self, query, values=None):
+        return await self._timed(query, super().fetch_all(query, values))
+
+    async def fetch_one(self, query, values=None):
+        return await self._timed(query, super().fetch_one(query, values))
+
+    async def fetch_val(self, query, values=None, column=0):
+        return await self._timed(query, super().fetch_val(query, values, column=column))
+
+    async def execute(self, query, values=None):
+        return await self._timed(query, super().execute(query, values))
+
+    async def execute_many(self, query, values):
+        return await self._timed(query, super().execute_many(query, values))
+
+    async def iterate(self, query, values=None):
+        # Counted once, timed to the first row; the rest is paced by the consumer
+        stats = _current_stats.get()
+        started = time.perf_counter()
+        first = True
+        async for record in super().iterate(query, values):
+            if first and stats is not None:
+                stats.record(query, time.perf_counter() - started)
+            first = False
+            yield record
+        if first and stats is not None:
+            stats.record(query, time.perf_counter() - started)
+
+
+class QueryAccountingMiddleware:
+    """Tracks each HTTP request's queries and logs the ones over DB_QUERY_BUDGET."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with track_queries() as stats:
+            if DB_QUERY_HEADERS:
+                async def send_with_headers(message):
+                    # Queries made after the response has started (background tasks) are not included
+                    if message["type"] == "http.response.start":
+                        message = {
+                            **message,
+                            "headers": list(message.get("headers", [])) + [
+                                (b"x-db-query-count", str(stats.count).encode()),
+                                (b"server-timing", f'db;dur={stats.seconds * 1000:.1f};desc="{stats.count} queries"'.encode()),
+                            ],
+                        }
+                    await send(message)
+
+                await self.app(scope, receive, send_with_headers)
+            else:
+                await self.app(scope, receive, send)
+
+        problems = stats.over_budget(DB_QUERY_BUDGET, DB_REPEATED_QUERY_BUDGET)
+        if problems:
+            route = getattr(scope.get("route"), "path", scope["path"])
+            print(
+                f"Query budget exceeded on {scope['method']} {route} "
+                f"({stats.count} queries, {stats.seconds * 1000:.1f} ms): " + "; ".join(problems),
+                flush=True,
+            )
@@ -5,6 +5,8 @@ from app.database import database
 from app.models import addresses
 from app.deps import get_current_user
 from app.schemas import AddressCreate, AddressRead, AddressUpdate, Message
+from app.crud import address_fingerprint, upsert_address
+from pymysql.err import IntegrityError
 import traceback
 
 router = APIRouter()
@@ -50,7 +52,8 @@ async def create_user_address(address: AddressCreate, current_user=Depends(get_c
                 .values(is_default=False)
             )
 
-        address_id = await database.execute(addresses.insert().values(**values))
+        # Saving an address the user already has returns the existing row
+        address_id = await upsert_address(current_user["id"], values, refresh_default=True)
         result = await database.fetch_one(addresses.select().where(addresses.c.id == address_id))
         return dict(result) if result else None
     except Exception as e:
@@ -76,7 +79,11 @@ async def update_user_address(address_id: int, update: AddressUpdate, current_us
         )
 
     update_data["updated_at"] = datetime.utcnow()
-    await database.execute(addresses.update().where(addresses.c.id == address_id).values(**update_data))
+    update_data["fingerprint"] = address_fingerprint({**dict(addr), **update_data})
+    try:
+        await database.execute(addresses.update().where(addresses.c.id == address_id).values(**update_data))
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="An identical address is already saved")
     updated = await database.fetch_one(addresses.select().where(addresses.c.id == address_id))
     return updated
 
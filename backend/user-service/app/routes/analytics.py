@@ -0,0 +1,61 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import List, Optional
+from datetime import date, timedelta
+from app.deps import get_current_shop_owner, get_current_admin_user
+from app.schemas import SalesRollupRead
+from app.analytics import fetch_rollups, ROLLUP_GROUPS
+from app.auth import now_ist_naive
+
+router = APIRouter()
+
+# Hourly rows are 24x denser; keep hourly ranges short
+MAX_HOURLY_RANGE_DAYS = 31
+
+
+def _resolve_range(start: Optional[date], end: Optional[date], granularity: str, group_by: str):
+    if group_by not in ROLLUP_GROUPS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(ROLLUP_GROUPS)}")
+    end = end or now_ist_naive().date()
+    start = start or end - timedelta(days=29)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    if granularity == "hour" and (end - start).days >= MAX_HOURLY_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Hourly analytics are limited to {MAX_HOURLY_RANGE_DAYS} days")
+    return start, end
+
+
+# =====================
+# Shop Owner → Sales Analytics
+# =====================
+@router.get("/shop-owner/analytics", response_model=List[SalesRollupRead])
+async def shop_owner_analytics(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    granularity: str = Query("day", pattern="^(day|hour)$"),
+    group_by: str = "total",
+    item_id: Optional[int] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    current_user=Depends(get_current_shop_owner),
+):
+    start, end = _resolve_range(start, end, granularity, group_by)
+    return await fetch_rollups(current_user["id"], start, end, granularity, group_by, item_id, limit)
+
+
+# =====================
+# Admin → Sales Analytics
+# =====================
+@router.get("/admin/analytics", response_model=List[SalesRollupRead], dependencies=[Depends(get_current_admin_user)])
+async def admin_analytics(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    granularity: str = Query("day", pattern="^(day|hour)$"),
+    group_by: str = "total",
+    owner_id: Optional[int] = None,
+    item_id: Optional[int] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+):
+    start, end = _resolve_range(start, end, granularity, group_by)
+    # Without an owner, totals are site-wide and item/variant rows span all owners
+    if owner_id is None and group_by == "total":
+        owner_id = 0
+    return await fetch_rollups(owner_id, start, end, granularity, group_by, item_id, limit)
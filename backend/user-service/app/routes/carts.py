@@ -2,8 +2,11 @@ from fastapi import APIRouter, Depends, HTTPException
 from typing import List, Optional
 from app.database import database
 from app.models import carts, items, product_variants, variant_images
-from app.schemas import CartItemAdd, CartItemUpdate, CartItem, Message, ItemRead
+from app.schemas import CartItemAdd, CartItemUpdate, CartItem, Message, ItemRead, BestCouponRead
 from app.deps import get_current_user
+from app.coupon_service import find_best_coupon
+from app.inventory import live_stock_sql
+from datetime import datetime, timezone, timedelta
 import traceback
 from sqlalchemy import select, and_
 
@@ -15,7 +18,7 @@ router = APIRouter()
 @router.get("/", response_model=List[CartItem])
 async def get_cart(current_user=Depends(get_current_user)):
     try:
-        query = """
+        query = f"""
             SELECT 
                 c.id,
                 c.user_id,
@@ -31,7 +34,7 @@ async def get_cart(current_user=Depends(get_current_user)):
                 pv.color as selected_variant_color,
                 pv.size as selected_variant_size,
                 pv.price as selected_variant_price,
-                pv.stock as selected_variant_stock,
+                {live_stock_sql("pv")} as selected_variant_stock,
                 pv.image_url as selected_variant_image_url
             FROM carts c
             JOIN items i ON c.item_id = i.id
@@ -41,31 +44,28 @@ async def get_cart(current_user=Depends(get_current_user)):
         """
         results = await database.fetch_all(query, values={"user_id": current_user["id"]})
 
-        cart_response = []
-        for row in results:
-            # Get all variants for this item
-            variants_query = """
+        # Get all variants of every item in the cart in one query
+        variants_by_item = {}
+        if results:
+            variants_query = f"""
                 SELECT 
                     pv.id,
                     pv.item_id,  # This is required for ProductVariantRead
                     pv.color,
                     pv.size, 
                     pv.price,
-                    pv.stock,
+                    {live_stock_sql("pv")} as stock,
                     pv.image_url
                 FROM product_variants pv
-                WHERE pv.item_id = :item_id
+                WHERE pv.item_id IN :item_ids
                 ORDER BY pv.id
             """
             item_variants = await database.fetch_all(
                 variants_query, 
-                values={"item_id": row["item_id"]}
+                values={"item_ids": tuple({row["item_id"] for row in results})}
             )
-            
-            # Build variants list for ItemRead
-            variants_list = []
             for variant in item_variants:
-                variants_list.append({
+                variants_by_item.setdefault(variant["item_id"], []).append({
                     "id": variant["id"],
                     "item_id": variant["item_id"],  # Required field
                     "color": variant["color"],
@@ -74,6 +74,11 @@ async def get_cart(current_user=Depends(get_current_user)):
                     "stock": variant["stock"],
                     "image_url": variant["image_url"]
                 })
+
+        cart_response = []
+        for row in results:
+            # Build variants list for ItemRead
+            variants_list = variants_by_item.get(row["item_id"], [])
             
             # Use variant image if available
             image_url = row["selected_variant_image_url"]
@@ -176,7 +181,7 @@ async def add_or_update_item(data: CartItemAdd, current_user=Depends(get_current
             cart_item_id = await database.execute(insert_query)
 
         # Fetch the complete cart item for response
-        cart_query = """
+        cart_query = f"""
             SELECT 
                 c.id,
                 c.user_id,
@@ -191,7 +196,7 @@ async def add_or_update_item(data: CartItemAdd, current_user=Depends(get_current
                 pv.color as selected_variant_color,
                 pv.size as selected_variant_size,
                 pv.price as selected_variant_price,
-                pv.stock as selected_variant_stock,
+                {live_stock_sql("pv")} as selected_variant_stock,
                 pv.image_url as selected_variant_image_url
             FROM carts c
             JOIN items i ON c.item_id = i.id
@@ -207,14 +212,14 @@ async def add_or_update_item(data: CartItemAdd, current_user=Depends(get_current
             raise HTTPException(status_code=404, detail="Cart item not found after creation")
 
         # Get all variants for this item
-        variants_query = """
+        variants_query = f"""
             SELECT 
                 pv.id,
                 pv.item_id,  # This is required for ProductVariantRead
                 pv.color,
                 pv.size, 
                 pv.price,
-                pv.stock,
+                {live_stock_sql("pv")} as stock,
                 pv.image_url
             FROM product_variants pv
             WHERE pv.item_id = :item_id
@@ -358,4 +363,35 @@ async def clear_cart(current_user=Depends(get_current_user)):
     
     except Exception as e:
         print(f"Error in clear_cart: {e}")
-        raise HTTPException(status_code=500, detail="Failed to clear cart")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Failed to clear cart")
+
+
+# =====================
+# Best coupon for the current cart
+# =====================
+@router.get("/best-coupon", response_model=BestCouponRead)
+async def get_best_coupon(current_user=Depends(get_current_user)):
+    # Cart total at current variant prices, the same prices create_order will charge
+    cart_total = await database.fetch_val(
+        """
+            SELECT COALESCE(SUM(pv.price * c.quantity), 0)
+            FROM carts c
+            JOIN product_variants pv ON c.variant_id = pv.id
+            WHERE c.user_id = :user_id
+        """,
+        values={"user_id": current_user["id"]},
+    )
+    cart_total = float(cart_total or 0)
+
+    IST = timezone(timedelta(hours=5, minutes=30))
+    now_ist = datetime.now(IST)
+    now_str = now_ist.strftime("%Y-%m-%d %H:%M:%S")
+    now = datetime.strptime(now_str, "%Y-%m-%d %H:%M:%S")
+
+    coupon, discount_amount = await find_best_coupon(cart_total, current_user["id"], now)
+    return {
+        "cart_total": cart_total,
+        "coupon": coupon,
+        "discount_amount": discount_amount,
+        "total_after_discount": cart_total - discount_amount,
+    }
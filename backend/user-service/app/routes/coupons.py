@@ -1,13 +1,28 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from typing import List
 from datetime import datetime, timezone, timedelta
 from app.database import database
 from app.models import coupons
 from app.deps import get_current_user, get_current_shop_owner, get_current_admin_user
-from app.schemas import CouponCreate, CouponRead, CouponUpdate, Message
+from app.schemas import CouponCreate, CouponRead, CouponUpdate, CouponBatchCreate, Message
+from app.coupon_service import validate_coupon, invalidate_coupon_cache, generate_coupon_codes, insert_coupon_codes
 
 router = APIRouter()
 
+# NOT NULL columns; an explicit null in an update leaves them unchanged instead of failing the write
+_NOT_NULL_COUPON_FIELDS = {column.name for column in coupons.c if not column.nullable}
+
+
+def _coupon_update_values(coupon_updates: CouponUpdate) -> dict:
+    values = {
+        field: value
+        for field, value in coupon_updates.dict(exclude_unset=True).items()
+        if value is not None or field not in _NOT_NULL_COUPON_FIELDS
+    }
+    return {**values, "updated_at": datetime.utcnow()}
+
 
 # Public - List active coupons
 @router.get("/coupons/", response_model=List[CouponRead])
@@ -53,6 +68,7 @@ async def create_coupon_shop_owner(coupon: CouponCreate, current_user=Depends(ge
         "used_count": 0,
     })
     coupon_id = await database.execute(coupons.insert().values(**values))
+    invalidate_coupon_cache(coupon.code)
     result = await database.fetch_one(coupons.select().where(coupons.c.id == coupon_id))
     return result
 
@@ -65,8 +81,9 @@ async def update_coupon_shop_owner(coupon_id: int, coupon_updates: CouponUpdate,
         raise HTTPException(status_code=404, detail="Coupon not found")
     if c["created_by"] != current_user["id"]:
         raise HTTPException(status_code=403, detail="Not authorized to update this coupon")
-    update_data = {**coupon_updates.dict(exclude_unset=True), "updated_at": datetime.utcnow()}
+    update_data = _coupon_update_values(coupon_updates)
     await database.execute(coupons.update().where(coupons.c.id == coupon_id).values(**update_data))
+    invalidate_coupon_cache(c["code"])
     updated = await database.fetch_one(coupons.select().where(coupons.c.id == coupon_id))
     return updated
 
@@ -82,6 +99,7 @@ async def toggle_coupon_shop_owner(coupon_id: int, current_user=Depends(get_curr
     await database.execute(
         coupons.update().where(coupons.c.id == coupon_id).values(active=new_status, updated_at=datetime.utcnow())
     )
+    invalidate_coupon_cache(coupon["code"])
     return {"message": f"Coupon {'enabled' if new_status else 'disabled'}"}
 
 
@@ -113,18 +131,71 @@ async def create_coupon_admin(coupon: CouponCreate, current_user=Depends(get_cur
         "used_count": 0,
     })
     coupon_id = await database.execute(coupons.insert().values(**values))
+    invalidate_coupon_cache(coupon.code)
     result = await database.fetch_one(coupons.select().where(coupons.c.id == coupon_id))
     return result
 
 
+# Admin - Generate a batch of unique coupon codes, returned as CSV
+@router.post("/admin/coupons/batch", dependencies=[Depends(get_current_admin_user)])
+async def create_coupon_batch_admin(batch: CouponBatchCreate, current_user=Depends(get_current_admin_user)):
+    prefix = batch.prefix or ""
+    if len(prefix) + batch.length > 32:
+        raise HTTPException(status_code=400, detail="Prefix plus code length must not exceed 32 characters")
+    if batch.discount_type not in ("percentage", "fixed"):
+        raise HTTPException(status_code=400, detail="discount_type must be 'percentage' or 'fixed'")
+
+    try:
+        codes = await run_in_threadpool(generate_coupon_codes, batch.count, batch.length, batch.alphabet, prefix)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    IST = timezone(timedelta(hours=5, minutes=30))
+    now_ist = datetime.now(IST)
+    now_str = now_ist.strftime("%Y-%m-%d %H:%M:%S")
+    now = datetime.strptime(now_str, "%Y-%m-%d %H:%M:%S")
+    template = {
+        "description": batch.description,
+        "discount_type": batch.discount_type,
+        "discount_value": batch.discount_value,
+        "active": batch.active,
+        "start_at": batch.start_at or now,
+        "end_at": batch.end_at,
+        "min_order_amount": batch.min_order_amount or 0,
+        "max_uses": batch.max_uses or 0,
+        "used_count": 0,
+        "per_user_limit": batch.per_user_limit or 0,
+        "created_by": current_user["id"],
+        "created_at": now,
+        "updated_at": now,
+    }
+
+    # All or nothing: a failed chunk leaves no partial campaign behind
+    async with database.transaction():
+        await insert_coupon_codes(codes, template, batch.length, batch.alphabet, prefix)
+
+    def csv_rows():
+        yield "code\n"
+        for start in range(0, len(codes), 10000):
+            yield "".join(f"{code}\n" for code in codes[start:start + 10000])
+
+    filename = f"coupons_{now.strftime('%Y%m%d_%H%M%S')}.csv"
+    return StreamingResponse(
+        csv_rows(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 # Admin - Update any coupon
 @router.put("/admin/coupons/{coupon_id}", response_model=CouponRead, dependencies=[Depends(get_current_admin_user)])
 async def update_coupon_admin(coupon_id: int, coupon_updates: CouponUpdate):
     c = await database.fetch_one(coupons.select().where(coupons.c.id == coupon_id))
     if not c:
         raise HTTPException(status_code=404, detail="Coupon not found")
-    update_data = {**coupon_updates.dict(exclude_unset=True), "updated_at": datetime.utcnow()}
+    update_data = _coupon_update_values(coupon_updates)
     await database.execute(coupons.update().where(coupons.c.id == coupon_id).values(**update_data))
+    invalidate_coupon_cache(c["code"])
     updated = await database.fetch_one(coupons.select().where(coupons.c.id == coupon_id))
     return updated
 
@@ -139,6 +210,7 @@ async def toggle_coupon_admin(coupon_id: int):
     await database.execute(
         coupons.update().where(coupons.c.id == coupon_id).values(active=new_status, updated_at=datetime.utcnow())
     )
+    invalidate_coupon_cache(c["code"])
     return {"message": f"Coupon {'enabled' if new_status else 'disabled'}"}
 
 
@@ -149,34 +221,14 @@ async def redeem_coupon(
     order_total: float,
     current_user=Depends(get_current_user)
 ):
-    # Fetch coupon by code
-    coupon = await database.fetch_one(coupons.select().where(coupons.c.code == code))
     IST = timezone(timedelta(hours=5, minutes=30))
     now_ist = datetime.now(IST)
     now_str = now_ist.strftime("%Y-%m-%d %H:%M:%S")
     now = datetime.strptime(now_str, "%Y-%m-%d %H:%M:%S")
-    
-    # Coupon existence and active check
-    if not coupon or not coupon["active"]:
-        raise HTTPException(status_code=404, detail="Coupon not available or inactive")
-    
-    # Check coupon validity period
-    if coupon["start_at"] and now < coupon["start_at"]:
-        raise HTTPException(status_code=400, detail="Coupon not valid yet")
-    if coupon["end_at"] and now > coupon["end_at"]:
-        raise HTTPException(status_code=400, detail="Coupon has expired")
-    
-    # Check minimum order amount eligibility
-    if coupon["min_order_amount"] and order_total < coupon["min_order_amount"]:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Order total below minimum required amount: {coupon['min_order_amount']}"
-        )
-    
-    # Check usage limit
-    if coupon["max_uses"] and coupon["used_count"] >= coupon["max_uses"]:
-        raise HTTPException(status_code=400, detail="Coupon usage limit reached")
-    
+
+    # Fetch coupon by code and check active, validity period, minimum amount and usage limits
+    coupon = await validate_coupon(code, order_total, current_user["id"], now)
+
     # If all validations pass, return coupon details for front-end application
     return coupon
 
@@ -189,6 +241,7 @@ async def delete_coupon_shop_owner(coupon_id: int, current_user=Depends(get_curr
     if coupon["created_by"] != current_user["id"]:
         raise HTTPException(status_code=403, detail="Not authorized to delete this coupon")
     await database.execute(coupons.delete().where(coupons.c.id == coupon_id))
+    invalidate_coupon_cache(coupon["code"])
     return {"message": "Coupon deleted successfully"}
 
 
@@ -199,4 +252,5 @@ async def delete_coupon_admin(coupon_id: int):
     if not coupon:
         raise HTTPException(status_code=404, detail="Coupon not found")
     await database.execute(coupons.delete().where(coupons.c.id == coupon_id))
+    invalidate_coupon_cache(coupon["code"])
     return {"message": "Coupon deleted successfully"}
@@ -0,0 +1,45 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from fastapi.security import OAuth2PasswordBearer
+
+from app.deps import get_current_user, get_current_admin_user
+from app.events import broker
+
+router = APIRouter()
+
+# EventSource cannot send an Authorization header, so the token may also come as ?token=
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login", auto_error=False)
+
+
+# =====================
+# Live events (SSE)
+# =====================
+@router.get("/events/stream")
+async def event_stream(
+    token: Optional[str] = Query(None),
+    bearer: Optional[str] = Depends(optional_oauth2_scheme),
+):
+    """
+    Server-sent events for the current user: `notification` (new in-app notification),
+    `order_status` (one of their orders changed) and `resync` (events were dropped,
+    refetch). Comment frames keep idle connections open through proxies.
+    """
+    if not (bearer or token):
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    current_user = await get_current_user(bearer or token)
+
+    stream = broker.subscribe(current_user["id"])
+    if stream is None:
+        raise HTTPException(status_code=429, detail="Too many open event streams")
+    return StreamingResponse(
+        broker.stream(current_user["id"], stream),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/admin/events/stats", dependencies=[Depends(get_current_admin_user)])
+async def event_stream_stats():
+    return broker.stats()
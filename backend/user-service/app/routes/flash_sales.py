@@ -0,0 +1,62 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import select
+from app.database import database
+from app.deps import get_current_admin_user
+from app.models import flash_sales, product_variants
+from app.schemas import FlashSaleCreate, FlashSaleRead
+from app.flash_sales import create_flash_sale, get_flash_sale_summary, reconcile_flash_sale
+
+router = APIRouter()
+
+
+# =====================
+# Admin → Schedule Flash Sale
+# =====================
+@router.post("/admin/flash-sales", response_model=FlashSaleRead, dependencies=[Depends(get_current_admin_user)])
+async def schedule_flash_sale(sale: FlashSaleCreate):
+    if sale.ends_at <= sale.starts_at:
+        raise HTTPException(status_code=400, detail="ends_at must be after starts_at")
+    variant = await database.fetch_val(select(product_variants.c.id).where(product_variants.c.id == sale.variant_id))
+    if not variant:
+        raise HTTPException(status_code=404, detail="Variant not found")
+
+    overlapping = await database.fetch_val(
+        select(flash_sales.c.id)
+        .where(flash_sales.c.variant_id == sale.variant_id)
+        .where(flash_sales.c.status == "scheduled")
+        .where(flash_sales.c.starts_at < sale.ends_at)
+        .where(flash_sales.c.ends_at > sale.starts_at)
+    )
+    if overlapping:
+        raise HTTPException(status_code=409, detail=f"Variant already has flash sale {overlapping} in that window")
+
+    sale_id = await create_flash_sale(sale.variant_id, sale.starts_at, sale.ends_at, sale.slice_size)
+    return await get_flash_sale_summary(sale_id)
+
+
+# =====================
+# Admin → Flash Sale Progress
+# =====================
+@router.get("/admin/flash-sales/{sale_id}", response_model=FlashSaleRead, dependencies=[Depends(get_current_admin_user)])
+async def flash_sale_progress(sale_id: int):
+    summary = await get_flash_sale_summary(sale_id)
+    if not summary:
+        raise HTTPException(status_code=404, detail="Flash sale not found")
+    return summary
+
+
+# =====================
+# Admin → Reconcile Flash Sale
+# =====================
+@router.post("/admin/flash-sales/{sale_id}/reconcile", response_model=FlashSaleRead, dependencies=[Depends(get_current_admin_user)])
+async def reconcile_sale(sale_id: int):
+    summary = await get_flash_sale_summary(sale_id)
+    if not summary:
+        raise HTTPException(status_code=404, detail="Flash sale not found")
+    if summary["status"] != "reconciled":
+        # Workers reconcile on their own after the grace period; this only runs it sooner
+        await reconcile_flash_sale(sale_id)
+        summary = await get_flash_sale_summary(sale_id)
+        if summary["status"] != "reconciled":
+            raise HTTPException(status_code=409, detail="Flash sale has not finished its grace period yet")
+    return summary
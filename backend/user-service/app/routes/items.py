@@ -4,11 +4,14 @@ from app.models import items, users, product_variants, variant_images, item_attr
 from app.schemas import ItemRead, Message, ProductVariantRead, ItemAttributeRead, ItemAttributeCreate, CategoryRead, CategoryCreate
 from typing import List,Optional
 from app.deps import get_current_shop_owner, get_current_admin_user, get_current_shop_owner_or_admin
-from app.crud import create_notification
+from app.crud import create_notification, publish_notifications
+from app.inventory import live_stock_sql, select_variants, add_stock, set_stock
+from app.wishlist_alerts import record_price_drop
 import os
 import time
 import json
 from collections import defaultdict
+from sqlalchemy import select
 
 LOW_STOCK_THRESHOLD = 5
 router = APIRouter()
@@ -20,40 +23,55 @@ router = APIRouter()
 async def list_items():
     try:
         items_results = await database.fetch_all(items.select())
-        items_list = []
-        for item in items_results:
-            item_dict = dict(item)
-
-            # Fetch variants
-            variants_results = await database.fetch_all(
-                product_variants.select().where(product_variants.c.item_id == item["id"])
-            )
-            variants_list = []
-            for variant in variants_results:
-                variant_dict = dict(variant)
-                images_results = await database.fetch_all(
-                    variant_images.select()
-                    .where(variant_images.c.variant_id == variant["id"])
-                    .order_by(variant_images.c.display_order)
-                )
-                variant_dict["images"] = [img["image_url"] for img in images_results]
-                variants_list.append(variant_dict)
-            item_dict["variants"] = variants_list
-
-            # Fetch categories linked to item
-            categories_results = await database.fetch_all(
-                categories.select()
-                .select_from(categories.join(item_categories, categories.c.id == item_categories.c.category_id))
-                .where(item_categories.c.item_id == item["id"])
+        if not items_results:
+            return []
+        item_ids = [item["id"] for item in items_results]
+
+        # Variants, their images, categories and attributes for every item, one query each
+        variants_results = await database.fetch_all(
+            select_variants()
+            .where(product_variants.c.item_id.in_(item_ids))
+            .order_by(product_variants.c.id)
+        )
+        images_by_variant = defaultdict(list)
+        variant_ids = [variant["id"] for variant in variants_results]
+        if variant_ids:
+            images_results = await database.fetch_all(
+                variant_images.select()
+                .where(variant_images.c.variant_id.in_(variant_ids))
+                .order_by(variant_images.c.variant_id, variant_images.c.display_order)
             )
-            item_dict["categories"] = [dict(cat) for cat in categories_results]
+            for img in images_results:
+                images_by_variant[img["variant_id"]].append(img["image_url"])
+
+        variants_by_item = defaultdict(list)
+        for variant in variants_results:
+            variant_dict = dict(variant)
+            variant_dict["images"] = images_by_variant.get(variant["id"], [])
+            variants_by_item[variant["item_id"]].append(variant_dict)
+
+        categories_results = await database.fetch_all(
+            select(*categories.c, item_categories.c.item_id)
+            .select_from(categories.join(item_categories, categories.c.id == item_categories.c.category_id))
+            .where(item_categories.c.item_id.in_(item_ids))
+        )
+        categories_by_item = defaultdict(list)
+        for cat in categories_results:
+            categories_by_item[cat["item_id"]].append({column.name: cat[column.name] for column in categories.c})
 
-            # Fetch item attributes
-            attributes_results = await database.fetch_all(
-                item_attributes.select().where(item_attributes.c.item_id == item["id"])
-            )
-            item_dict["attributes"] = [dict(attr) for attr in attributes_results]
+        attributes_results = await database.fetch_all(
+            item_attributes.select().where(item_attributes.c.item_id.in_(item_ids))
+        )
+        attributes_by_item = defaultdict(list)
+        for attr in attributes_results:
+            attributes_by_item[attr["item_id"]].append(dict(attr))
 
+        items_list = []
+        for item in items_results:
+            item_dict = dict(item)
+            item_dict["variants"] = variants_by_item.get(item["id"], [])
+            item_dict["categories"] = categories_by_item.get(item["id"], [])
+            item_dict["attributes"] = attributes_by_item.get(item["id"], [])
             items_list.append(item_dict)
         return items_list
     except Exception as e:
@@ -78,9 +96,10 @@ async def list_my_items(current_user=Depends(get_current_shop_owner)):
     item_ids = [item["id"] for item in items_results]
     
     # Get all variants for these items
-    variants_query = """
+    variants_query = f"""
     SELECT 
         pv.*,
+        {live_stock_sql("pv")} as live_stock,
         (
             SELECT JSON_ARRAYAGG(
                 vi.image_url
@@ -154,7 +173,7 @@ async def list_my_items(current_user=Depends(get_current_shop_owner)):
             "size": variant["size"],
             "color": variant["color"],
             "price": float(variant["price"]) if variant["price"] else None,
-            "stock": variant["stock"],
+            "stock": variant["live_stock"],
             "image_url": variant["image_url"],
             "images": images_list  # This should be List[str] - just image URLs
         }
@@ -234,7 +253,7 @@ async def get_item_detail(item_id: int):
 
     # Variants
     variants = await database.fetch_all(
-        product_variants.select().where(product_variants.c.item_id == item_id)
+        select_variants().where(product_variants.c.item_id == item_id)
     )
     variant_ids = [v["id"] for v in variants]
 
@@ -325,30 +344,45 @@ async def admin_list_items():
     
     items_results = await database.fetch_all(items_query)
     
-    # Then get variants for each item
+    if not items_results:
+        return []
+
+    # Then get the variants of all items in one query
+    variants_query = f"""
+        SELECT 
+            pv.id,
+            pv.item_id,
+            pv.color,
+            pv.size,
+            pv.price,
+            {live_stock_sql("pv")} as stock,
+            (SELECT vi.image_url 
+             FROM variant_images vi 
+             WHERE vi.variant_id = pv.id 
+             ORDER BY vi.display_order ASC 
+             LIMIT 1) as image_url
+        FROM product_variants pv
+        WHERE pv.item_id IN :item_ids
+        ORDER BY pv.id
+    """
+    variant_rows = await database.fetch_all(
+        query=variants_query, 
+        values={"item_ids": tuple(item["id"] for item in items_results)}
+    )
+    variants_by_item = defaultdict(list)
+    for variant in variant_rows:
+        variants_by_item[variant["item_id"]].append({
+            "id": variant["id"],
+            "color": variant["color"],
+            "size": variant["size"],
+            "price": variant["price"],
+            "stock": variant["stock"],
+            "image_url": variant["image_url"],
+        })
+
     items_with_variants = []
     for item in items_results:
-        variants_query = """
-            SELECT 
-                pv.id,
-                pv.color,
-                pv.size,
-                pv.price,
-                pv.stock,
-                (SELECT vi.image_url 
-                 FROM variant_images vi 
-                 WHERE vi.variant_id = pv.id 
-                 ORDER BY vi.display_order ASC 
-                 LIMIT 1) as image_url
-            FROM product_variants pv
-            WHERE pv.item_id = :item_id
-            ORDER BY pv.id
-        """
-        variants = await database.fetch_all(
-            query=variants_query, 
-            values={"item_id": item["id"]}
-        )
-        
+        variants = variants_by_item.get(item["id"], [])
         total_stock = sum(variant["stock"] or 0 for variant in variants)
         prices = [variant["price"] for variant in variants if variant["price"] is not None]
         
@@ -508,6 +542,7 @@ async def create_variant(
     color: Optional[str] = Form(None),
     price: Optional[float] = Form(None),
     stock: int = Form(0),
+    weight_grams: Optional[int] = Form(None),
     image: UploadFile = File(None),  # Single image (backward compatible)
     images: List[UploadFile] = File(None),  # Multiple images
     current_user=Depends(get_current_shop_owner_or_admin),
@@ -519,17 +554,20 @@ async def create_variant(
     if existing_item["owner_id"] != current_user["id"] and current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Not authorized to add variants to this item")
 
-    # Create variant first
-    variant_id = await database.execute(
-        product_variants.insert().values(
-            item_id=item_id,
-            size=size,
-            color=color,
-            price=price,
-            stock=stock,
-            image_url=None,
+    # Create variant first; its opening stock is the first ledger movement
+    async with database.transaction():
+        variant_id = await database.execute(
+            product_variants.insert().values(
+                item_id=item_id,
+                size=size,
+                color=color,
+                price=price,
+                stock=0,
+                image_url=None,
+                weight_grams=weight_grams,
+            )
         )
-    )
+        await add_stock({variant_id: stock}, "restock", f"user:{current_user['id']}")
 
     # Handle image uploads - support both single and multiple
     image_urls = []
@@ -578,13 +616,13 @@ async def create_variant(
 
     # Low stock notification
     if stock < LOW_STOCK_THRESHOLD:
-        await create_notification(
+        publish_notifications(await create_notification(
             user_id=existing_item["owner_id"],
             message=f"Low stock alert for variant of '{existing_item['title']}' — only {stock} left.",
             send_email_alert=True,
             item_title=existing_item["title"],
             stock=stock,
-        )
+        ))
 
     # Fetch the created variant
     variant = await database.fetch_one(
@@ -599,6 +637,7 @@ async def create_variant(
         "price": price,
         "stock": stock,
         "image_url": primary_image_url,
+        "weight_grams": weight_grams,
         "images": image_urls,
     }
 
@@ -609,6 +648,7 @@ async def update_variant(
     color: Optional[str] = Form(None),
     price: Optional[float] = Form(None),
     stock: int = Form(...),
+    weight_grams: Optional[int] = Form(None),  # left unchanged when not sent
     images: List[UploadFile] = File(None),  # Allow adding more images during update
     current_user=Depends(get_current_shop_owner_or_admin),
 ):
@@ -653,29 +693,34 @@ async def update_variant(
                     )
                 )
 
-    # Update variant details
-    await database.execute(
-        product_variants.update().where(product_variants.c.id == variant_id).values(
-            size=size,
-            color=color,
-            price=price,
-            stock=stock,
-            # Keep existing image_url unless new images were added
-            image_url=existing_variant["image_url"] if not new_image_urls else new_image_urls[0]
+    # Update variant details; the stock count goes to the ledger as an adjustment
+    variant_values = {
+        "size": size,
+        "color": color,
+        "price": price,
+        # Keep existing image_url unless new images were added
+        "image_url": existing_variant["image_url"] if not new_image_urls else new_image_urls[0],
+    }
+    if weight_grams is not None:
+        variant_values["weight_grams"] = weight_grams
+    async with database.transaction():
+        await database.execute(
+            product_variants.update().where(product_variants.c.id == variant_id).values(**variant_values)
         )
-    )
+        await record_price_drop(existing_variant, price)
+        await set_stock(variant_id, stock, f"user:{current_user['id']}")
 
     if stock < LOW_STOCK_THRESHOLD:
-        await create_notification(
+        publish_notifications(await create_notification(
             user_id=base_item["owner_id"],
             message=f"Low stock alert for variant of '{base_item['title']}' — only {stock} left.",
             send_email_alert=True,
             item_title=base_item["title"],
             stock=stock,
-        )
+        ))
 
     # Fetch updated variant with all images
-    updated_variant = await database.fetch_one(product_variants.select().where(product_variants.c.id == variant_id))
+    updated_variant = await database.fetch_one(select_variants().where(product_variants.c.id == variant_id))
     variant_images_list = await database.fetch_all(
         variant_images.select().where(variant_images.c.variant_id == variant_id).order_by(variant_images.c.display_order)
     )
@@ -1,30 +1,51 @@
-from fastapi import APIRouter, Depends
-from app.database import database
-from app.models import notifications
-from app.deps import get_current_user
-from app.schemas import Message, NotificationRead
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, Query, Response
+from app.crud import get_user_notifications, get_unread_count, mark_notification_read, mark_all_notifications_read
+from app.deps import get_current_user, get_current_admin_user
+from app.notifications import broadcast_notification
+from app.order_search import encode_cursor, decode_cursor
+from app.schemas import Message, NotificationRead, UnreadCount, NotificationBroadcast, NotificationBroadcastResult
 
 router = APIRouter()
 
-@router.get("/notifications", response_model=list[NotificationRead])
-async def get_notifications(current_user=Depends(get_current_user)):
-    query = notifications.select().where(notifications.c.user_id == current_user["id"])
-    return await database.fetch_all(query)
+NOTIFICATIONS_MAX_LIMIT = 100
+
+@router.get("/notifications", response_model=List[NotificationRead])
+async def get_notifications(
+    response: Response,
+    limit: int = Query(20, ge=1, le=NOTIFICATIONS_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    unread_only: bool = False,
+    current_user=Depends(get_current_user),
+):
+    rows = await get_user_notifications(
+        current_user["id"],
+        limit=limit,
+        after=decode_cursor(cursor) if cursor else None,
+        unread_only=unread_only,
+    )
+    # The body stays a plain list; the next page's ?cursor= travels in a header
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+    return rows
+
+@router.get("/notifications/unread-count", response_model=UnreadCount)
+async def get_notifications_unread_count(current_user=Depends(get_current_user)):
+    return {"unread": await get_unread_count(current_user["id"])}
 
 @router.put("/notifications/{notification_id}/read", response_model=Message)
-async def mark_notification_read(notification_id: int, current_user=Depends(get_current_user)):
-    query = notifications.update().where(
-        (notifications.c.id == notification_id) &
-        (notifications.c.user_id == current_user["id"])
-    ).values(is_read=True)
-    await database.execute(query)
+async def mark_notification_read_route(notification_id: int, current_user=Depends(get_current_user)):
+    await mark_notification_read(notification_id, current_user["id"])
     return {"message": "Notification marked as read"}
 
-# ✅ Add your new mark-all endpoint here
 @router.put("/notifications/mark-all-read", response_model=Message)
-async def mark_all_notifications_read(current_user=Depends(get_current_user)):
-    query = notifications.update().where(
-        notifications.c.user_id == current_user["id"]
-    ).values(is_read=True)
-    await database.execute(query)
+async def mark_all_notifications_read_route(current_user=Depends(get_current_user)):
+    await mark_all_notifications_read(current_user["id"])
     return {"message": "All notifications marked as read"}
+
+@router.post("/admin/notifications/broadcast", response_model=NotificationBroadcastResult, dependencies=[Depends(get_current_admin_user)])
+async def broadcast_notification_route(data: NotificationBroadcast):
+    recipients = await broadcast_notification(data.message, data.role)
+    return {"message": f"Notification sent to {recipients} users", "recipients": recipients}
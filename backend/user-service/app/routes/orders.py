@@ -1,13 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Request, Header, BackgroundTasks, Query
+from fastapi.responses import FileResponse, StreamingResponse
+from sqlalchemy import select, text, bindparam
+from typing import List, Optional
 from app.database import database
-from app.models import orders, items, order_items, coupons, addresses, users, product_variants
+from app.models import orders, items, order_items, coupons, addresses, users, product_variants, order_invoices, order_shipments
 from app.deps import get_current_user, get_current_shop_owner, get_current_admin_user
-from app.schemas import OrderCreate, OrderRead, OrderUpdateStatus, Message, OrderItemRead, PaymentInitiateRequest, PhonePeWebhookPayload
-from app.crud import create_notification
-from datetime import datetime, timezone, timedelta
-from app.email_service import send_order_confirmation, send_order_status_notification
+from app.schemas import OrderCreate, OrderRead, OrderUpdateStatus, OrderStatusBatchUpdate, OrderStatusBatchResult, OrderSearchPage, CheckoutAdmissionStats, Message, OrderItemRead, PaymentInitiateRequest, PhonePeWebhookPayload
+from app.crud import create_notification, publish_notifications, upsert_address
+from datetime import date, datetime, timezone, timedelta
+from app.email_service import send_order_confirmation, send_order_status_notification, send_order_status_notifications
+from app.coupon_service import validate_coupon, consume_coupon, compute_discount
+from app.shipping import quote_shipping, get_rate_table
+from app.idempotency import validate_idempotency_key, get_stored_response, claim_idempotency_key, store_response
+from app.invoices import snapshot_invoice, get_invoice_pdf_path
+from app.payments import lock_payment_for_order
+from app.stock_holds import lock_open_holds, attach_holds
+from app.inventory import select_variants, take_stock
+from app.flash_sales import FlashSaleAdmission
+from app.admission import checkout_admission, checkout_slot
+from app.events import publish
+from app.order_export import stream_order_export, export_media_type
+from app.order_search import ORDER_SEARCH_MAX_LIMIT, encode_cursor, decode_cursor, expected_index, build_search_query, explain_search_query, resolve_customer_id
+from app.analytics import record_order_sale
+from app.shipments import create_order_shipments, lock_orders, update_shipment_status, update_shipment_statuses, set_order_status, set_order_statuses
 import asyncio
+import json
 import uuid
 
 
@@ -18,8 +35,12 @@ router = APIRouter()
 # =====================
 # Customer → Create Order (with stock update + low stock notification)
 # =====================
-@router.post("/orders/", response_model=Message)
-async def create_order(order: OrderCreate, current_user=Depends(get_current_user)):
+@router.post("/orders/", response_model=Message, dependencies=[Depends(checkout_slot, scope="function")])
+async def create_order(
+    order: OrderCreate,
+    current_user=Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
     print("Reached create_order endpoint", flush=True)
     print(f"Order data received: {order.dict()}", flush=True)
 
@@ -34,8 +55,40 @@ async def create_order(order: OrderCreate, current_user=Depends(get_current_user
     now_str = now_ist.strftime("%Y-%m-%d %H:%M:%S")
     now = datetime.strptime(now_str, "%Y-%m-%d %H:%M:%S")
 
-    async with database.transaction():
+    # Retried requests with a completed key replay the stored response
+    idempotency_key = validate_idempotency_key(idempotency_key)
+    if idempotency_key:
+        stored_response = await get_stored_response(current_user["id"], idempotency_key)
+        if stored_response is not None:
+            return stored_response
+
+    # Flash-sale units are admitted in memory before the transaction opens, so a slice claim
+    # never needs a second connection, and are handed back unless this order records them
+    flash_quantities = {}
+    for item in order.items:
+        if getattr(item, "variant_id", None):
+            flash_quantities[item.variant_id] = flash_quantities.get(item.variant_id, 0) + item.quantity
+    # Low stock notifications are published to event streams only once the order commits
+    notifications_to_publish = []
+    async with FlashSaleAdmission(flash_quantities) as flash_admission, database.transaction():
+        # Claim the key first so concurrent duplicates wait on this transaction
+        if idempotency_key:
+            stored_response = await claim_idempotency_key(current_user["id"], idempotency_key)
+            if stored_response is not None:
+                return stored_response
+
+        # Payment row first, then its stock holds: the same lock order as the payment worker
+        transaction_id = getattr(order, "transaction_id", None)
+        payment = None
+        open_holds = {}
+        if transaction_id:
+            # Only the customer's own, unused payment; it may already be confirmed by webhook
+            payment = await lock_payment_for_order(transaction_id, current_user["id"])
+            open_holds = await lock_open_holds(transaction_id)
+
         total_order_price = 0
+        total_weight_grams = 0
+        default_item_weight_grams = get_rate_table().default_item_weight_grams
         # Use a list to store item data instead of a map to handle same item_id with different variants
         item_data_list = []
         variant_data_map = {}
@@ -53,9 +106,9 @@ async def create_order(order: OrderCreate, current_user=Depends(get_current_user
                     detail=f"Item {item.item_id} requires a variant selection. Please select color/size."
                 )
             
-            # Fetch variant data (price and stock are here now)
+            # Fetch variant data (price and stock are here now); stock is the live ledger level
             variant_data = await database.fetch_one(
-                product_variants.select().where(product_variants.c.id == item.variant_id)
+                select_variants().where(product_variants.c.id == item.variant_id)
             )
             if not variant_data:
                 raise HTTPException(status_code=404, detail=f"Variant {item.variant_id} not found")
@@ -63,8 +116,11 @@ async def create_order(order: OrderCreate, current_user=Depends(get_current_user
             if variant_data["item_id"] != item.item_id:
                 raise HTTPException(status_code=400, detail=f"Variant {item.variant_id} does not belong to item {item.item_id}")
             
-            # Check variant stock
-            if variant_data["stock"] is not None and variant_data["stock"] < item.quantity:
+            # Check variant stock; units held for this payment were already taken out of it.
+            # Flash-sale variants are checked at admission against the in-memory counters instead.
+            held_quantity = open_holds[item.variant_id]["quantity"] if item.variant_id in open_holds else 0
+            in_flash_sale = flash_admission.sale_for(item.variant_id) is not None
+            if not in_flash_sale and variant_data["stock"] is not None and variant_data["stock"] + held_quantity < item.quantity:
                 raise HTTPException(
                     status_code=400, 
                     detail=f"Not enough stock for {item_data['title']} - {variant_data.get('color', 'selected variant')}. Only {variant_data['stock']} available."
@@ -95,43 +151,30 @@ async def create_order(order: OrderCreate, current_user=Depends(get_current_user
             })
             
             total_order_price += price_to_use * item.quantity
+            total_weight_grams += (variant_data["weight_grams"] or default_item_weight_grams) * item.quantity
             print(f"Using variant {item.variant_id} for item {item.item_id}: stock={stock_to_check}, price={price_to_use}", flush=True)
 
         print(f"Total order price calculated: {total_order_price}", flush=True)
 
         inserted_address_id = None
+        shipping_postal_code = ""
         if hasattr(order, "shipping_address_id") and order.shipping_address_id:
             inserted_address_id = order.shipping_address_id
+            saved_address = await database.fetch_one(
+                addresses.select().where(
+                    (addresses.c.id == inserted_address_id) & (addresses.c.user_id == current_user["id"])
+                )
+            )
+            if not saved_address:
+                raise HTTPException(status_code=404, detail="Shipping address not found")
+            shipping_postal_code = saved_address["postal_code"]
             print(f"Using existing shipping_address_id: {inserted_address_id}", flush=True)
         elif hasattr(order, "shipping_address") and order.shipping_address:
             try:
-                address_values = order.shipping_address.dict()
-                address_values["user_id"] = current_user["id"]
-
-                query = (
-                    addresses.select()
-                    .where(addresses.c.user_id == current_user["id"])
-                    .where(addresses.c.full_name == address_values["full_name"])
-                    .where(addresses.c.phone == address_values["phone"])
-                    .where(addresses.c.address_line1 == address_values["address_line1"])
-                    .where(
-                        (addresses.c.address_line2 == address_values.get("address_line2"))
-                        | ((addresses.c.address_line2.is_(None)) & (address_values.get("address_line2") == ""))
-                    )
-                    .where(addresses.c.city == address_values["city"])
-                    .where(addresses.c.state == address_values["state"])
-                    .where(addresses.c.postal_code == address_values["postal_code"])
-                    .where(addresses.c.country == address_values["country"])
-                )
-                existing_address = await database.fetch_one(query)
-
-                if existing_address:
-                    inserted_address_id = existing_address["id"]
-                    print(f"Reusing existing address with id {inserted_address_id}", flush=True)
-                else:
-                    inserted_address_id = await database.execute(addresses.insert().values(**address_values))
-                    print(f"Saved new shipping address with id {inserted_address_id} for user_id={current_user['id']}", flush=True)
-
+                # Point lookup on (user_id, fingerprint): reuses an identical saved address or inserts it
+                inserted_address_id = await upsert_address(current_user["id"], order.shipping_address.dict())
+                shipping_postal_code = order.shipping_address.postal_code
+                print(f"Using shipping address with id {inserted_address_id} for user_id={current_user['id']}", flush=True)
             except Exception as e:
                 print(f"Failed to save shipping address: {e}", flush=True)
                 raise HTTPException(status_code=500, detail="Failed to save shipping address")
@@ -141,22 +184,29 @@ async def create_order(order: OrderCreate, current_user=Depends(get_current_user
         discount_amount = 0.0
         coupon = None
         if hasattr(order, "coupon_code") and order.coupon_code:
-            coupon = await database.fetch_one(coupons.select().where(coupons.c.code == order.coupon_code))
+            # Same rules as /coupons/redeem: active, validity window, minimum amount, usage limits
+            coupon = await validate_coupon(order.coupon_code, total_order_price, current_user["id"], now)
             print(f"Coupon fetched: {coupon}", flush=True)
-            if coupon:
-                if coupon.discount_type == "percentage":
-                    discount_amount = total_order_price * (coupon.discount_value / 100)
-                elif coupon.discount_type == "fixed":
-                    discount_amount = coupon.discount_value
-                discount_amount = min(discount_amount, total_order_price)
-                print(f"Discount amount calculated: {discount_amount}", flush=True)
-
-        shipping_charge = order.shipping_charge or 0.0
+            discount_amount = compute_discount(coupon, total_order_price)
+            print(f"Discount amount calculated: {discount_amount}", flush=True)
+
+        # Shipping is quoted from in-memory rate tables; the client-sent shipping_charge is not trusted
+        shipping_charge = 0.0
+        if (order.shipping_mode or "delivery") != "pickup":
+            shipping_charge = quote_shipping(
+                shipping_postal_code, total_weight_grams, total_order_price - discount_amount
+            )["charge"]
         print(f"Shipping charge applied: {shipping_charge}", flush=True)
 
         final_total_price = total_order_price - discount_amount + shipping_charge
         print(f"Final total price after discount and shipping: {final_total_price}", flush=True)
-        transaction_id = getattr(order, "transaction_id", None)
+
+        # The payment must cover exactly this order, not a cheaper cart
+        if payment is not None and abs(payment["amount"] - final_total_price) > 0.01:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Payment amount {payment['amount']:.2f} does not match order total {final_total_price:.2f}",
+            )
 
         try:
             order_values = {
@@ -165,18 +215,38 @@ async def create_order(order: OrderCreate, current_user=Depends(get_current_user
                 "total_price": final_total_price,
                 "order_date": now,
                 "shipping_address_id": inserted_address_id,
+                "shipping_charge": shipping_charge,
             }
             if transaction_id:
                 order_values["transaction_id"] = transaction_id
+                order_values["payment_status"] = payment["status"]
             if coupon:
-                order_values["coupon_code"] = coupon.code
+                order_values["coupon_code"] = coupon["code"]
             order_id = await database.execute(orders.insert().values(**order_values))
             print(f"Inserted order with ID: {order_id}", flush=True)
         except Exception as e:
             print(f"Exception inserting order: {e}", flush=True)
             raise
 
-        # Insert order items and update variant stocks - FIXED: Using item_data_list instead of order.items
+        # Units covered by the payment's holds are not taken from stock a second time
+        ordered_quantities = {}
+        for item_data in item_data_list:
+            ordered_quantities[item_data["variant_id"]] = ordered_quantities.get(item_data["variant_id"], 0) + item_data["quantity"]
+        held_quantities = await attach_holds(order_id, open_holds, ordered_quantities) if open_holds else {}
+        quantities_to_take = {
+            variant_id: quantity - held_quantities.get(variant_id, 0)
+            for variant_id, quantity in ordered_quantities.items()
+        }
+        # Flash-sale variants come out of this worker's stock slice without touching the variant row;
+        # units admitted for quantities the payment's holds already cover go back to the counter
+        for variant_id in sorted(quantities_to_take):
+            if flash_admission.sale_for(variant_id) is not None:
+                flash_admission.settle(variant_id, quantities_to_take.pop(variant_id))
+        await flash_admission.record(order_id)
+        # One sale movement per variant, checked under the variant locks; raises 400 if oversold meanwhile
+        stock_left = await take_stock(quantities_to_take, "sale", f"order:{order_id}")
+
+        # Insert order items and send low stock alerts - FIXED: Using item_data_list instead of order.items
         for item_data in item_data_list:
             line_total_price = item_data["price"] * item_data["quantity"]
             
@@ -198,22 +268,16 @@ async def create_order(order: OrderCreate, current_user=Depends(get_current_user
                 print(f"Exception inserting order item id={item_data['item_id']}: {e}", flush=True)
                 raise
             
-            # Update variant stock (stock is only in variants table now)
-            new_stock = item_data["stock"] - item_data["quantity"]
-            
-            try:
-                await database.execute(
-                    product_variants.update()
-                    .where(product_variants.c.id == item_data["variant_id"])
-                    .values(stock=new_stock)
-                )
-                print(f"Updated variant stock for variant_id={item_data['variant_id']} to {new_stock}", flush=True)
-            except Exception as e:
-                print(f"Exception updating variant stock for variant_id={item_data['variant_id']}: {e}", flush=True)
-                raise
+            # Stock left after the sale movement (held units were taken at payment initiation);
+            # no low stock alerts for flash-sale variants, whose stock sits in worker slices
+            if flash_admission.sale_for(item_data["variant_id"]) is not None:
+                new_stock = None
+            else:
+                new_stock = stock_left.get(item_data["variant_id"], item_data["stock"])
+            print(f"Stock for variant_id={item_data['variant_id']} is now {new_stock}", flush=True)
             
             # Send low stock notification if needed
-            if new_stock < LOW_STOCK_THRESHOLD:
+            if new_stock is not None and new_stock < LOW_STOCK_THRESHOLD:
                 try:
                     item_title = item_data["base_data"]["title"]
                     variant = variant_data_map[item_data["variant_id"]]
@@ -227,7 +291,7 @@ async def create_order(order: OrderCreate, current_user=Depends(get_current_user
                     
                     variant_description = f" ({', '.join(variant_info)})" if variant_info else " (selected variant)"
                     
-                    await create_notification(
+                    notifications_to_publish += await create_notification(
                         user_id=item_data["base_data"]["owner_id"],
                         message=f"Low stock alert for '{item_title}{variant_description}' — only {new_stock} left.",
                         send_email_alert=True,
@@ -238,18 +302,10 @@ async def create_order(order: OrderCreate, current_user=Depends(get_current_user
                 except Exception as e:
                     print(f"Exception sending notification for item_id={item_data['item_id']}: {e}", flush=True)
 
-        # Increment coupon usage count atomically if coupon applied
+        # Increment coupon usage count atomically if coupon applied; rolls the order back if the limit was hit
         if coupon:
-            try:
-                new_used_count = (coupon.used_count or 0) + 1
-                await database.execute(
-                    coupons.update()
-                    .where(coupons.c.id == coupon.id)
-                    .values(used_count=new_used_count)
-                )
-                print(f"Coupon usage incremented to {new_used_count}", flush=True)
-            except Exception as e:
-                print(f"Error incrementing coupon usage: {e}", flush=True)
+            await consume_coupon(coupon, current_user["id"], order_id, total_order_price, now)
+            print(f"Coupon {coupon['code']} redemption recorded", flush=True)
 
         # Prepare order summary for emails - FIXED: Using item_data_list
         order_summary_lines = []
@@ -326,8 +382,35 @@ async def create_order(order: OrderCreate, current_user=Depends(get_current_user
                 recipient_role="shopowner"
             )
 
+        # Count the sale in the analytics rollups; commits or rolls back with the order
+        await record_order_sale(now, [
+            (
+                item_data["base_data"]["owner_id"],
+                item_data["item_id"],
+                item_data["variant_id"],
+                item_data["quantity"],
+                item_data["price"] * item_data["quantity"],
+            )
+            for item_data in item_data_list
+        ])
+
+        # One shipment per shop owner, each with its own status
+        owner_subtotals = {}
+        for item_data in item_data_list:
+            owner_id = item_data["base_data"]["owner_id"]
+            owner_subtotals[owner_id] = owner_subtotals.get(owner_id, 0) + item_data["price"] * item_data["quantity"]
+        await create_order_shipments(order_id, current_user["id"], now, owner_subtotals)
+
+        # Freeze the invoice with the amounts actually charged
+        await snapshot_invoice(order_id, discount_amount=discount_amount, shipping_charge=shipping_charge)
+
+        response = {"message": "Order placed successfully"}
+        if idempotency_key:
+            await store_response(current_user["id"], idempotency_key, order_id, response)
+
+    publish_notifications(notifications_to_publish)
     print("Order created successfully", flush=True)
-    return {"message": "Order placed successfully"}
+    return response
 
 
 # # =====================
@@ -342,63 +425,67 @@ async def view_my_orders(current_user=Depends(get_current_user)):
     query = orders.select().where(orders.c.customer_id == current_user["id"])
     order_rows = await database.fetch_all(query)
 
-    orders_with_items = []
-    for order in order_rows:
-        # Fetch order items with complete variant information
-        items_query = (
-            order_items.select()
-            .where(order_items.c.order_id == order.id)
-            .join(items, items.c.id == order_items.c.item_id)
-            .join(product_variants, product_variants.c.id == order_items.c.variant_id, isouter=True)
-            .with_only_columns(
-                order_items.c.id,
-                order_items.c.item_id,
-                order_items.c.quantity,
-                order_items.c.variant_id,
-                items.c.title.label("item_title"),
-                product_variants.c.image_url.label("variant_image_url"),
-                product_variants.c.color.label("variant_color"),
-                product_variants.c.size.label("variant_size"),
-                product_variants.c.price.label("variant_price"),
-                order_items.c.line_total_price,
-            )
+    if not order_rows:
+        return []
+    order_ids = [order.id for order in order_rows]
+
+    # Fetch the items of all orders with complete variant information in one query
+    items_query = (
+        order_items.select()
+        .where(order_items.c.order_id.in_(order_ids))
+        .join(items, items.c.id == order_items.c.item_id)
+        .join(product_variants, product_variants.c.id == order_items.c.variant_id, isouter=True)
+        .with_only_columns(
+            order_items.c.id,
+            order_items.c.order_id,
+            order_items.c.item_id,
+            order_items.c.quantity,
+            order_items.c.variant_id,
+            items.c.title.label("item_title"),
+            product_variants.c.image_url.label("variant_image_url"),
+            product_variants.c.color.label("variant_color"),
+            product_variants.c.size.label("variant_size"),
+            product_variants.c.price.label("variant_price"),
+            order_items.c.line_total_price,
         )
-        item_rows = await database.fetch_all(items_query)
-
-        # Map item_rows to schema dicts
-        item_list = []
-        for item in item_rows:
-            # Build enhanced item title with variant info
-            item_title = item.item_title
-            variant_info = []
-            if item.variant_color:
-                variant_info.append(item.variant_color)
-            if item.variant_size:
-                variant_info.append(item.variant_size)
-            
-            if variant_info:
-                item_title += f" ({', '.join(variant_info)})"
-            
-            item_data = {
-                "id": item.id,
-                "item_id": item.item_id,
-                "quantity": item.quantity,
-                "variant_id": item.variant_id,
-                "item_title": item_title,  # Enhanced title with variant info
-                "image_url": item.variant_image_url,  # Always use variant image
-                "line_total_price": item.line_total_price,
-                "variant_color": item.variant_color,
-                "variant_size": item.variant_size,
-                "variant_price": item.variant_price,
-            }
-            item_list.append(item_data)
-
-        # Fetch shipping address for this order
-        address_query = addresses.select().where(addresses.c.id == order.shipping_address_id)
-        address_row = await database.fetch_one(address_query)
-        shipping_address = None
-        if address_row:
-            shipping_address = {
+        .order_by(order_items.c.id)
+    )
+    item_rows = await database.fetch_all(items_query)
+
+    # Map item_rows to schema dicts
+    items_by_order = {}
+    for item in item_rows:
+        # Build enhanced item title with variant info
+        item_title = item.item_title
+        variant_info = []
+        if item.variant_color:
+            variant_info.append(item.variant_color)
+        if item.variant_size:
+            variant_info.append(item.variant_size)
+        
+        if variant_info:
+            item_title += f" ({', '.join(variant_info)})"
+        
+        items_by_order.setdefault(item.order_id, []).append({
+            "id": item.id,
+            "item_id": item.item_id,
+            "quantity": item.quantity,
+            "variant_id": item.variant_id,
+            "item_title": item_title,  # Enhanced title with variant info
+            "image_url": item.variant_image_url,  # Always use variant image
+            "line_total_price": item.line_total_price,
+            "variant_color": item.variant_color,
+            "variant_size": item.variant_size,
+            "variant_price": item.variant_price,
+        })
+
+    # Fetch the shipping addresses of all orders in one query
+    address_ids = {order.shipping_address_id for order in order_rows if order.shipping_address_id}
+    addresses_by_id = {}
+    if address_ids:
+        address_rows = await database.fetch_all(addresses.select().where(addresses.c.id.in_(address_ids)))
+        for address_row in address_rows:
+            addresses_by_id[address_row.id] = {
                 "id": address_row.id,
                 "user_id": address_row.user_id,
                 "full_name": address_row.full_name,
@@ -414,10 +501,12 @@ async def view_my_orders(current_user=Depends(get_current_user)):
                 "updated_at": address_row.updated_at,
             }
 
-        # Build result dict matching the OrderRead schema
+    # Build result dicts matching the OrderRead schema
+    orders_with_items = []
+    for order in order_rows:
         order_dict = dict(order)
-        order_dict["items"] = item_list
-        order_dict["shipping_address"] = shipping_address
+        order_dict["items"] = items_by_order.get(order.id, [])
+        order_dict["shipping_address"] = addresses_by_id.get(order.shipping_address_id)
         order_dict["total_price"] = order.total_price 
         orders_with_items.append(order_dict)
 
@@ -429,129 +518,123 @@ async def view_my_orders(current_user=Depends(get_current_user)):
 # =====================
 @router.get("/shop-owner/orders", response_model=List[OrderRead])
 async def shop_owner_orders(current_user=Depends(get_current_shop_owner)):
-    # First, fetch all orders that contain items owned by this shop owner
+    # The owner's shipments, newest first: a range scan on (owner_id, order_date)
     orders_query = """
-        SELECT DISTINCT 
-            o.id, o.customer_id, o.total_price, o.status, o.coupon_code, 
-            o.shipping_address_id, o.order_date,
-            owner.username as shop_owner_name  -- Add shop owner name
-        FROM orders o
-        JOIN order_items oi ON oi.order_id = o.id
-        JOIN items i ON oi.item_id = i.id
-        JOIN users owner ON i.owner_id = owner.id  -- Join with users table for shop owner
-        WHERE i.owner_id = :owner_id
-        ORDER BY o.order_date DESC
+        SELECT
+            s.order_id AS id, s.status, s.order_date,
+            o.customer_id, o.total_price, o.coupon_code, o.shipping_address_id,
+            customer.username AS customer_username
+        FROM order_shipments s
+        JOIN orders o ON o.id = s.order_id
+        LEFT JOIN users customer ON customer.id = o.customer_id
+        WHERE s.owner_id = :owner_id
+        ORDER BY s.order_date DESC
     """
     order_rows = await database.fetch_all(query=orders_query, values={"owner_id": current_user["id"]})
-
-    orders_with_items = []
-    for order in order_rows:
-        # Fetch order items with complete variant information for items owned by this shop owner
-        items_query = """
-            SELECT 
-                oi.id,
-                oi.item_id,
-                oi.quantity,
-                oi.variant_id,
-                oi.line_total_price,
-                i.title AS item_title,
-                pv.color AS variant_color,
-                pv.size AS variant_size,
-                pv.price AS variant_price,
-                -- Get the primary variant image (first image by display_order)
-                (SELECT vi.image_url 
-                 FROM variant_images vi 
-                 WHERE vi.variant_id = pv.id 
-                 ORDER BY vi.display_order ASC 
-                 LIMIT 1) AS image_url,
-                owner.username as shop_owner_name,  -- Add shop owner name to items
-                i.owner_id as item_owner_id         -- Add item owner ID
-            FROM order_items oi
-            JOIN items i ON oi.item_id = i.id
-            LEFT JOIN product_variants pv ON oi.variant_id = pv.id
-            JOIN users owner ON i.owner_id = owner.id  -- Join with users table
-            WHERE oi.order_id = :order_id AND i.owner_id = :owner_id
-        """
-        item_rows = await database.fetch_all(
-            query=items_query, 
-            values={"order_id": order.id, "owner_id": current_user["id"]}
+    if not order_rows:
+        return []
+
+    order_ids = [order.id for order in order_rows]
+
+    # Items owned by this shop owner across all of those orders in one query
+    items_query = """
+        SELECT 
+            oi.id,
+            oi.order_id,
+            oi.item_id,
+            oi.quantity,
+            oi.variant_id,
+            oi.line_total_price,
+            i.title AS item_title,
+            pv.color AS variant_color,
+            pv.size AS variant_size,
+            pv.price AS variant_price,
+            -- Get the primary variant image (first image by display_order)
+            (SELECT vi.image_url 
+             FROM variant_images vi 
+             WHERE vi.variant_id = pv.id 
+             ORDER BY vi.display_order ASC 
+             LIMIT 1) AS image_url,
+            i.owner_id as item_owner_id
+        FROM order_items oi
+        JOIN items i ON oi.item_id = i.id
+        LEFT JOIN product_variants pv ON oi.variant_id = pv.id
+        WHERE oi.order_id IN :order_ids AND i.owner_id = :owner_id
+    """
+    item_rows = await database.fetch_all(
+        text(items_query).bindparams(
+            bindparam("order_ids", value=order_ids, expanding=True),
+            owner_id=current_user["id"],
         )
+    )
 
-        # Map item_rows to schema dicts with enhanced item titles
-        item_list = []
-        for item in item_rows:
-            # Build enhanced item title with variant info
-            item_title = item.item_title
-            variant_info = []
-            if item.variant_color:
-                variant_info.append(item.variant_color)
-            if item.variant_size:
-                variant_info.append(item.variant_size)
-            
-            if variant_info:
-                item_title += f" ({', '.join(variant_info)})"
-            
-            item_data = {
-                "id": item.id,
-                "item_id": item.item_id,
-                "quantity": item.quantity,
-                "variant_id": item.variant_id,
-                "item_title": item_title,
-                "image_url": item.image_url,
-                "line_total_price": item.line_total_price,
-                "variant_color": item.variant_color,
-                "variant_size": item.variant_size,
-                "variant_price": item.variant_price,
-                "shop_owner_name": item.shop_owner_name,  # Include shop owner name
-                "item_owner_id": item.item_owner_id,      # Include item owner ID
+    # Map item_rows to schema dicts with enhanced item titles
+    items_by_order = {}
+    for item in item_rows:
+        # Build enhanced item title with variant info
+        item_title = item.item_title
+        variant_info = []
+        if item.variant_color:
+            variant_info.append(item.variant_color)
+        if item.variant_size:
+            variant_info.append(item.variant_size)
+        
+        if variant_info:
+            item_title += f" ({', '.join(variant_info)})"
+        
+        items_by_order.setdefault(item.order_id, []).append({
+            "id": item.id,
+            "item_id": item.item_id,
+            "quantity": item.quantity,
+            "variant_id": item.variant_id,
+            "item_title": item_title,
+            "image_url": item.image_url,
+            "line_total_price": item.line_total_price,
+            "variant_color": item.variant_color,
+            "variant_size": item.variant_size,
+            "variant_price": item.variant_price,
+            "shop_owner_name": current_user["username"],
+            "item_owner_id": item.item_owner_id,
+        })
+
+    # Shipping addresses for all orders in one query
+    address_ids = {order.shipping_address_id for order in order_rows if order.shipping_address_id}
+    addresses_by_id = {}
+    if address_ids:
+        address_rows = await database.fetch_all(addresses.select().where(addresses.c.id.in_(address_ids)))
+        for address_row in address_rows:
+            addresses_by_id[address_row.id] = {
+                "id": address_row.id,
+                "user_id": address_row.user_id,
+                "full_name": address_row.full_name,
+                "phone": address_row.phone,
+                "address_line1": address_row.address_line1,
+                "address_line2": address_row.address_line2,
+                "city": address_row.city,
+                "state": address_row.state,
+                "postal_code": address_row.postal_code,
+                "country": address_row.country,
+                "is_default": address_row.is_default,
+                "created_at": address_row.created_at,
+                "updated_at": address_row.updated_at,
             }
-            item_list.append(item_data)
 
-        # Fetch shipping address for this order
-        shipping_address = None
-        if order.shipping_address_id:
-            address_query = addresses.select().where(addresses.c.id == order.shipping_address_id)
-            address_row = await database.fetch_one(address_query)
-            if address_row:
-                shipping_address = {
-                    "id": address_row.id,
-                    "user_id": address_row.user_id,
-                    "full_name": address_row.full_name,
-                    "phone": address_row.phone,
-                    "address_line1": address_row.address_line1,
-                    "address_line2": address_row.address_line2,
-                    "city": address_row.city,
-                    "state": address_row.state,
-                    "postal_code": address_row.postal_code,
-                    "country": address_row.country,
-                    "is_default": address_row.is_default,
-                    "created_at": address_row.created_at,
-                    "updated_at": address_row.updated_at,
-                }
-
-        # Fetch customer username
-        customer_query = "SELECT username FROM users WHERE id = :customer_id"
-        customer_row = await database.fetch_one(
-            query=customer_query, 
-            values={"customer_id": order.customer_id}
-        )
-
-        # Build result dict matching the OrderRead schema
-        order_dict = {
+    # Build result dicts matching the OrderRead schema; status is this owner's shipment status
+    return [
+        {
             "id": order.id,
             "customer_id": order.customer_id,
             "total_price": order.total_price,
             "status": order.status,
             "coupon_code": order.coupon_code,
-            "customer_username": customer_row["username"] if customer_row else None,
-            "items": item_list,
-            "shipping_address": shipping_address,
+            "customer_username": order.customer_username,
+            "items": items_by_order.get(order.id, []),
+            "shipping_address": addresses_by_id.get(order.shipping_address_id),
             "order_date": order.order_date,
-            "shop_owner_name": order.shop_owner_name,  # Include shop owner name at order level
+            "shop_owner_name": current_user["username"],
         }
-        orders_with_items.append(order_dict)
-
-    return orders_with_items
+        for order in order_rows
+    ]
 
 
 # =====================
@@ -559,25 +642,30 @@ async def shop_owner_orders(current_user=Depends(get_current_shop_owner)):
 # =====================
 @router.put("/shop-owner/orders/{order_id}/status", response_model=Message, dependencies=[Depends(get_current_shop_owner)])
 async def shop_owner_update_order_status(order_id: int, status_data: OrderUpdateStatus, current_user=Depends(get_current_shop_owner)):
-    # Authorize shop owner for this order
-    query = """
-        SELECT 1 FROM order_items oi
-        JOIN items i ON oi.item_id = i.id
-        WHERE oi.order_id = :order_id AND i.owner_id = :owner_id
-        LIMIT 1
-    """
-    authorized = await database.fetch_one(query=query, values={"order_id": order_id, "owner_id": current_user["id"]})
-    if not authorized:
-        raise HTTPException(status_code=403, detail="Not authorized to update this order")
+    async with database.transaction():
+        # Lock the order first (same order as the admin path) so shipment and order status move together
+        existing_order = await database.fetch_one(
+            orders.select().where(orders.c.id == order_id).with_for_update()
+        )
+        if not existing_order:
+            raise HTTPException(status_code=404, detail="Order not found")
 
-    existing_order = await database.fetch_one(orders.select().where(orders.c.id == order_id))
-    if not existing_order:
-        raise HTTPException(status_code=404, detail="Order not found")
+        # Authorize shop owner for this order: a unique-key lookup on (order_id, owner_id)
+        shipment = await database.fetch_one(
+            order_shipments.select().where(
+                (order_shipments.c.order_id == order_id) & (order_shipments.c.owner_id == current_user["id"])
+            )
+        )
+        if not shipment:
+            raise HTTPException(status_code=403, detail="Not authorized to update this order")
 
-    # Update order status
-    await database.execute(
-        orders.update().where(orders.c.id == order_id).values(status=status_data.status)
-    )
+        # Update this owner's shipment; the order status follows its shipments
+        order_status = await update_shipment_status(
+            existing_order, current_user["id"], status_data.status, status_data.tracking_number
+        )
+
+    # The customer sees the order's status, which only moves once every shipment has
+    _publish_order_statuses([existing_order], {order_id: order_status}, {order_id: status_data.tracking_number})
 
     # Send shipping notification email if status is "shipped"
     if status_data.status.lower() in ["processing", "shipped", "delivered", "cancelled"]:
@@ -585,7 +673,7 @@ async def shop_owner_update_order_status(order_id: int, status_data: OrderUpdate
         customer_id = existing_order["customer_id"]
         customer = await database.fetch_one(users.select().where(users.c.id == customer_id))
         if customer:
-            tracking_number = status_data.tracking_number if hasattr(status_data, "tracking_number") else "N/A"
+            tracking_number = status_data.tracking_number or "N/A"
             send_order_status_notification(
                 to_email=customer["email"],
                 order_id=order_id,
@@ -595,6 +683,184 @@ async def shop_owner_update_order_status(order_id: int, status_data: OrderUpdate
 
     return {"message": f"Order {order_id} status updated to {status_data.status}"}
 
+# Statuses the customer is emailed about
+NOTIFY_ORDER_STATUSES = ("processing", "shipped", "delivered", "cancelled")
+
+
+def _publish_order_statuses(order_rows, statuses: dict, tracking_numbers=None):
+    """
+    Pushes the change to the customers' open /events/stream tabs; call after commit.
+    `statuses` maps order_id -> the order's status after the change.
+    """
+    tracking_numbers = tracking_numbers or {}
+    for order in order_rows:
+        publish(order["customer_id"], "order_status", {
+            "order_id": order["id"],
+            "status": statuses[order["id"]],
+            "tracking_number": tracking_numbers.get(order["id"]),
+        })
+
+
+async def _queue_status_notifications(background_tasks: BackgroundTasks, order_ids, status: str, tracking_numbers=None):
+    """
+    Looks up the customers of all orders in one query and queues their status emails
+    as a single batch that runs after the response is sent.
+    """
+    if status.lower() not in NOTIFY_ORDER_STATUSES or not order_ids:
+        return
+    rows = await database.fetch_all(
+        select(orders.c.id, users.c.email)
+        .select_from(orders.join(users, users.c.id == orders.c.customer_id))
+        .where(orders.c.id.in_(list(order_ids)))
+    )
+    tracking_numbers = tracking_numbers or {}
+    background_tasks.add_task(send_order_status_notifications, [
+        {
+            "to_email": row["email"],
+            "order_id": row["id"],
+            "status": status,
+            "tracking_number": tracking_numbers.get(row["id"]),
+        }
+        for row in rows
+        if row["email"]
+    ])
+
+
+# =====================
+# Shop Owner → Bulk Update Order Status
+# =====================
+@router.post("/shop-owner/orders/status:batch", response_model=OrderStatusBatchResult, dependencies=[Depends(get_current_shop_owner)])
+async def shop_owner_update_order_status_batch(
+    batch: OrderStatusBatchUpdate,
+    background_tasks: BackgroundTasks,
+    current_user=Depends(get_current_shop_owner),
+):
+    order_ids = sorted(set(batch.order_ids))
+
+    async with database.transaction():
+        order_rows = await lock_orders(order_ids)
+
+        # Authorize every order at once against this owner's shipments
+        owned = await database.fetch_all(
+            select(order_shipments.c.order_id).where(
+                (order_shipments.c.owner_id == current_user["id"])
+                & (order_shipments.c.order_id.in_(order_ids))
+            )
+        )
+        owned_ids = {row["order_id"] for row in owned}
+        not_owned = [order_id for order_id in order_ids if order_id not in owned_ids]
+        if not_owned:
+            raise HTTPException(
+                status_code=403,
+                detail=f"Not authorized to update orders: {', '.join(map(str, not_owned))}",
+            )
+
+        order_statuses = await update_shipment_statuses(order_rows, current_user["id"], batch.status, batch.tracking_numbers)
+
+    _publish_order_statuses(order_rows, order_statuses, batch.tracking_numbers)
+    await _queue_status_notifications(background_tasks, order_ids, batch.status, batch.tracking_numbers)
+    return {"message": f"{len(order_ids)} orders updated to {batch.status}", "order_ids": order_ids}
+
+
+# =====================
+# Order Export (streamed)
+# =====================
+def _export_response(start: Optional[date], end: Optional[date], format: str, compress: bool, owner_id: Optional[int] = None):
+    IST = timezone(timedelta(hours=5, minutes=30))
+    today = datetime.now(IST).date()
+    end = end or today
+    start = start or end
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+
+    # Whole days, end inclusive
+    range_start = datetime.combine(start, datetime.min.time())
+    range_end = datetime.combine(end + timedelta(days=1), datetime.min.time())
+    filename = f"orders_{start.isoformat()}_{end.isoformat()}.{format}" + (".gz" if compress else "")
+    return StreamingResponse(
+        stream_order_export(range_start, range_end, format, compress, owner_id),
+        media_type=export_media_type(format, compress),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.get("/admin/orders/export", dependencies=[Depends(get_current_admin_user)])
+async def admin_export_orders(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    compress: bool = True,
+):
+    return _export_response(start, end, format, compress)
+
+
+@router.get("/shop-owner/orders/export")
+async def shop_owner_export_orders(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    compress: bool = True,
+    current_user=Depends(get_current_shop_owner),
+):
+    return _export_response(start, end, format, compress, owner_id=current_user["id"])
+
+
+# =====================
+# Admin → Checkout Admission Metrics
+# =====================
+@router.get("/admin/checkout/admission", response_model=CheckoutAdmissionStats, dependencies=[Depends(get_current_admin_user)])
+async def checkout_admission_stats():
+    # Per worker process: each has its own slot budget and queue
+    return checkout_admission.stats()
+
+
+# =====================
+# Admin → Search Orders
+# =====================
+@router.get("/admin/orders/search", dependencies=[Depends(get_current_admin_user)])
+async def admin_search_orders(
+    email: Optional[str] = None,
+    transaction_id: Optional[str] = None,
+    status: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=ORDER_SEARCH_MAX_LIMIT),
+    explain: bool = False,
+):
+    customer_id = None
+    if email:
+        customer_id = await resolve_customer_id(email.strip())
+        if customer_id is None:
+            return OrderSearchPage(orders=[])
+
+    query = build_search_query(
+        transaction_id=transaction_id,
+        customer_id=customer_id,
+        status=status,
+        start=datetime.combine(start, datetime.min.time()) if start else None,
+        end=datetime.combine(end + timedelta(days=1), datetime.min.time()) if end else None,
+        after=decode_cursor(cursor) if cursor else None,
+        limit=limit + 1,  # one extra row tells us whether there is a next page
+    )
+
+    if explain:
+        index = expected_index(transaction_id, customer_id, status)
+        plan = await explain_search_query(query)
+        return {
+            "expected_index": index,
+            "uses_expected_index": any(row.get("key") == index for row in plan),
+            "plan": plan,
+        }
+
+    rows = await database.fetch_all(query)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["order_date"], rows[-1]["id"])
+    return OrderSearchPage(orders=[dict(row) for row in rows], next_cursor=next_cursor)
+
+
 # =====================
 # Admin → View All Orders
 # =====================
@@ -719,177 +985,74 @@ async def admin_list_orders():
 # =====================
 @router.put("/admin/orders/{order_id}", response_model=Message, dependencies=[Depends(get_current_admin_user)])
 async def update_order_status(order_id: int, status_data: OrderUpdateStatus):
-    existing_order = await database.fetch_one(orders.select().where(orders.c.id == order_id))
-    if not existing_order:
-        raise HTTPException(status_code=404, detail="Order not found")
+    async with database.transaction():
+        existing_order = await database.fetch_one(
+            orders.select().where(orders.c.id == order_id).with_for_update()
+        )
+        if not existing_order:
+            raise HTTPException(status_code=404, detail="Order not found")
 
-    await database.execute(
-        orders.update().where(orders.c.id == order_id).values(status=status_data.status)
-    )
+        await set_order_status(existing_order, status_data.status)
+    _publish_order_statuses([existing_order], {order_id: status_data.status}, {order_id: status_data.tracking_number})
     return {"message": f"Order {order_id} status updated to {status_data.status}"}
 
 
 
 
+# =====================
+# Admin → Bulk Update Order Status
+# =====================
+@router.post("/admin/orders/status:batch", response_model=OrderStatusBatchResult, dependencies=[Depends(get_current_admin_user)])
+async def update_order_status_batch(batch: OrderStatusBatchUpdate, background_tasks: BackgroundTasks):
+    order_ids = sorted(set(batch.order_ids))
+
+    async with database.transaction():
+        order_rows = await lock_orders(order_ids)
+        found_ids = {order["id"] for order in order_rows}
+        missing = [order_id for order_id in order_ids if order_id not in found_ids]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Orders not found: {', '.join(map(str, missing))}")
+
+        await set_order_statuses(order_rows, batch.status)
+
+    _publish_order_statuses(order_rows, dict.fromkeys(order_ids, batch.status), batch.tracking_numbers)
+    await _queue_status_notifications(background_tasks, order_ids, batch.status, batch.tracking_numbers)
+    return {"message": f"{len(order_ids)} orders updated to {batch.status}", "order_ids": order_ids}
+
+
 # =====================
 # Customer → Get Order Invoice
 # =====================
 @router.get("/orders/{order_id}/invoice")
 async def get_order_invoice(order_id: int, current_user=Depends(get_current_user)):
-    # Verify the order belongs to the current user
-    order_query = orders.select().where(
-        (orders.c.id == order_id) & 
-        (orders.c.customer_id == current_user["id"])
-    )
-    order = await database.fetch_one(order_query)
-    
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
-
-    # Fetch complete invoice data with variant information
-    invoice_query = """
-    SELECT 
-        o.id as order_id,
-        o.order_date,
-        o.total_price,
-        o.status,
-        o.coupon_code,
-        o.transaction_id,
-        u.username as customer_name,
-        u.email as customer_email,
-        up.contact_number as customer_phone,
-        a.full_name as shipping_name,
-        a.phone as shipping_phone,
-        a.address_line1,
-        a.address_line2,
-        a.city,
-        a.state,
-        a.postal_code,
-        a.country,
-        oi.quantity,
-        oi.line_total_price,
-        oi.variant_id,
-        i.title as item_title,
-        i.description,
-        pv.color as variant_color,
-        pv.size as variant_size,
-        pv.price as variant_price,
-        pv.image_url as variant_image_url,
-        c.discount_type,
-        c.discount_value,
-        c.code as coupon_code
-    FROM orders o
-    LEFT JOIN users u ON o.customer_id = u.id
-    LEFT JOIN user_profiles up ON u.id = up.user_id
-    LEFT JOIN addresses a ON o.shipping_address_id = a.id
-    LEFT JOIN order_items oi ON o.id = oi.order_id
-    LEFT JOIN items i ON oi.item_id = i.id
-    LEFT JOIN product_variants pv ON oi.variant_id = pv.id
-    LEFT JOIN coupons c ON o.coupon_code = c.code
-    WHERE o.id = :order_id
-    """
-    
-    rows = await database.fetch_all(invoice_query, values={"order_id": order_id})
-    
-    if not rows:
-        raise HTTPException(status_code=404, detail="Invoice data not found")
-
-    # Structure the invoice data
-    invoice_data = {
-        "order_id": rows[0]["order_id"],
-        "order_date": rows[0]["order_date"],
-        "total_price": float(rows[0]["total_price"]),
-        "status": rows[0]["status"],
-        "transaction_id": rows[0]["transaction_id"],
-        "customer": {
-            "name": rows[0]["customer_name"],
-            "email": rows[0]["customer_email"],
-            "phone": rows[0]["customer_phone"]
-        },
-        "shipping_address": {
-            "full_name": rows[0]["shipping_name"],
-            "phone": rows[0]["shipping_phone"],
-            "address_line1": rows[0]["address_line1"],
-            "address_line2": rows[0]["address_line2"] or "",
-            "city": rows[0]["city"],
-            "state": rows[0]["state"],
-            "postal_code": rows[0]["postal_code"],
-            "country": rows[0]["country"]
-        },
-        "items": [],
-        "coupon": None,
-        "subtotal": 0.0,
-        "discount_amount": 0.0,
-        "shipping_charge": 0.0  # Will be calculated
-    }
-
-    # Calculate subtotal from items
-    subtotal = 0
-
-    # Add items with variant information
-    for row in rows:
-        if row["item_title"]:  # Only add if there's an item
-            # Build item title with variant information
-            item_title = row["item_title"]
-            variant_info = []
-            
-            if row["variant_color"]:
-                variant_info.append(row["variant_color"])
-            if row["variant_size"]:
-                variant_info.append(row["variant_size"])
-            
-            if variant_info:
-                item_title += f" ({', '.join(variant_info)})"
-            
-            # Use variant price (this is the actual price used in the order)
-            unit_price = float(row["variant_price"])
-            line_total = float(row["line_total_price"])
-            subtotal += line_total
-
-            # Use variant image if available, otherwise fallback
-            image_url = row["variant_image_url"]
+    document = await _get_invoice_document(order_id, current_user["id"])
+    return document
 
-            invoice_data["items"].append({
-                "item_title": item_title,
-                "description": row["description"],
-                "image_url": image_url,
-                "unit_price": unit_price,
-                "quantity": row["quantity"],
-                "line_total_price": line_total,
-                "variant_id": row["variant_id"],
-                "variant_color": row["variant_color"],
-                "variant_size": row["variant_size"]
-            })
 
-    # Update subtotal
-    invoice_data["subtotal"] = subtotal
+@router.get("/orders/{order_id}/invoice.pdf")
+async def get_order_invoice_pdf(order_id: int, current_user=Depends(get_current_user)):
+    document = await _get_invoice_document(order_id, current_user["id"])
+    path = await get_invoice_pdf_path(document)
+    return FileResponse(path, media_type="application/pdf", filename=f"invoice_{order_id}.pdf")
 
-    # Add coupon info if exists
-    if rows[0]["coupon_code"]:
-        invoice_data["coupon"] = {
-            "code": rows[0]["coupon_code"],
-            "discount_type": rows[0]["discount_type"],
-            "discount_value": float(rows[0]["discount_value"])
-        }
 
-        # Calculate discount amount for display
-        if rows[0]["discount_type"] == "percentage":
-            discount_amount = subtotal * (float(rows[0]["discount_value"]) / 100)
-        else:  # fixed
-            discount_amount = float(rows[0]["discount_value"])
-        
-        invoice_data["discount_amount"] = discount_amount
+async def _get_invoice_document(order_id: int, customer_id: int) -> dict:
+    # Ownership check, live status and the stored snapshot in one primary-key lookup
+    row = await database.fetch_one(
+        select(orders.c.status, order_invoices.c.document)
+        .select_from(orders.outerjoin(order_invoices, order_invoices.c.order_id == orders.c.id))
+        .where((orders.c.id == order_id) & (orders.c.customer_id == customer_id))
+    )
+    if not row:
+        raise HTTPException(status_code=404, detail="Order not found")
 
-        # Calculate shipping charge as the difference between total and (subtotal - discount)
-        calculated_total_after_discount = subtotal - discount_amount
-        actual_total = float(rows[0]["total_price"])
-        shipping_charge = actual_total - calculated_total_after_discount
-        invoice_data["shipping_charge"] = max(0.0, shipping_charge)
+    if row["document"]:
+        document = json.loads(row["document"])
     else:
-        # Calculate shipping charge when no coupon
-        actual_total = float(rows[0]["total_price"])
-        shipping_charge = actual_total - subtotal
-        invoice_data["shipping_charge"] = max(0.0, shipping_charge)
-        invoice_data["discount_amount"] = 0.0
+        # Orders placed before snapshots existed are frozen on first request
+        document = await snapshot_invoice(order_id)
+        if document is None:
+            raise HTTPException(status_code=404, detail="Invoice data not found")
 
-    return invoice_data
\ No newline at end of file
+    document["status"] = row["status"]
+    return document
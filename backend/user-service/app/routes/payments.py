@@ -0,0 +1,115 @@
+import json
+import uuid
+from urllib.parse import urlencode
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from pydantic import ValidationError
+
+from app.auth import now_ist_naive
+from app.database import database
+from app.deps import get_current_user
+from app.models import payment_transactions
+from app.schemas import PaymentInitiateRequest, PhonePeWebhookPayload, PaymentStatusRead, Message
+from app.payments import PAYMENT_GATEWAY_URL, PAYMENT_WEBHOOK_SECRET, normalize_payment_status, verify_signature, ingest_webhook
+from app.stock_holds import place_holds, schedule_hold_expiry
+from app.admission import checkout_slot
+
+router = APIRouter()
+
+
+# =====================
+# Customer → Start Payment
+# =====================
+@router.post("/payment/phonepe/initiate", dependencies=[Depends(checkout_slot, scope="function")])
+async def initiate_payment(payment: PaymentInitiateRequest, current_user=Depends(get_current_user)):
+    if payment.amount <= 0:
+        raise HTTPException(status_code=400, detail="Amount must be positive")
+
+    quantities = {}
+    for item in payment.items or []:
+        if not item.variant_id:
+            raise HTTPException(status_code=400, detail=f"Item {item.item_id} requires a variant selection")
+        if item.quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity must be positive")
+        quantities[item.variant_id] = quantities.get(item.variant_id, 0) + item.quantity
+
+    transaction_id = f"TXN{uuid.uuid4().hex[:24].upper()}"
+    now = now_ist_naive()
+    hold_expires_at = None
+    async with database.transaction():
+        await database.execute(
+            payment_transactions.insert().values(
+                transaction_id=transaction_id,
+                customer_id=current_user["id"],
+                merchant_order_ref=payment.orderId,
+                amount=payment.amount,
+                status="INITIATED",
+                created_at=now,
+                updated_at=now,
+            )
+        )
+        # Stock is held until the webhook commits or releases it, or the hold times out
+        if quantities:
+            hold_expires_at = await place_holds(transaction_id, quantities)
+    if hold_expires_at:
+        schedule_hold_expiry(transaction_id, hold_expires_at)
+
+    query = urlencode({
+        "amount": payment.amount,
+        "callbackUrl": payment.callbackUrl,
+        "redirectUrl": payment.redirectUrl,
+    })
+    return {
+        "success": True,
+        "transactionId": transaction_id,
+        "redirectUrl": f"{PAYMENT_GATEWAY_URL}/pay/{transaction_id}?{query}",
+        "holdExpiresAt": hold_expires_at.isoformat() if hold_expires_at else None,
+    }
+
+
+# =====================
+# Gateway → Webhook (acknowledged once queued)
+# =====================
+@router.post("/payment/phonepe/webhook", response_model=Message)
+async def payment_webhook(request: Request):
+    if not PAYMENT_WEBHOOK_SECRET:
+        # Fail closed: without a secret no signature can be checked
+        raise HTTPException(status_code=503, detail="Payment webhooks are not configured")
+    body = await request.body()
+    if not verify_signature(body, request.headers.get("X-VERIFY")):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+
+    try:
+        data = json.loads(body)
+        payload = PhonePeWebhookPayload(**data)
+    except (ValueError, TypeError, ValidationError):
+        raise HTTPException(status_code=400, detail="Invalid webhook payload")
+
+    status = normalize_payment_status(payload.status)
+    if status is None:
+        raise HTTPException(status_code=400, detail=f"Unknown payment status: {payload.status}")
+
+    # Only the queue write happens here; the payment worker applies it to orders
+    await ingest_webhook(payload.transactionId, status, data)
+    return {"message": "accepted"}
+
+
+# =====================
+# Customer → Payment Status
+# =====================
+@router.get("/payment/phonepe/status/{transaction_id}", response_model=PaymentStatusRead)
+async def payment_status(transaction_id: str, current_user=Depends(get_current_user)):
+    payment = await database.fetch_one(
+        payment_transactions.select().where(
+            (payment_transactions.c.transaction_id == transaction_id)
+            & (payment_transactions.c.customer_id == current_user["id"])
+        )
+    )
+    if not payment:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    return {
+        "transactionId": payment["transaction_id"],
+        "status": payment["status"],
+        "amount": payment["amount"],
+        "orderId": payment["merchant_order_ref"],
+    }
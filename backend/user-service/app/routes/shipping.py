@@ -0,0 +1,19 @@
+from fastapi import APIRouter, Query
+from typing import Optional
+from app.schemas import ShippingQuote
+from app.shipping import quote_shipping, get_rate_table
+
+router = APIRouter()
+
+# =====================
+# Public → shipping quote (in-memory rate tables, no DB access)
+# =====================
+@router.get("/shipping/quote", response_model=ShippingQuote)
+async def get_shipping_quote(
+    postal_code: str = Query(..., min_length=3, max_length=10),
+    weight_grams: Optional[int] = Query(None, ge=0),
+    subtotal: Optional[float] = Query(None, ge=0),
+):
+    if weight_grams is None:
+        weight_grams = get_rate_table().default_item_weight_grams
+    return quote_shipping(postal_code, weight_grams, subtotal)
@@ -1,13 +1,48 @@
+import os
+import time
+from collections import OrderedDict
+
 from fastapi import APIRouter, Depends, HTTPException
 from typing import List
 from app.database import database
-from app.models import wishlist, items, product_variants, variant_images
+from app.models import wishlist, items
 from app.deps import get_current_user
-from app.schemas import WishlistCreate, WishlistRead, Message
+from app.schemas import WishlistCreate, WishlistRead, WishlistContainsRequest, WishlistContainsResponse, Message
 from sqlalchemy import select
 
 router = APIRouter()
 
+# Short TTL: wishlist edits made through other workers show up within this window
+WISHLIST_CACHE_TTL_SECONDS = float(os.getenv("WISHLIST_CACHE_TTL_SECONDS", 30))
+WISHLIST_CACHE_MAX_USERS = int(os.getenv("WISHLIST_CACHE_MAX_USERS", 10000))
+
+# customer_id -> (expires_at on the monotonic clock, frozenset of item ids), least recently used first
+_wishlist_cache = OrderedDict()
+
+
+# =====================
+# Wishlist id cache
+# =====================
+async def _get_wishlist_item_ids(customer_id: int) -> frozenset:
+    now = time.monotonic()
+    entry = _wishlist_cache.get(customer_id)
+    if entry and entry[0] > now:
+        _wishlist_cache.move_to_end(customer_id)
+        return entry[1]
+
+    rows = await database.fetch_all(select(wishlist.c.item_id).where(wishlist.c.customer_id == customer_id))
+    item_ids = frozenset(row["item_id"] for row in rows)
+    _wishlist_cache[customer_id] = (now + WISHLIST_CACHE_TTL_SECONDS, item_ids)
+    _wishlist_cache.move_to_end(customer_id)
+    while len(_wishlist_cache) > WISHLIST_CACHE_MAX_USERS:
+        _wishlist_cache.popitem(last=False)
+    return item_ids
+
+
+def _invalidate_wishlist_cache(customer_id: int):
+    _wishlist_cache.pop(customer_id, None)
+
+
 # =====================
 # Customer → Add to Wishlist
 # =====================
@@ -34,84 +69,90 @@ async def add_to_wishlist(data: WishlistCreate, current_user=Depends(get_current
     await database.execute(
         wishlist.insert().values(customer_id=current_user["id"], item_id=data.item_id)
     )
+    _invalidate_wishlist_cache(current_user["id"])
     return {"message": "Item added to wishlist"}
 
 # =====================
-# Customer → View Wishlist (simple approach)
+# Customer → View Wishlist
 # =====================
+# One pass: each wishlisted item with its first variant (lowest id) and that
+# variant's first image, picked with ROW_NUMBER over the customer's items only.
+WISHLIST_QUERY = """
+    SELECT
+        w.id,
+        w.customer_id,
+        w.item_id,
+        i.title,
+        i.description,
+        i.owner_id,
+        fv.price,
+        fv.color,
+        fv.size,
+        fi.image_url
+    FROM wishlist w
+    JOIN items i ON i.id = w.item_id
+    LEFT JOIN (
+        SELECT pv.id, pv.item_id, pv.price, pv.color, pv.size,
+               ROW_NUMBER() OVER (PARTITION BY pv.item_id ORDER BY pv.id) AS rn
+        FROM product_variants pv
+        WHERE pv.item_id IN (SELECT item_id FROM wishlist WHERE customer_id = :customer_id)
+    ) fv ON fv.item_id = w.item_id AND fv.rn = 1
+    LEFT JOIN (
+        SELECT vi.variant_id, vi.image_url,
+               ROW_NUMBER() OVER (PARTITION BY vi.variant_id ORDER BY vi.display_order, vi.id) AS rn
+        FROM variant_images vi
+        JOIN product_variants pv ON pv.id = vi.variant_id
+        WHERE pv.item_id IN (SELECT item_id FROM wishlist WHERE customer_id = :customer_id)
+    ) fi ON fi.variant_id = fv.id AND fi.rn = 1
+    WHERE w.customer_id = :customer_id
+    ORDER BY w.id
+"""
+
+
 @router.get("/wishlist/", response_model=List[WishlistRead])
 async def get_my_wishlist(current_user=Depends(get_current_user)):
     if current_user["role"] != "customer":
         raise HTTPException(status_code=403, detail="Only customers can view wishlist")
 
-    # First get wishlist items
-    wishlist_query = """
-        SELECT w.id, w.customer_id, w.item_id
-        FROM wishlist w
-        WHERE w.customer_id = :customer_id
-        ORDER BY w.id
-    """
-    wishlist_items = await database.fetch_all(
-        wishlist_query, 
-        values={"customer_id": current_user["id"]}
-    )
+    rows = await database.fetch_all(WISHLIST_QUERY, values={"customer_id": current_user["id"]})
 
     wishlist_response = []
-    for wishlist_item in wishlist_items:
-        # Get item details with first variant info
-        item_query = """
-            SELECT 
-                i.title,
-                i.description,
-                i.owner_id,
-                pv.price,
-                pv.color,
-                pv.size,
-                (SELECT vi.image_url 
-                 FROM variant_images vi 
-                 WHERE vi.variant_id = pv.id 
-                 ORDER BY vi.display_order ASC 
-                 LIMIT 1) as image_url
-            FROM items i
-            LEFT JOIN product_variants pv ON i.id = pv.item_id
-            WHERE i.id = :item_id
-            ORDER BY pv.id
-            LIMIT 1
-        """
-        item_data = await database.fetch_one(
-            item_query, 
-            values={"item_id": wishlist_item["item_id"]}
-        )
+    for row in rows:
+        # Build enhanced item title with variant info
+        item_title = row["title"]
+        variant_info = [value for value in (row["color"], row["size"]) if value]
+        if variant_info:
+            item_title += f" ({', '.join(variant_info)})"
 
-        if item_data:
-            # Build enhanced item title with variant info
-            item_title = item_data["title"]
-            variant_info = []
-            if item_data["color"]:
-                variant_info.append(item_data["color"])
-            if item_data["size"]:
-                variant_info.append(item_data["size"])
-            
-            if variant_info:
-                item_title += f" ({', '.join(variant_info)})"
-            
-            wishlist_response.append({
-                "id": wishlist_item["id"],
-                "customer_id": wishlist_item["customer_id"],
-                "item": {
-                    "id": wishlist_item["item_id"],
-                    "title": item_title,
-                    "description": item_data["description"],
-                    "price": item_data["price"],  # This might be None if no variants exist
-                    "image_url": item_data["image_url"],
-                    "owner_id": item_data["owner_id"],
-                    "variant_color": item_data["color"],
-                    "variant_size": item_data["size"],
-                }
-            })
+        wishlist_response.append({
+            "id": row["id"],
+            "customer_id": row["customer_id"],
+            "item": {
+                "id": row["item_id"],
+                "title": item_title,
+                "description": row["description"],
+                "price": row["price"],  # None if the item has no variants
+                "image_url": row["image_url"],
+                "owner_id": row["owner_id"],
+                "variant_color": row["color"],
+                "variant_size": row["size"],
+            }
+        })
 
     return wishlist_response
 
+# =====================
+# Customer → Which of these items are wishlisted?
+# =====================
+@router.post("/wishlist/contains", response_model=WishlistContainsResponse)
+async def wishlist_contains(data: WishlistContainsRequest, current_user=Depends(get_current_user)):
+    """Marks hearts on a catalog page: returns the given item ids that are in the wishlist."""
+    if current_user["role"] != "customer":
+        raise HTTPException(status_code=403, detail="Only customers can view wishlist")
+
+    item_ids = await _get_wishlist_item_ids(current_user["id"])
+    return {"item_ids": [item_id for item_id in dict.fromkeys(data.item_ids) if item_id in item_ids]}
+
 # =====================
 # Customer → Remove from Wishlist
 # =====================
@@ -128,5 +169,6 @@ async def remove_from_wishlist(wishlist_id: int, current_user=Depends(get_curren
 
     if result == 0:
         raise HTTPException(status_code=404, detail="Wishlist item not found")
+    _invalidate_wishlist_cache(current_user["id"])
 
     return {"message": "Item removed from wishlist"}
\ No newline at end of file
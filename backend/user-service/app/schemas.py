@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr, Field, constr
+from pydantic import BaseModel, EmailStr, Field, StringConstraints, constr
 from typing import Optional, List, Annotated, Dict
 from datetime import datetime, date
 
@@ -162,6 +162,7 @@ class ProductVariantBase(BaseModel):
     price: Optional[float] = Field(None, ge=0)      # nullable, fallback to base item price
     stock: Optional[int] = Field(0, ge=0)
     image_url: Optional[str] = None
+    weight_grams: Optional[int] = Field(None, ge=0)  # shipping weight; None uses the rate table default
 
 
 class ProductVariantCreate(ProductVariantBase):
@@ -298,7 +299,8 @@ class OrderCreate(BaseModel):
     coupon_code: Optional[str] = None
     shipping_address: Optional[AddressCreate] = None  # Make optional since we have shipping_address_id
     shipping_address_id: Optional[int] = None  # Add this field
-    shipping_charge: Optional[float] = 0.0
+    shipping_charge: Optional[float] = 0.0  # ignored: shipping is quoted server-side by app.shipping
+    shipping_mode: Optional[str] = "delivery"  # "delivery" or "pickup" (no shipping charge)
     transaction_id: Optional[str] = None
 
 class OrderRead(BaseModel):
@@ -316,8 +318,61 @@ class OrderRead(BaseModel):
     class Config:
         from_attributes = True
 
+# Stored lowercase; "Cancelled" and "cancelled" must mean the same to stock and rollups
+OrderStatusStr = Annotated[
+    str,
+    StringConstraints(strip_whitespace=True, to_lower=True, pattern="(?i)^(pending|processing|shipped|delivered|cancelled)$"),
+]
+
 class OrderUpdateStatus(BaseModel):
-    status: str
+    status: OrderStatusStr
+    tracking_number: Optional[str] = None  # stored on the shop owner's shipment
+
+
+class OrderStatusBatchUpdate(BaseModel):
+    order_ids: List[int] = Field(..., min_length=1, max_length=1000)
+    status: OrderStatusStr
+    tracking_numbers: Optional[Dict[int, str]] = None  # order_id -> tracking number
+
+
+class OrderStatusBatchResult(BaseModel):
+    message: str
+    order_ids: List[int]
+
+
+class OrderSearchRow(BaseModel):
+    id: int
+    order_date: Optional[datetime] = None
+    status: Optional[str] = None
+    total_price: float
+    shipping_charge: Optional[float] = None
+    coupon_code: Optional[str] = None
+    transaction_id: Optional[str] = None
+    customer_id: int
+    customer_username: Optional[str] = None
+    customer_email: Optional[str] = None
+
+
+class OrderSearchPage(BaseModel):
+    orders: List[OrderSearchRow]
+    next_cursor: Optional[str] = None  # pass back as ?cursor= for the next page
+
+
+class ShippingQuote(BaseModel):
+    postal_code: str
+    zone: str
+    weight_grams: int
+    charge: float
+
+
+class SalesRollupRead(BaseModel):
+    bucket: datetime  # start of the hour or day
+    owner_id: int
+    item_id: Optional[int] = None  # None on owner/site totals
+    variant_id: Optional[int] = None  # None on owner and item totals
+    revenue: float
+    units: int
+    orders: int
 
 
 # ========================= 
@@ -329,12 +384,19 @@ class PaymentInitiateRequest(BaseModel):
     customerId: str
     callbackUrl: str
     redirectUrl: str
+    items: Optional[List[OrderItemBase]] = None  # cart lines whose stock is held until the payment resolves
 
 class PhonePeWebhookPayload(BaseModel):
     transactionId: str
     status: str
     # add other fields as per webhook request
 
+class PaymentStatusRead(BaseModel):
+    transactionId: str
+    status: str  # INITIATED, PENDING, SUCCESS or FAILED
+    amount: float
+    orderId: Optional[str] = None
+
 # =========================
 # Wishlist Schemas
 # =========================
@@ -366,6 +428,12 @@ class WishlistRead(BaseModel):
     class Config:
         from_attributes = True
 
+class WishlistContainsRequest(BaseModel):
+    item_ids: List[int] = Field(..., max_length=500)
+
+class WishlistContainsResponse(BaseModel):
+    item_ids: List[int]  # the requested ids that are in the wishlist
+
 
 # =========================
 # Generic Message Schema
@@ -407,6 +475,17 @@ class NotificationRead(BaseModel):
         from_attributes = True
 
 
+class UnreadCount(BaseModel):
+    unread: int
+
+class NotificationBroadcast(BaseModel):
+    message: str = Field(..., min_length=1, max_length=500)
+    role: Optional[str] = Field(None, pattern="^(customer|shopowner|admin)$")  # everyone when omitted
+
+class NotificationBroadcastResult(BaseModel):
+    message: str
+    recipients: int
+
 class NotificationCreate(BaseModel):
     user_id: int
     message: str
@@ -455,6 +534,8 @@ class CouponBase(BaseModel):
     end_at: Optional[datetime] = None
     min_order_amount: Optional[float] = 0
     max_uses: Optional[int] = 0  # 0 means unlimited
+    per_user_limit: Optional[int] = 0  # 0 means unlimited per customer
+    public: bool = True  # false keeps the code out of best-coupon suggestions
 
 class CouponCreate(CouponBase):
     pass
@@ -468,6 +549,8 @@ class CouponUpdate(BaseModel):
     end_at: Optional[datetime] = None
     min_order_amount: Optional[float] = None
     max_uses: Optional[int] = None
+    per_user_limit: Optional[int] = None
+    public: Optional[bool] = None  # null leaves it unchanged, like omitting it
 
 class CouponRead(CouponBase):
     id: int
@@ -477,4 +560,60 @@ class CouponRead(CouponBase):
     updated_at: Optional[datetime] = None
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+
+class CouponBatchCreate(BaseModel):
+    count: int = Field(..., ge=1, le=1_000_000)
+    prefix: Optional[str] = Field("", max_length=16)
+    length: int = Field(10, ge=4, le=32)  # random characters after the prefix
+    alphabet: str = Field("ABCDEFGHJKLMNPQRSTUVWXYZ23456789", min_length=2)  # no 0/O/1/I lookalikes
+    description: Optional[str] = None
+    discount_type: str  # "percentage" or "fixed"
+    discount_value: float = Field(..., ge=0)
+    active: Optional[bool] = True
+    start_at: Optional[datetime] = None
+    end_at: Optional[datetime] = None
+    min_order_amount: Optional[float] = 0
+    max_uses: Optional[int] = 1  # single-use by default
+    per_user_limit: Optional[int] = 0
+
+
+class BestCouponRead(BaseModel):
+    cart_total: float
+    coupon: Optional[CouponRead] = None
+    discount_amount: float = 0.0
+    total_after_discount: float
+
+
+class FlashSaleCreate(BaseModel):
+    variant_id: int
+    starts_at: datetime  # IST
+    ends_at: datetime
+    slice_size: Optional[int] = Field(None, ge=1, le=10_000)  # units per worker claim; server default if omitted
+
+
+class FlashSaleRead(BaseModel):
+    id: int
+    variant_id: int
+    starts_at: datetime
+    ends_at: datetime
+    slice_size: int
+    status: str
+    units_allocated: int  # claimed into worker slices so far
+    units_sold: int
+    units_released: Optional[int] = None  # set once reconciled
+    reconciled_at: Optional[datetime] = None
+
+
+class CheckoutAdmissionStats(BaseModel):
+    max_concurrent: int
+    max_queue: int
+    active: int  # checkouts holding a slot
+    queued: int
+    admitted: int
+    rejected_queue_full: int
+    rejected_timeout: int
+    wait_p50_ms: float  # over the last 1000 admissions
+    wait_p99_ms: float
+    service_time_ms: float  # moving average of time a checkout holds its slot
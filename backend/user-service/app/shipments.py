@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import select, func, case
+
+from app.analytics import apply_shipment_status_changes
+from app.auth import now_ist_naive
+from app.database import database
+from app.models import orders, order_shipments
+from app.stock_holds import restore_cancelled_stock
+
+# How far an order has progressed; an order is only as far along as its slowest shipment
+ORDER_STATUS_PROGRESSION = ("pending", "processing", "shipped", "delivered")
+
+SHIPMENT_BACKFILL_BATCH_SIZE = 10000
+
+
+def derive_order_status(statuses) -> str:
+    """
+    Order-level status from its shipments: cancelled only when every shipment is,
+    otherwise the least advanced of the remaining ones.
+    """
+    active = [(s or "pending").lower() for s in statuses if (s or "").lower() != "cancelled"]
+    if not active:
+        return "cancelled"
+    return min(
+        active,
+        key=lambda s: ORDER_STATUS_PROGRESSION.index(s) if s in ORDER_STATUS_PROGRESSION else 0,
+    )
+
+
+# =====================
+# Writes
+# =====================
+async def create_order_shipments(order_id: int, customer_id: int, order_date: datetime, owner_subtotals: dict):
+    """
+    One shipment per shop owner in a new order; call inside the create_order transaction.
+    `owner_subtotals` maps owner_id -> that owner's line total.
+    """
+    if not owner_subtotals:
+        return
+    await database.execute(
+        order_shipments.insert().values([
+            {
+                "order_id": order_id,
+                "owner_id": owner_id,
+                "customer_id": customer_id,
+                "status": "pending",
+                "order_date": order_date,
+                "subtotal": subtotal,
+                "updated_at": order_date,
+            }
+            for owner_id, subtotal in sorted(owner_subtotals.items())
+        ])
+    )
+
+
+async def lock_orders(order_ids) -> list:
+    """
+    Reads orders FOR UPDATE in id order, so concurrent status changes lock rows in the
+    same sequence; call inside a transaction before touching their shipments.
+    """
+    return await database.fetch_all(
+        orders.select().where(orders.c.id.in_(list(order_ids))).order_by(orders.c.id).with_for_update()
+    )
+
+
+def _is_cancelled(status: Optional[str]) -> bool:
+    return (status or "").lower() == "cancelled"
+
+
+def _reject_uncancel(order_ids, status: str):
+    # A cancellation already returned its stock and left the sales rollups; reopening it
+    # would sell those units again without taking them, so cancelled is final
+    if order_ids and not _is_cancelled(status):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Cancelled orders cannot be reopened: {', '.join(map(str, sorted(set(order_ids))))}",
+        )
+
+
+async def _shipment_statuses(order_ids, owner_id: Optional[int] = None) -> list:
+    # (order_id, owner_id, status) before a change, so stock and rollups move exactly once per shipment
+    query = (
+        select(order_shipments.c.order_id, order_shipments.c.owner_id, order_shipments.c.status)
+        .where(order_shipments.c.order_id.in_(order_ids))
+    )
+    if owner_id is not None:
+        query = query.where(order_shipments.c.owner_id == owner_id)
+    return [(row["order_id"], row["owner_id"], row["status"]) for row in await database.fetch_all(query)]
+
+
+async def _sync_order_statuses(order_rows) -> dict:
+    """
+    Re-derives each order's status from its shipments, writing one UPDATE per
+    resulting status. Returns order_id -> status. The sales rollups follow the
+    shipments themselves, not the derived status.
+    """
+    rows = await database.fetch_all(
+        select(order_shipments.c.order_id, order_shipments.c.status)
+        .where(order_shipments.c.order_id.in_([order["id"] for order in order_rows]))
+    )
+    statuses_by_order = {}
+    for row in rows:
+        statuses_by_order.setdefault(row["order_id"], []).append(row["status"])
+
+    order_statuses = {}
+    changed = []
+    for order in order_rows:
+        if order["id"] not in statuses_by_order:
+            order_statuses[order["id"]] = order["status"]
+            continue
+        order_status = derive_order_status(statuses_by_order[order["id"]])
+        order_statuses[order["id"]] = order_status
+        if order_status != order["status"]:
+            changed.append((order, order_status))
+
+    ids_by_status = {}
+    for order, order_status in changed:
+        ids_by_status.setdefault(order_status, []).append(order["id"])
+    for order_status, order_ids in ids_by_status.items():
+        await database.execute(orders.update().where(orders.c.id.in_(order_ids)).values(status=order_status))
+    return order_statuses
+
+
+async def update_shipment_statuses(order_rows, owner_id: int, status: str, tracking_numbers: Optional[dict] = None) -> dict:
+    """
+    Sets one owner's shipments in several orders to `status` in a single UPDATE, then
+    re-derives the order statuses. `order_rows` come from lock_orders.
+    `tracking_numbers` maps order_id -> tracking number. Returns order_id -> order status.
+    Cancelled shipments stay cancelled; moving one elsewhere fails with 400.
+    """
+    order_ids = [order["id"] for order in order_rows]
+    before = await _shipment_statuses(order_ids, owner_id)
+    _reject_uncancel([order_id for order_id, _, old_status in before if _is_cancelled(old_status)], status)
+    if _is_cancelled(status):
+        await restore_cancelled_stock(
+            [(order_id, owner) for order_id, owner, old_status in before if not _is_cancelled(old_status)]
+        )
+
+    values = {"status": status, "updated_at": now_ist_naive()}
+    if tracking_numbers:
+        values["tracking_number"] = case(
+            tracking_numbers, value=order_shipments.c.order_id, else_=order_shipments.c.tracking_number
+        )
+    await database.execute(
+        order_shipments.update()
+        .where(order_shipments.c.owner_id == owner_id)
+        .where(order_shipments.c.order_id.in_(order_ids))
+        .values(**values)
+    )
+    orders_by_id = {order["id"]: order for order in order_rows}
+    await apply_shipment_status_changes(
+        [(orders_by_id[order_id], owner, old_status, status) for order_id, owner, old_status in before]
+    )
+    return await _sync_order_statuses(order_rows)
+
+
+async def update_shipment_status(order, owner_id: int, status: str, tracking_number: Optional[str] = None) -> str:
+    """
+    Single-order form of update_shipment_statuses; `order` must be read FOR UPDATE.
+    Returns the order status after the change.
+    """
+    tracking_numbers = {order["id"]: tracking_number} if tracking_number else None
+    order_statuses = await update_shipment_statuses([order], owner_id, status, tracking_numbers)
+    return order_statuses[order["id"]]
+
+
+async def set_order_statuses(order_rows, status: str):
+    """
+    Admin override: sets the orders and every one of their shipments to `status`,
+    one UPDATE each. `order_rows` come from lock_orders. Fails with 400 when a
+    shipment (or a pre-shipments order) is already cancelled and `status` is not.
+    """
+    order_ids = [order["id"] for order in order_rows]
+    before = await _shipment_statuses(order_ids)
+    shipped = {order_id for order_id, _, _ in before}
+    _reject_uncancel(
+        [order_id for order_id, _, old_status in before if _is_cancelled(old_status)]
+        + [order["id"] for order in order_rows if order["id"] not in shipped and _is_cancelled(order["status"])],
+        status,
+    )
+    if _is_cancelled(status):
+        await restore_cancelled_stock(
+            [(order_id, owner) for order_id, owner, old_status in before if not _is_cancelled(old_status)]
+        )
+    await database.execute(orders.update().where(orders.c.id.in_(order_ids)).values(status=status))
+    await database.execute(
+        order_shipments.update()
+        .where(order_shipments.c.order_id.in_(order_ids))
+        .values(status=status, updated_at=now_ist_naive())
+    )
+    orders_by_id = {order["id"]: order for order in order_rows}
+    changes = [(orders_by_id[order_id], owner, old_status, status) for order_id, owner, old_status in before]
+    # Orders from before shipments existed move as a whole
+    changes += [(order, None, order["status"], status) for order in order_rows if order["id"] not in shipped]
+    await apply_shipment_status_changes(changes)
+
+
+async def set_order_status(order, status: str):
+    await set_order_statuses([order], status)
+
+
+# =====================
+# Backfill
+# =====================
+async def backfill_order_shipments():
+    """
+    Creates the missing shipments of orders placed before shipments existed, in
+    primary-key batches. Safe to re-run; existing shipments are left alone.
+    """
+    max_id = await database.fetch_val(select(func.max(orders.c.id)))
+    for start in range(0, (max_id or 0) + 1, SHIPMENT_BACKFILL_BATCH_SIZE):
+        await database.execute(
+            query="""
+            INSERT IGNORE INTO order_shipments
+                (order_id, owner_id, customer_id, status, order_date, subtotal, updated_at)
+            SELECT o.id, i.owner_id, o.customer_id, COALESCE(o.status, 'pending'),
+                   COALESCE(o.order_date, :now), SUM(oi.line_total_price), :now
+            FROM orders o
+            JOIN order_items oi ON oi.order_id = o.id
+            JOIN items i ON i.id = oi.item_id
+            WHERE o.id >= :start AND o.id < :end
+            GROUP BY o.id, i.owner_id, o.customer_id, o.status, o.order_date
+            """,
+            values={"start": start, "end": start + SHIPMENT_BACKFILL_BATCH_SIZE, "now": now_ist_naive()},
+        )
+
+
+async def _main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.shipments")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("backfill", help="create shipments for orders placed before they existed")
+    parser.parse_args(argv)
+
+    await database.connect()
+    try:
+        await backfill_order_shipments()
+        print("Order shipments backfilled", flush=True)
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
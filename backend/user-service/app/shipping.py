@@ -0,0 +1,98 @@
+import json
+import math
+import os
+from array import array
+from bisect import bisect_left
+from typing import Optional
+
+# Rate tables live in a JSON file so they can change without a code deploy
+SHIPPING_RATES_PATH = os.getenv(
+    "SHIPPING_RATES_PATH", os.path.join(os.path.dirname(__file__), "shipping_rates.json")
+)
+
+
+class ShippingRateTable:
+    """
+    Postal-code-prefix -> zone and zone x weight-band rate tables, flattened into
+    arrays at load time so a quote is two array reads and a bisect, with no DB access.
+    """
+
+    def __init__(self, config: dict):
+        self.zones = list(config["zones"])
+        zone_ids = {zone: i for i, zone in enumerate(self.zones)}
+        default_zone = zone_ids[config["default_zone"]]
+
+        # Every 3-digit prefix resolved once; the longest configured prefix wins
+        self.zone_by_prefix = array("B", [default_zone]) * 1000
+        for prefix, zone in sorted(config["postal_prefixes"].items(), key=lambda p: len(p[0])):
+            if not prefix.isdigit() or not 1 <= len(prefix) <= 3:
+                raise ValueError(f"Postal prefix must be 1-3 digits: {prefix!r}")
+            span = 10 ** (3 - len(prefix))
+            start = int(prefix) * span
+            for i in range(start, start + span):
+                self.zone_by_prefix[i] = zone_ids[zone]
+        self.default_zone = default_zone
+
+        self.band_limits = list(config["weight_bands_grams"])
+        bands = len(self.band_limits)
+        self.rates = array("d", [0.0]) * (len(self.zones) * bands)
+        for zone, rates in config["rates"].items():
+            if len(rates) != bands:
+                raise ValueError(f"Zone {zone!r} needs one rate per weight band")
+            base = zone_ids[zone] * bands
+            for band, rate in enumerate(rates):
+                self.rates[base + band] = float(rate)
+        self.overweight_per_kg = array("d", [0.0]) * len(self.zones)
+        for zone, rate in config.get("overweight_per_kg", {}).items():
+            self.overweight_per_kg[zone_ids[zone]] = float(rate)
+
+        self.default_item_weight_grams = int(config.get("default_item_weight_grams", 500))
+        self.free_shipping_above = config.get("free_shipping_above")
+
+    def zone_for(self, postal_code: str) -> int:
+        digits = "".join(ch for ch in postal_code or "" if ch.isdigit())
+        if len(digits) < 3:
+            return self.default_zone
+        return self.zone_by_prefix[int(digits[:3])]
+
+    def quote(self, postal_code: str, weight_grams: int, subtotal: Optional[float] = None) -> dict:
+        zone = self.zone_for(postal_code)
+        if self.free_shipping_above is not None and subtotal is not None and subtotal >= self.free_shipping_above:
+            charge = 0.0
+        else:
+            bands = len(self.band_limits)
+            band = bisect_left(self.band_limits, weight_grams)
+            if band < bands:
+                charge = self.rates[zone * bands + band]
+            else:
+                extra_kg = math.ceil((weight_grams - self.band_limits[-1]) / 1000)
+                charge = self.rates[zone * bands + bands - 1] + extra_kg * self.overweight_per_kg[zone]
+        return {
+            "postal_code": postal_code,
+            "zone": self.zones[zone],
+            "weight_grams": weight_grams,
+            "charge": charge,
+        }
+
+
+_rate_table: Optional[ShippingRateTable] = None
+
+
+def load_rate_table(path: str = SHIPPING_RATES_PATH) -> ShippingRateTable:
+    """
+    (Re)loads the rate tables; called at startup.
+    """
+    global _rate_table
+    with open(path, encoding="utf-8") as f:
+        _rate_table = ShippingRateTable(json.load(f))
+    return _rate_table
+
+
+def get_rate_table() -> ShippingRateTable:
+    if _rate_table is None:
+        return load_rate_table()
+    return _rate_table
+
+
+def quote_shipping(postal_code: str, weight_grams: int, subtotal: Optional[float] = None) -> dict:
+    return get_rate_table().quote(postal_code, weight_grams, subtotal)
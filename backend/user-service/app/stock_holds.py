@@ -0,0 +1,286 @@
+import asyncio
+import heapq
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, func
+
+from app.auth import now_ist_naive
+from app.database import database
+from app.inventory import take_stock, add_stock, add_stock_movements
+from app.models import stock_holds, order_items, items
+
+# How long stock stays held for a payment that never reports back
+STOCK_HOLD_TTL_SECONDS = int(os.getenv("STOCK_HOLD_TTL_SECONDS", 900))
+# Holds placed by other processes (or before a restart) are picked up by an indexed sweep this often
+STOCK_HOLD_SWEEP_SECONDS = float(os.getenv("STOCK_HOLD_SWEEP_SECONDS", 60))
+STOCK_HOLD_RELEASE_BATCH_SIZE = int(os.getenv("STOCK_HOLD_RELEASE_BATCH_SIZE", 500))
+
+
+async def _mark_holds(hold_ids, status: str, now: datetime):
+    if hold_ids:
+        await database.execute(
+            stock_holds.update().where(stock_holds.c.id.in_(list(hold_ids))).values(status=status, updated_at=now)
+        )
+
+
+async def _release(holds, now: datetime) -> int:
+    await add_stock_movements(
+        [(hold["variant_id"], hold["quantity"], f"txn:{hold['transaction_id']}") for hold in holds], "release"
+    )
+    await _mark_holds([hold["id"] for hold in holds], "released", now)
+    return len(holds)
+
+
+# =====================
+# Payment lifecycle
+# =====================
+async def place_holds(transaction_id: str, quantities: dict) -> datetime:
+    """
+    Moves stock into holds for a payment being initiated; call inside a transaction.
+    `quantities` maps variant_id -> units. Stock is checked and taken under the
+    variant locks, so concurrent checkouts cannot oversell. Returns when the holds
+    expire; pass that to schedule_hold_expiry once the transaction has committed.
+    """
+    now = now_ist_naive()
+    expires_at = now + timedelta(seconds=STOCK_HOLD_TTL_SECONDS)
+    await take_stock(quantities, "hold", f"txn:{transaction_id}")
+
+    await database.execute(
+        stock_holds.insert().values([
+            {
+                "transaction_id": transaction_id,
+                "variant_id": variant_id,
+                "quantity": quantity,
+                "status": "held",
+                "expires_at": expires_at,
+                "created_at": now,
+                "updated_at": now,
+            }
+            for variant_id, quantity in sorted(quantities.items())
+        ])
+    )
+    return expires_at
+
+
+async def commit_holds(transaction_ids):
+    """Payment succeeded: the held stock is sold for good."""
+    if transaction_ids:
+        await database.execute(
+            stock_holds.update()
+            .where(stock_holds.c.transaction_id.in_(list(transaction_ids)))
+            .where(stock_holds.c.status == "held")
+            .values(status="committed", updated_at=now_ist_naive())
+        )
+
+
+async def release_holds(transaction_ids, expired_before: Optional[datetime] = None) -> int:
+    """
+    Payment failed or timed out: returns still-held stock to the variants. Only holds
+    in the held state are touched, so a late release never undoes a commit. Expiry
+    (expired_before set) skips holds an order has claimed: those units belong to the
+    order until the payment resolves. Returns how many holds were released.
+    """
+    if not transaction_ids:
+        return 0
+    query = (
+        stock_holds.select()
+        .where(stock_holds.c.transaction_id.in_(list(transaction_ids)))
+        .where(stock_holds.c.status == "held")
+    )
+    if expired_before is not None:
+        query = query.where(stock_holds.c.expires_at <= expired_before).where(stock_holds.c.order_id.is_(None))
+    holds = await database.fetch_all(query.order_by(stock_holds.c.id).with_for_update())
+    return await _release(holds, now_ist_naive())
+
+
+# =====================
+# Orders
+# =====================
+async def lock_open_holds(transaction_id: str) -> dict:
+    """
+    Holds of a payment not yet claimed by an order, read FOR UPDATE so the expiry
+    job cannot release them while create_order runs. Returns variant_id -> hold.
+    """
+    holds = await database.fetch_all(
+        stock_holds.select()
+        .where(stock_holds.c.transaction_id == transaction_id)
+        .where(stock_holds.c.status.in_(("held", "committed")))
+        .where(stock_holds.c.order_id.is_(None))
+        .order_by(stock_holds.c.id)
+        .with_for_update()
+    )
+    return {hold["variant_id"]: hold for hold in holds}
+
+
+async def attach_holds(order_id: int, holds: dict, ordered: dict) -> dict:
+    """
+    Claims a payment's holds for a new order. `ordered` maps variant_id -> units in
+    the order; held units beyond that are returned to stock straight away.
+    Returns variant_id -> units already taken from stock by the holds.
+    """
+    now = now_ist_naive()
+    covered, excess, unused = {}, {}, []
+    for variant_id, hold in holds.items():
+        quantity = min(hold["quantity"], ordered.get(variant_id, 0))
+        if quantity < hold["quantity"]:
+            excess[variant_id] = hold["quantity"] - quantity
+        if quantity == 0:
+            unused.append(hold["id"])
+            continue
+        covered[variant_id] = quantity
+        values = {"order_id": order_id, "updated_at": now}
+        if quantity < hold["quantity"]:
+            values["quantity"] = quantity
+        await database.execute(stock_holds.update().where(stock_holds.c.id == hold["id"]).values(**values))
+
+    await add_stock(excess, "release", f"order:{order_id}")
+    await _mark_holds(unused, "released", now)
+    return covered
+
+
+async def restore_cancelled_stock(shipment_keys):
+    """
+    Returns the stock of newly cancelled shipments, given as (order_id, owner_id)
+    pairs. Units whose hold was already released (payment failed or timed out) were
+    given back then and are not counted twice; the remaining holds are closed.
+    """
+    shipment_keys = set(shipment_keys)
+    if not shipment_keys:
+        return
+    order_ids = sorted({order_id for order_id, _ in shipment_keys})
+
+    lines = await database.fetch_all(
+        select(
+            order_items.c.order_id,
+            items.c.owner_id,
+            order_items.c.variant_id,
+            func.sum(order_items.c.quantity).label("quantity"),
+        )
+        .select_from(order_items.join(items, items.c.id == order_items.c.item_id))
+        .where(order_items.c.order_id.in_(order_ids))
+        .group_by(order_items.c.order_id, items.c.owner_id, order_items.c.variant_id)
+    )
+    quantities = {}
+    cancelled_lines = set()
+    for line in lines:
+        if line["variant_id"] is None or (line["order_id"], line["owner_id"]) not in shipment_keys:
+            continue
+        key = (line["order_id"], line["variant_id"])
+        quantities[key] = quantities.get(key, 0) + int(line["quantity"])
+        cancelled_lines.add(key)
+
+    holds = await database.fetch_all(
+        stock_holds.select().where(stock_holds.c.order_id.in_(order_ids)).order_by(stock_holds.c.id).with_for_update()
+    )
+    closing = []
+    for hold in holds:
+        if (hold["order_id"], hold["variant_id"]) not in cancelled_lines:
+            continue
+        if hold["status"] == "released":
+            quantities[(hold["order_id"], hold["variant_id"])] -= hold["quantity"]
+        else:
+            closing.append(hold["id"])
+
+    await add_stock_movements(
+        [(variant_id, quantity, f"order:{order_id}") for (order_id, variant_id), quantity in quantities.items()],
+        "cancellation",
+    )
+    await _mark_holds(closing, "released", now_ist_naive())
+
+
+# =====================
+# Expiry scheduler
+# =====================
+class _HoldExpiryScheduler:
+    """
+    Min-heap of (expires_at, transaction_id). The loop sleeps until the earliest
+    expiry and releases everything due in one batch, so the holds table is never
+    polled as a whole. A coarse sweep on (status, expires_at) feeds the heap with
+    holds this process did not place itself.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self, transaction_id: str, expires_at: datetime):
+        heapq.heappush(self._heap, (expires_at, transaction_id))
+        if self._heap[0][1] == transaction_id:
+            self._wakeup.set()
+
+    async def _sweep(self, now: datetime):
+        rows = await database.fetch_all(
+            select(stock_holds.c.transaction_id, func.min(stock_holds.c.expires_at).label("expires_at"))
+            .where(stock_holds.c.status == "held")
+            .where(stock_holds.c.order_id.is_(None))
+            .where(stock_holds.c.expires_at <= now + timedelta(seconds=STOCK_HOLD_SWEEP_SECONDS))
+            .group_by(stock_holds.c.transaction_id)
+        )
+        for row in rows:
+            heapq.heappush(self._heap, (row["expires_at"], row["transaction_id"]))
+
+    async def _release_due(self, now: datetime):
+        due = set()
+        while self._heap and self._heap[0][0] <= now:
+            due.add(heapq.heappop(self._heap)[1])
+        due = sorted(due)
+        for start in range(0, len(due), STOCK_HOLD_RELEASE_BATCH_SIZE):
+            async with database.transaction():
+                released = await release_holds(due[start:start + STOCK_HOLD_RELEASE_BATCH_SIZE], expired_before=now)
+            if released:
+                print(f"Released {released} expired stock holds", flush=True)
+
+    async def _run(self):
+        next_sweep = 0.0
+        while True:
+            self._wakeup.clear()
+            try:
+                now = now_ist_naive()
+                if time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + STOCK_HOLD_SWEEP_SECONDS
+                    await self._sweep(now)
+                await self._release_due(now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Stock hold expiry error: {e}", flush=True)
+
+            timeout = max(0.0, next_sweep - time.monotonic())
+            if self._heap:
+                timeout = min(timeout, max(0.0, (self._heap[0][0] - now_ist_naive()).total_seconds()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+_scheduler = _HoldExpiryScheduler()
+
+
+def schedule_hold_expiry(transaction_id: str, expires_at: datetime):
+    _scheduler.schedule(transaction_id, expires_at)
+
+
+def start_hold_scheduler():
+    _scheduler.start()
+
+
+async def stop_hold_scheduler():
+    await _scheduler.stop()
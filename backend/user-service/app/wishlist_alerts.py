@@ -0,0 +1,233 @@
+"""
+Back-in-stock and price-drop alerts for wishlisted items.
+
+Stock and price writers append wishlist_alert_events rows in their own transaction
+(see app.inventory and record_price_drop). A background matcher drains the events in
+batches, finds the wishlisters through ix_wishlist_item_id and writes in-app
+notifications with one multi-row insert; a slower loop mails each customer at most
+one digest per WISHLIST_DIGEST_SECONDS.
+"""
+import asyncio
+import os
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import select
+
+from app.auth import now_ist_naive
+from app.crud import insert_notifications, publish_notifications
+from app.database import database
+from app.email_service import send_wishlist_digests
+from app.inventory import get_stock
+from app.models import wishlist, wishlist_alert_events, wishlist_alerts, product_variants, items, users
+
+WISHLIST_ALERT_POLL_SECONDS = float(os.getenv("WISHLIST_ALERT_POLL_SECONDS", 5))
+WISHLIST_ALERT_BATCH_SIZE = int(os.getenv("WISHLIST_ALERT_BATCH_SIZE", 500))
+# The same alert (customer, variant, kind) is not repeated within this window, so flapping stock stays quiet
+WISHLIST_ALERT_COOLDOWN_HOURS = int(os.getenv("WISHLIST_ALERT_COOLDOWN_HOURS", 24))
+WISHLIST_DIGEST_SECONDS = float(os.getenv("WISHLIST_DIGEST_SECONDS", 3600))
+WISHLIST_DIGEST_BATCH_SIZE = int(os.getenv("WISHLIST_DIGEST_BATCH_SIZE", 2000))
+
+
+# =====================
+# Change hooks (call inside the writer's transaction)
+# =====================
+async def record_price_drop(variant, new_price: Optional[float]):
+    """Queues a price-drop event when `variant` (the row before the update) gets cheaper."""
+    old_price = variant["price"]
+    if old_price is None or new_price is None or new_price >= old_price:
+        return
+    await database.execute(
+        wishlist_alert_events.insert().values(
+            item_id=variant["item_id"],
+            variant_id=variant["id"],
+            kind="price_drop",
+            old_value=old_price,
+            new_value=new_price,
+            created_at=now_ist_naive(),
+            processed_at=None,
+        )
+    )
+
+
+# =====================
+# Matcher
+# =====================
+def _variant_label(variant) -> str:
+    options = ", ".join(option for option in (variant["size"], variant["color"]) if option)
+    return f"'{variant['title']}' ({options})" if options else f"'{variant['title']}'"
+
+
+def _alert_message(kind: str, variant, change) -> str:
+    if kind == "price_drop":
+        return f"Price drop: {_variant_label(variant)} is now Rs. {change['new_value']:.2f} (was Rs. {change['old_value']:.2f})."
+    return f"Back in stock: {_variant_label(variant)} is available again."
+
+
+async def process_alert_events(batch_size: int = WISHLIST_ALERT_BATCH_SIZE) -> int:
+    """
+    Turns one batch of pending events into alerts for everyone who wishlisted the
+    item. Events of the same variant and kind are collapsed, and changes that were
+    undone before the batch ran (sold out again, price raised back) are dropped.
+    Returns how many events were consumed.
+    """
+    async with database.transaction():
+        events = await database.fetch_all(
+            wishlist_alert_events.select()
+            .where(wishlist_alert_events.c.processed_at.is_(None))
+            .order_by(wishlist_alert_events.c.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        if not events:
+            return 0
+        now = now_ist_naive()
+
+        changes = {}
+        for event in events:
+            key = (event["variant_id"], event["kind"])
+            if key in changes:
+                changes[key]["new_value"] = event["new_value"]
+            else:
+                changes[key] = dict(event)
+
+        stock = await get_stock([variant_id for variant_id, kind in changes if kind == "back_in_stock"])
+        variants = {
+            row["id"]: row
+            for row in await database.fetch_all(
+                select(product_variants.c.id, product_variants.c.size, product_variants.c.color, items.c.title)
+                .select_from(product_variants.join(items, items.c.id == product_variants.c.item_id))
+                .where(product_variants.c.id.in_(sorted({variant_id for variant_id, _ in changes})))
+            )
+        }
+        for (variant_id, kind), change in list(changes.items()):
+            if variant_id not in variants:
+                del changes[(variant_id, kind)]
+            elif kind == "back_in_stock" and not (stock.get(variant_id) is None or stock[variant_id] > 0):
+                del changes[(variant_id, kind)]
+            elif kind == "price_drop" and change["new_value"] >= change["old_value"]:
+                del changes[(variant_id, kind)]
+
+        rows = []
+        if changes:
+            subscribers = {}
+            for row in await database.fetch_all(
+                select(wishlist.c.customer_id, wishlist.c.item_id)
+                .where(wishlist.c.item_id.in_(sorted({change["item_id"] for change in changes.values()})))
+                .distinct()
+            ):
+                subscribers.setdefault(row["item_id"], []).append(row["customer_id"])
+
+            recent = {
+                (row["user_id"], row["variant_id"], row["kind"])
+                for row in await database.fetch_all(
+                    select(wishlist_alerts.c.user_id, wishlist_alerts.c.variant_id, wishlist_alerts.c.kind)
+                    .where(wishlist_alerts.c.variant_id.in_(sorted({variant_id for variant_id, _ in changes})))
+                    .where(wishlist_alerts.c.created_at >= now - timedelta(hours=WISHLIST_ALERT_COOLDOWN_HOURS))
+                )
+            }
+            for (variant_id, kind), change in sorted(changes.items()):
+                message = _alert_message(kind, variants[variant_id], change)
+                for user_id in subscribers.get(change["item_id"], []):
+                    if (user_id, variant_id, kind) in recent:
+                        continue
+                    rows.append({
+                        "user_id": user_id,
+                        "item_id": change["item_id"],
+                        "variant_id": variant_id,
+                        "kind": kind,
+                        "message": message,
+                        "created_at": now,
+                        "emailed_at": None,
+                    })
+
+        if rows:
+            published = await insert_notifications(rows)
+            await database.execute(wishlist_alerts.insert().values(rows))
+        await database.execute(
+            wishlist_alert_events.update()
+            .where(wishlist_alert_events.c.id.in_([event["id"] for event in events]))
+            .values(processed_at=now)
+        )
+
+    if rows:
+        publish_notifications(published)
+        print(f"Sent {len(rows)} wishlist alerts from {len(events)} stock/price events", flush=True)
+    return len(events)
+
+
+# =====================
+# Email digest
+# =====================
+async def send_alert_digests(batch_size: int = WISHLIST_DIGEST_BATCH_SIZE) -> int:
+    """
+    Mails every customer with unsent alerts one digest of them. Alerts are marked
+    before sending, so a failed mail is not retried; the in-app notification stays.
+    Returns how many digests went out.
+    """
+    sent = 0
+    while True:
+        async with database.transaction():
+            pending = await database.fetch_all(
+                select(wishlist_alerts.c.id, wishlist_alerts.c.message, users.c.email)
+                .select_from(wishlist_alerts.join(users, users.c.id == wishlist_alerts.c.user_id))
+                .where(wishlist_alerts.c.emailed_at.is_(None))
+                .order_by(wishlist_alerts.c.user_id, wishlist_alerts.c.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            if not pending:
+                return sent
+            await database.execute(
+                wishlist_alerts.update()
+                .where(wishlist_alerts.c.id.in_([alert["id"] for alert in pending]))
+                .values(emailed_at=now_ist_naive())
+            )
+
+        digests = {}
+        for alert in pending:
+            digests.setdefault(alert["email"], []).append(alert["message"])
+        delivered = await asyncio.get_running_loop().run_in_executor(
+            None, send_wishlist_digests, [{"to_email": email, "lines": lines} for email, lines in digests.items()]
+        )
+        sent += len(delivered)
+        if len(pending) < batch_size:
+            return sent
+
+
+_alert_task: Optional[asyncio.Task] = None
+
+
+async def _run_alerts():
+    next_digest = asyncio.get_running_loop().time() + WISHLIST_DIGEST_SECONDS
+    while True:
+        await asyncio.sleep(WISHLIST_ALERT_POLL_SECONDS)
+        try:
+            while await process_alert_events() == WISHLIST_ALERT_BATCH_SIZE:
+                pass
+            if asyncio.get_running_loop().time() >= next_digest:
+                next_digest = asyncio.get_running_loop().time() + WISHLIST_DIGEST_SECONDS
+                digests = await send_alert_digests()
+                if digests:
+                    print(f"Sent {digests} wishlist digest emails", flush=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Wishlist alert error: {e}", flush=True)
+
+
+def start_wishlist_alerts():
+    global _alert_task
+    if _alert_task is None:
+        _alert_task = asyncio.create_task(_run_alerts())
+
+
+async def stop_wishlist_alerts():
+    global _alert_task
+    if _alert_task is not None:
+        _alert_task.cancel()
+        try:
+            await _alert_task
+        except asyncio.CancelledError:
+            pass
+        _alert_task = None
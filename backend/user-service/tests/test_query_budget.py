@@ -0,0 +1,234 @@
+"""
+Query budgets for endpoints that used to run one query per row. The database is
+faked at the databases.Database level, below InstrumentedDatabase, so every query
+the endpoint makes is still counted; the app is driven in-process through
+QueryAccountingMiddleware so its per-request stats nest inside query_budget.
+"""
+import re
+from datetime import datetime
+
+import databases
+import httpx
+import pytest
+from fastapi import FastAPI
+from sqlalchemy import select
+
+from app.database import database
+from app.deps import get_current_admin_user, get_current_user
+from app.models import items
+from app.query_accounting import QueryAccountingMiddleware, query_budget
+from app.routes import carts as carts_routes
+from app.routes import items as items_routes
+from app.routes import orders as orders_routes
+from app.routes import wishlist as wishlist_routes
+
+ROW_COUNT = 25
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class _Row(dict):
+    """A fake record: both row["column"] and row.column work, like databases' Record."""
+    __getattr__ = dict.__getitem__
+
+
+def _main_table(query) -> str:
+    # Drop parenthesised parts (scalar subqueries, IN lists) so the first FROM left is the query's own
+    sql = str(query)
+    while True:
+        stripped = re.sub(r"\([^()]*\)", "", sql)
+        if stripped == sql:
+            break
+        sql = stripped
+    return re.search(r"\bFROM\s+(\w+)", sql).group(1)
+
+
+def _item(i: int) -> dict:
+    return {"id": i, "title": f"Item {i}", "description": None, "brand": None, "owner_id": 3}
+
+
+def _variant(i: int, item_id: int) -> dict:
+    return {
+        "id": i, "item_id": item_id, "size": "M", "color": "Red", "price": 499.0, "stock": 4,
+        "image_url": None, "weight_grams": None, "stock_ledger_id": 0,
+    }
+
+
+def _rows() -> dict:
+    """Rows per table: ROW_COUNT items with two variants each, and a cart, orders and wishlist over them."""
+    now = datetime(2026, 1, 1)
+    ids = range(1, ROW_COUNT + 1)
+    return {
+        "items": [
+            {**_item(i), "owner_username": "shop", "owner_email": "shop@example.com"} for i in ids
+        ],
+        "product_variants": [_variant(2 * i + k, i) for i in ids for k in (0, 1)],
+        "variant_images": [{"variant_id": 2 * i, "image_url": f"/img/{i}.png"} for i in ids],
+        "categories": [{"id": 1, "name": "Shirts", "description": None, "parent_id": None, "item_id": i} for i in ids],
+        "item_attributes": [{"id": i, "item_id": i, "attribute_key": "fabric", "value": "cotton"} for i in ids],
+        "carts": [
+            {
+                "id": i, "user_id": 7, "item_id": i, "variant_id": 2 * i, "quantity": 1,
+                "item_title": f"Item {i}", "item_description": None, "item_owner_id": 3,
+                "selected_variant_id": 2 * i, "selected_variant_item_id": i, "selected_variant_color": "Red",
+                "selected_variant_size": "M", "selected_variant_price": 499.0, "selected_variant_stock": 4,
+                "selected_variant_image_url": None,
+            }
+            for i in ids
+        ],
+        "orders": [
+            {
+                "id": i, "customer_id": 7, "status": "pending", "order_date": now, "total_price": 499.0,
+                "coupon_code": None, "transaction_id": None, "shipping_address_id": 1,
+                "shipping_charge": None, "payment_status": None,
+            }
+            for i in ids
+        ],
+        "order_items": [
+            {
+                "id": i, "order_id": i, "item_id": i, "quantity": 1, "variant_id": 2 * i,
+                "item_title": f"Item {i}", "variant_image_url": None, "variant_color": "Red",
+                "variant_size": "M", "variant_price": 499.0, "line_total_price": 499.0,
+            }
+            for i in ids
+        ],
+        "addresses": [
+            {
+                "id": 1, "user_id": 7, "full_name": "Asha Rao", "phone": "9876543210",
+                "address_line1": "12 MG Road", "address_line2": None, "city": "Pune",
+                "state": "Maharashtra", "postal_code": "411001", "country": "India",
+                "is_default": True, "created_at": now, "updated_at": now,
+            }
+        ],
+        "wishlist": [
+            {
+                "id": i, "customer_id": 7, "item_id": i, "title": f"Item {i}", "description": None,
+                "price": 499.0, "image_url": None, "owner_id": 3, "color": "Red", "size": "M",
+            }
+            for i in ids
+        ],
+    }
+
+
+@pytest.fixture
+def fake_database(monkeypatch):
+    """Answers every query from memory with all rows of the query's main table."""
+    rows = _rows()
+
+    async def fetch_all(self, query, values=None):
+        return [_Row(row) for row in rows.get(_main_table(query), [])]
+
+    async def fetch_one(self, query, values=None):
+        return None
+
+    async def fetch_val(self, query, values=None, column=0):
+        return None
+
+    monkeypatch.setattr(databases.Database, "fetch_all", fetch_all)
+    monkeypatch.setattr(databases.Database, "fetch_one", fetch_one)
+    monkeypatch.setattr(databases.Database, "fetch_val", fetch_val)
+
+
+def _client(app: FastAPI, role: str = "customer") -> httpx.AsyncClient:
+    user = {"id": 7, "role": role, "username": "asha"}
+    app.add_middleware(QueryAccountingMiddleware)
+    app.dependency_overrides[get_current_user] = lambda: user
+    app.dependency_overrides[get_current_admin_user] = lambda: user
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+
+async def _get_within_budget(app: FastAPI, path: str, max_queries: int, role: str = "customer"):
+    async with _client(app, role) as client:
+        with query_budget(max_queries=max_queries, max_repeats=1) as stats:
+            response = await client.get(path)
+    assert response.status_code == 200, response.text
+    return response, stats
+
+
+@pytest.mark.anyio
+async def test_get_my_wishlist_is_one_query(fake_database):
+    app = FastAPI()
+    app.include_router(wishlist_routes.router)
+
+    response, stats = await _get_within_budget(app, "/wishlist/", max_queries=1)
+
+    assert len(response.json()) == ROW_COUNT
+    # Counted by the middleware's stats and merged into the budget's
+    assert stats.count == 1
+
+
+@pytest.mark.anyio
+async def test_list_items_query_count_does_not_grow_with_items(fake_database):
+    app = FastAPI()
+    app.include_router(items_routes.router)
+
+    response, stats = await _get_within_budget(app, "/items/", max_queries=5)
+
+    body = response.json()
+    assert len(body) == ROW_COUNT
+    assert [len(item["variants"]) for item in body] == [2] * ROW_COUNT
+    assert body[0]["categories"][0]["name"] == "Shirts"
+    assert body[0]["attributes"][0]["value"] == "cotton"
+    assert stats.count == 5
+
+
+@pytest.mark.anyio
+async def test_admin_list_items_query_count_does_not_grow_with_items(fake_database):
+    app = FastAPI()
+    app.include_router(items_routes.router)
+
+    response, stats = await _get_within_budget(app, "/admin/items", max_queries=2, role="admin")
+
+    body = response.json()
+    assert len(body) == ROW_COUNT
+    assert body[0]["variant_count"] == 2
+    assert body[0]["total_stock"] == 8
+    assert stats.count == 2
+
+
+@pytest.mark.anyio
+async def test_get_cart_query_count_does_not_grow_with_cart_rows(fake_database):
+    app = FastAPI()
+    app.include_router(carts_routes.router, prefix="/cart")
+
+    response, stats = await _get_within_budget(app, "/cart/", max_queries=2)
+
+    body = response.json()
+    assert len(body) == ROW_COUNT
+    assert [len(row["item"]["variants"]) for row in body] == [2] * ROW_COUNT
+    assert stats.count == 2
+
+
+@pytest.mark.anyio
+async def test_view_my_orders_query_count_does_not_grow_with_orders(fake_database):
+    app = FastAPI()
+    app.include_router(orders_routes.router)
+
+    response, stats = await _get_within_budget(app, "/orders/me", max_queries=3)
+
+    body = response.json()
+    assert len(body) == ROW_COUNT
+    assert body[0]["items"][0]["item_title"] == "Item 1 (Red, M)"
+    assert body[0]["shipping_address"]["city"] == "Pune"
+    assert stats.count == 3
+
+
+@pytest.mark.anyio
+async def test_query_budget_catches_per_row_queries(fake_database):
+    app = FastAPI()
+
+    @app.get("/n-plus-one")
+    async def n_plus_one():
+        rows = await database.fetch_all(select(items.c.id))
+        for row in rows:
+            await database.fetch_one(select(items).where(items.c.id == row["id"]))
+        return {"rows": len(rows)}
+
+    async with _client(app) as client:
+        with pytest.raises(AssertionError, match="Query budget exceeded"):
+            with query_budget(max_queries=5, max_repeats=1):
+                response = await client.get("/n-plus-one")
+                assert response.status_code == 200
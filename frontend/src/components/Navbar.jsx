@@ -43,9 +43,8 @@ export default function Navbar() {
     if (user) {
       const fetchNotifications = async () => {
         try {
-          const res = await API.get("/notifications");
-          const unread = res.data.filter((n) => !n.is_read).length;
-          setUnreadCount(unread);
+          const res = await API.get("/notifications/unread-count");
+          setUnreadCount(res.data.unread);
         } catch (err) {
           console.error("Failed to fetch notifications", err);
         }
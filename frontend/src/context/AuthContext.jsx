@@ -107,10 +107,12 @@ export function AuthProvider({ children }) {
   const fetchNotifications = useCallback(async () => {
     if (!authToken) return;
     try {
-      const res = await API.get("/notifications");
+      const [res, countRes] = await Promise.all([
+        API.get("/notifications"),
+        API.get("/notifications/unread-count"),
+      ]);
       setNotifications(res.data);
-      const unread = res.data.filter((n) => !n.is_read).length;
-      setUnreadCount(unread);
+      setUnreadCount(countRes.data.unread);
     } catch (err) {
       console.error("Failed to fetch notifications:", err);
     }
@@ -745,7 +745,7 @@ export default function AdminPanel() {
         const [usersRes, itemsRes, notificationsRes, couponsRes] = await Promise.all([
           API.get("/users/"),
           API.get("/admin/items"),
-          API.get("/notifications"),
+          API.get("/notifications", { params: { limit: 5 } }),
           getAdminCoupons()
         ]);
 